@@ -13,8 +13,13 @@ export CLASSES_PATH=${CLASSES_PATH:-vlfm/vlm/classes.txt}
 export GROUNDING_DINO_PORT=${GROUNDING_DINO_PORT:-12181}
 export BLIP2ITM_PORT=${BLIP2ITM_PORT:-12182}
 export SAM_PORT=${SAM_PORT:-12183}
+# Combined GroundingDINO + MobileSAM server. The policy only uses it when
+# DETECT_AND_SEGMENT_PORT is exported before running the evaluation.
+DETECT_AND_SEGMENT_PORT=${DETECT_AND_SEGMENT_PORT:-12185}
 
 export LLava_PORT=${LLava_PORT:-12189}
+# Optional SQLite file where LLaVA stores its answers, so reruns skip the GPU on repeats
+LLAVA_RESPONSE_CACHE=${LLAVA_RESPONSE_CACHE:-}
 export LLAMA_PORT=${LLAMA_PORT:-12190}
 
 CUDA_DEVICE=0
@@ -37,10 +42,19 @@ tmux send-keys -t ${session_name}:0.0 "CUDA_VISIBLE_DEVICES=${CUDA_DEVICE} ${VLF
 tmux send-keys -t ${session_name}:0.1 "CUDA_VISIBLE_DEVICES=${CUDA_DEVICE} ${VLFM_PYTHON} -m vlfm.vlm.blip2itm --port ${BLIP2ITM_PORT}" C-m
 tmux send-keys -t ${session_name}:0.2 "CUDA_VISIBLE_DEVICES=${CUDA_DEVICE} ${VLFM_PYTHON} -m vlfm.vlm.sam --port ${SAM_PORT}" C-m
 
-tmux send-keys -t ${session_name}:0.3 "CUDA_VISIBLE_DEVICES=\"${CUDA_DEVICE},${CUDA_DEVICE+1}\" ${VLFM_PYTHON} -m vlfm.vlm.llava_next --port ${LLava_PORT}" C-m
+tmux send-keys -t ${session_name}:0.3 "CUDA_VISIBLE_DEVICES=\"${CUDA_DEVICE},${CUDA_DEVICE+1}\" ${VLFM_PYTHON} -m vlfm.vlm.llava_next --port ${LLava_PORT} ${LLAVA_RESPONSE_CACHE:+--response-cache ${LLAVA_RESPONSE_CACHE}}" C-m
 # tmux send-keys -t ${session_name}:0.4 "CUDA_VISIBLE_DEVICES=${CUDA_DEVICE+1} ${VLFM_PYTHON} -m vlfm.vlm.llama_3 --port ${LLAMA_PORT}" C-m
+# tmux send-keys -t ${session_name}:0.4 "CUDA_VISIBLE_DEVICES=${CUDA_DEVICE} ${VLFM_PYTHON} -m vlfm.vlm.detect_and_segment --port ${DETECT_AND_SEGMENT_PORT}" C-m
 
-# Attach to the tmux session to view the windows
-echo "Created tmux session '${session_name}'. You must wait up to 90 seconds for the model weights to finish being loaded."
+echo "Created tmux session '${session_name}'."
 echo "Run the following to monitor all the server commands:"
 echo "tmux attach-session -t ${session_name}"
+
+# Block until every server reports that its model is loaded and warmed up
+for port in ${GROUNDING_DINO_PORT} ${BLIP2ITM_PORT} ${SAM_PORT} ${LLava_PORT}; do
+  echo "Waiting for the server on port ${port} to be ready..."
+  until curl -sf "http://localhost:${port}/ready" > /dev/null; do
+    sleep 1
+  done
+done
+echo "All servers are ready."
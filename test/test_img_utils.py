@@ -0,0 +1,24 @@
+# Copyright (c) 2023 Boston Dynamics AI Institute LLC. All rights reserved.
+
+import numpy as np
+
+from vlfm.utils.img_utils import pixel_value_within_radius, pixel_values_within_radius
+
+
+def test_pixel_values_within_radius_matches_single_pixel_version() -> None:
+    rng = np.random.default_rng(0)
+    image = rng.uniform(0, 1, (120, 100, 2)).astype(np.float32)
+    image[rng.uniform(0, 1, image.shape[:2]) < 0.5] = 0
+    image[:40, :40] = 0  # not seen yet
+    # locations close to the borders of the image, where the neighborhood is cropped
+    locations = np.array([[0, 0], [5, 97], [119, 3], [60, 50], [10, 10], [119, 99], [30, 45]])
+
+    for reduction in ["median", "max"]:
+        values = pixel_values_within_radius(image, locations, 12, reduction=reduction)
+        assert values.shape == (len(locations), 2)
+        for location, location_values in zip(locations, values):
+            for c in range(2):
+                expected = pixel_value_within_radius(image[..., c], tuple(location), 12, reduction=reduction)
+                assert location_values[c] == expected
+
+    assert pixel_values_within_radius(image[..., 0], locations, 12)[4] == -1
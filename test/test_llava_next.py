@@ -0,0 +1,33 @@
+# Copyright (c) 2023 Boston Dynamics AI Institute LLC. All rights reserved.
+
+from typing import List
+
+import pytest
+
+pytest.importorskip("transformers")
+
+from vlfm.vlm.llava_next import label_token_ids  # noqa: E402
+
+
+class _SentencePieceLikeTokenizer:
+    """Encodes "?" and " Yes" with a bare "▁" token in front, like the Llama/Mistral tokenizers."""
+
+    vocab = {"<unk>": 0, "▁": 1, "?": 2, "Yes": 3, "▁Yes": 4, "No": 5, "▁No": 6}
+    unk_token_id = 0
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> List[int]:
+        return {"?": [1, 2], " ?": [1, 2], "Yes": [3], " Yes": [1, 3], "No": [6], " No": [6]}[text]
+
+    def decode(self, token_ids: List[int]) -> str:
+        tokens = {token_id: token for token, token_id in self.vocab.items()}
+        return "".join(tokens[token_id] for token_id in token_ids).replace("▁", " ")
+
+    def convert_tokens_to_ids(self, token: str) -> int:
+        return self.vocab.get(token, self.unk_token_id)
+
+
+def test_label_token_ids_skip_the_bare_prefix_token() -> None:
+    tokenizer = _SentencePieceLikeTokenizer()
+    assert label_token_ids(tokenizer, "?") == [2]
+    assert label_token_ids(tokenizer, "Yes") == [3, 4]
+    assert label_token_ids(tokenizer, "No") == [5, 6]
@@ -0,0 +1,170 @@
+# Copyright (c) 2023 Boston Dynamics AI Institute LLC. All rights reserved.
+
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import requests
+
+import vlfm.vlm.server_wrapper as server_wrapper
+from vlfm.vlm.server_wrapper import (
+    SharedMemoryRing,
+    StaleFrameError,
+    UnknownImageError,
+    _ImageStore,
+    decode_frames,
+    encode_frames,
+    image_hash,
+    mask_to_packed_roi,
+    packed_roi_to_mask,
+    shm_frames_are_valid,
+    str_to_image,
+)
+
+
+def test_frames_roundtrip() -> None:
+    rgb = np.random.randint(0, 255, (48, 64, 3), dtype=np.uint8)
+    depth = np.random.rand(48, 64).astype(np.float32)
+    payload = {"image": rgb, "depth": depth, "caption": "chair . sofa .", "bbox": [1, 2, 3, 4]}
+
+    for codec in ["raw", "png"]:
+        decoded = decode_frames(encode_frames(payload, codec=codec))
+        assert decoded["caption"] == payload["caption"]
+        assert decoded["bbox"] == payload["bbox"]
+        assert np.array_equal(str_to_image(decoded["image"]), rgb), f"Lossless codec {codec} changed the image"
+        assert np.array_equal(decoded["depth"], depth), "Float arrays must always be sent raw"
+
+    decoded = decode_frames(encode_frames(payload, codec="jpeg"))
+    assert decoded["image"].shape == rgb.shape
+
+
+def test_image_ids() -> None:
+    rgb = np.random.randint(0, 255, (48, 64, 3), dtype=np.uint8)
+    image_id = image_hash(rgb)
+    assert image_hash(rgb.copy()) == image_id
+    assert image_hash(rgb[..., 0]) != image_id
+
+    store = _ImageStore(capacity=1)
+    with pytest.raises(UnknownImageError):
+        decode_frames(encode_frames({"image": image_id}), image_store=store)
+
+    # Sending the pixels once with their id makes the server cache them
+    decode_frames(encode_frames({"image": rgb}, image_ids={"image": image_id}), image_store=store)
+    decoded = decode_frames(encode_frames({"image": image_id}), image_store=store)
+    assert np.array_equal(decoded["image"], rgb)
+
+
+def test_packed_roi_masks() -> None:
+    mask = np.zeros((48, 64), dtype=bool)
+    mask[10:20, 30:37] = np.random.rand(10, 7) > 0.3
+    mask[12, 30] = mask[19, 36] = True
+    packed = mask_to_packed_roi(mask)
+    assert packed["offset"] == [10, 30] and packed["shape"] == [10, 7]
+    assert np.array_equal(packed_roi_to_mask(packed, mask.shape), mask.astype(np.uint8))
+
+    empty = np.zeros((48, 64), dtype=bool)
+    assert not packed_roi_to_mask(mask_to_packed_roi(empty), empty.shape).any()
+
+
+def test_shared_memory_frames_are_rejected_once_overwritten(monkeypatch: pytest.MonkeyPatch) -> None:
+    ring = SharedMemoryRing(4096)
+    # Client and server share this process, so the server reads the client's own ring
+    monkeypatch.setattr(server_wrapper, "_SHM_RING", ring)
+    try:
+        frame = np.full((32, 32), 7, dtype=np.uint8)
+        body = encode_frames({"image": frame}, shm_ring=ring)
+        shm_frames: list = []
+        decoded = decode_frames(body, shm_frames=shm_frames)
+        assert np.array_equal(decoded["image"], frame) and len(shm_frames) == 1
+        del decoded
+
+        # Three more frames fill the ring, the fourth one wraps around over the first
+        for _ in range(3):
+            encode_frames({"image": np.zeros_like(frame)}, shm_ring=ring)
+        assert shm_frames_are_valid(shm_frames)
+        decode_frames(body)
+        encode_frames({"image": np.zeros_like(frame)}, shm_ring=ring)
+        assert not shm_frames_are_valid(shm_frames)
+        with pytest.raises(StaleFrameError):
+            decode_frames(body)
+    finally:
+        ring.close()
+
+
+def test_requests_past_their_deadline_are_dropped() -> None:
+    class SlowModel(server_wrapper.ServerMixin):
+        def __init__(self) -> None:
+            self.calls = 0
+
+        def process_payload(self, payload: dict) -> dict:
+            self.calls += 1
+            time.sleep(0.3)
+            return {"response": payload["i"]}
+
+        def stats(self) -> dict:
+            return {"calls": self.calls}
+
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        port = s.getsockname()[1]
+    model = SlowModel()
+    threading.Thread(
+        target=server_wrapper.host_model, args=(model, "slow", port), kwargs={"max_queue_depth": 16}, daemon=True
+    ).start()
+    url = f"http://localhost:{port}/slow"
+    server_wrapper.wait_until_ready(url, timeout=10)
+
+    # Eight clients that wait 0.5s each: the model only has time to serve the first ones
+    def post(i: int) -> int:
+        headers = {server_wrapper.DEADLINE_HEADER: repr(time.time() + 0.5)}
+        return requests.post(url, json={"i": i}, headers=headers, timeout=5).status_code
+
+    with ThreadPoolExecutor(8) as pool:
+        statuses = list(pool.map(post, range(8)))
+    time.sleep(0.5)
+    assert 200 in statuses and 504 in statuses
+    assert model.calls < len(statuses), "Expired requests must not reach the model"
+    assert server_wrapper.get_stats(url) == {"calls": model.calls}
+
+
+def test_request_queue_never_exceeds_its_depth() -> None:
+    release = threading.Event()
+
+    class BlockedModel(server_wrapper.ServerMixin):
+        def process_payload(self, payload: dict) -> dict:
+            release.wait()
+            return {"response": payload["i"]}
+
+    scheduler = server_wrapper._RequestScheduler(BlockedModel(), 0.0, 1, max_queue_depth=2)
+    barrier = threading.Barrier(16)
+    rejected = []
+
+    def submit(i: int) -> None:
+        barrier.wait()
+        try:
+            scheduler.submit({"i": i})
+        except server_wrapper.QueueFullError:
+            rejected.append(i)
+
+    # Widen the window between the depth check and the put, where requests used to slip through
+    qsize = scheduler._queue.qsize
+
+    def slow_qsize() -> int:
+        depth = qsize()
+        time.sleep(0.01)
+        return depth
+
+    scheduler._queue.qsize = slow_qsize  # type: ignore[method-assign]
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.5)
+    release.set()
+    for thread in threads:
+        thread.join()
+    # At most one request is being processed and two are waiting
+    assert len(rejected) >= 16 - 3
@@ -0,0 +1,38 @@
+# Copyright (c) 2023 Boston Dynamics AI Institute LLC. All rights reserved.
+
+import os
+
+from vlfm.utils.sqlite_cache import SQLiteCache
+
+
+def test_sqlite_cache_persistence(tmp_path: str) -> None:
+    path = os.path.join(str(tmp_path), "cache", "responses.sqlite")
+    cache = SQLiteCache(path)
+    key = SQLiteCache.make_key("llava", "image-id", "Is there a chair?")
+    assert key != SQLiteCache.make_key("llava", "image-id", "Is there a sofa?")
+
+    assert cache.get(key) is None
+    cache.put(key, {"lmm_output": "Yes", "likelihood": [["Yes", 0.9], ["No", 0.05], ["?", 0.05]]})
+    assert cache.get(key)["lmm_output"] == "Yes"
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+    cache.close()
+
+    # a new process finds the same entries on disk
+    reopened = SQLiteCache(path)
+    assert reopened.get(key)["likelihood"][0] == ["Yes", 0.9]
+    reopened.close()
+
+
+def test_sqlite_cache_eviction(tmp_path: str) -> None:
+    # each value is ~1 KB, the store holds at most ~4 of them
+    cache = SQLiteCache(os.path.join(str(tmp_path), "responses.sqlite"), max_size_mb=4.5 / 1024)
+    for i in range(4):
+        cache.put(str(i), "x" * 1024)
+    cache.get("0")  # "1" becomes the least recently used entry
+    cache.put("4", "x" * 1024)
+
+    assert cache.get("1") is None
+    for key in ["0", "2", "3", "4"]:
+        assert cache.get(key) is not None
+    assert cache.stats()["entries"] == 4
+    cache.close()
@@ -0,0 +1,73 @@
+# Copyright (c) 2023 Boston Dynamics AI Institute LLC. All rights reserved.
+
+from typing import List
+
+import pytest
+
+from vlfm.brain.structured_output import (
+    INT,
+    STR,
+    STR_DICT,
+    STR_LIST,
+    StructuredOutputError,
+    ask_structured,
+    coerce_to_schema,
+    parse_structured,
+)
+
+
+def test_local_repair() -> None:
+    response = """Sure, here is the answer.
+```yaml
+YAML_START # must be present to get the information back
+attributes_of_the_image:
+    color: "red"
+image_description_refined: A red chair: it has a wooden frame # no newline here
+YAML_END
+```
+Reasoning: ..."""
+    answer = coerce_to_schema(
+        parse_structured(response), {"image_description_refined": STR, "attributes_of_the_image": STR_DICT}
+    )
+    assert answer["image_description_refined"] == "A red chair: it has a wooden frame"
+    assert answer["attributes_of_the_image"] == {"color": "red"}
+
+
+def test_key_and_value_coercion() -> None:
+    parsed = parse_structured('YAML_START\nSimilarity Score: "7/10"\nquestion:\n    1: "Is it blue?"\n')
+    answer = coerce_to_schema(parsed, {"similarity_score": INT, "questions": STR_LIST})
+    assert answer == {"similarity_score": 7, "questions": ["Is it blue?"]}
+
+    # answers of providers asked for a JSON schema
+    answer = coerce_to_schema(parse_structured('{"facts": "The chair is red."}'), {"facts": STR})
+    assert answer == {"facts": "The chair is red."}
+
+    # no questions is a valid answer
+    for empty in ["{}", "[]", ""]:
+        parsed = parse_structured(f"YAML_START\nquestions: {empty}\nYAML_END")
+        answer = coerce_to_schema(parsed, {"questions": STR_LIST})
+        assert answer == {"questions": []}
+    with pytest.raises(StructuredOutputError):
+        coerce_to_schema(parse_structured("YAML_START\nquestions: 3\nYAML_END"), {"questions": STR_LIST})
+
+
+class _ScriptedLLM:
+    def __init__(self, responses: List[str]) -> None:
+        self.responses = responses
+        self.prompts: List[str] = []
+
+    def ask(self, prompt: str, **kwargs: dict) -> str:
+        self.prompts.append(prompt)
+        return self.responses[len(self.prompts) - 1]
+
+
+def test_reask_with_correction() -> None:
+    llm = _ScriptedLLM(["I think the score is high.", "YAML_START\nsimilarity_score: 8\nquestions:\n  - Is it red?\n"])
+    answer = ask_structured(llm, "PROMPT", {"similarity_score": INT, "questions": STR_LIST}, name="similarity_score")
+    assert answer == {"similarity_score": 8, "questions": ["Is it red?"]}
+    assert len(llm.prompts) == 2
+    assert llm.prompts[1].startswith("PROMPT") and "I think the score is high." in llm.prompts[1]
+
+    llm = _ScriptedLLM(["no yaml"] * 3)
+    with pytest.raises(StructuredOutputError):
+        ask_structured(llm, "PROMPT", {"facts": STR}, name="facts_updater")
@@ -0,0 +1,73 @@
+# Copyright (c) 2023 Boston Dynamics AI Institute LLC. All rights reserved.
+
+import os
+from typing import Any
+
+import numpy as np
+import pytest
+
+import vlfm.mapping.value_map as value_map
+from vlfm.mapping.value_map import ValueMap
+from vlfm.utils.geometry_utils import get_rotation_matrix
+from vlfm.utils.img_utils import img_in_img_slices, rotate_image
+
+
+def test_cached_waypoint_values_are_invalidated_by_updates(tmp_path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(value_map, "CONFIDENCE_MASK_DIR", str(tmp_path))
+    v = ValueMap(value_channels=1, pixels_per_meter=30)
+    depth = np.ones((48, 64), dtype=np.float32)
+    in_view = np.array([[2.0, 0.0]])
+    behind = np.array([[-3.0, 0.0]])
+    waypoints = np.concatenate([in_view, behind])
+
+    v.update_map(np.array([0.5]), depth, np.eye(4), min_depth=0.5, max_depth=5.0, fov=np.deg2rad(79))
+    _, values = v.sort_waypoints(waypoints, 0.5)
+    assert values == [0.5, -1]
+
+    # Turning around only changes the values of the waypoints behind the camera
+    tf = np.eye(4)
+    tf[:2, :2] = get_rotation_matrix(np.pi)
+    v.update_map(np.array([0.8]), depth, tf, min_depth=0.5, max_depth=5.0, fov=np.deg2rad(79))
+    assert v._intersects_dirty_boxes(np.array([[500 + 60, 500]]), 15).tolist() == [False]  # in_view, in pixels
+    sorted_waypoints, values = v.sort_waypoints(waypoints, 0.5)
+    assert np.array_equal(sorted_waypoints, np.concatenate([behind, in_view]))
+    assert np.allclose(values, [0.8, 0.5])
+
+
+def test_dirty_boxes_are_bounded() -> None:
+    v = ValueMap(value_channels=1, pixels_per_meter=30)
+    for i in range(100):
+        v._add_dirty_box((i, 2 * i, i + 10, 2 * i + 10))
+    assert len(v._dirty_boxes) <= v._max_dirty_boxes
+    # Merging must not forget any changed region
+    assert v._intersects_dirty_boxes(np.array([[0, 0], [109, 208], [500, 500]]), 1).tolist() == [True, True, False]
+
+
+def test_failed_confidence_mask_save_leaves_no_file(tmp_path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(value_map, "CONFIDENCE_MASK_DIR", str(tmp_path))
+
+    def failing_save(*args: Any, **kwargs: Any) -> None:
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(np, "save", failing_save)
+    v = ValueMap(value_channels=1, pixels_per_meter=30)
+    with pytest.warns(UserWarning):
+        v._save_confidence_mask((1.0, 5.0, 30, 0.25), np.ones((3, 3)))
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("yaw", [0.0, np.pi / 2, np.deg2rad(45), np.deg2rad(10)])
+def test_localized_data_matches_rotated_local_data(yaw: float) -> None:
+    v = ValueMap(value_channels=1, pixels_per_meter=30)
+    depth = np.tile(np.linspace(0.2, 0.8, 64, dtype=np.float32), (48, 1))
+    tf = np.eye(4)
+    tf[:2, :2] = get_rotation_matrix(yaw)
+    curr_data, window = v._localize_new_data(depth, tf, min_depth=0.5, max_depth=5.0, fov=np.deg2rad(79))
+
+    expected = rotate_image(v._process_local_data(depth, np.deg2rad(79), 0.5, 5.0), -yaw)
+    full = np.zeros(v._map.shape, dtype=np.float32)
+    full[window] = curr_data
+    expected_full = np.zeros(v._map.shape, dtype=np.float32)
+    expected_window, data_window = img_in_img_slices(v._map.shape, expected.shape, *v._episode_pixel_origin)
+    expected_full[expected_window] = expected[data_window]
+    assert np.allclose(full, expected_full, atol=1e-6)
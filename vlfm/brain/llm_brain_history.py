@@ -1,15 +1,14 @@
 from colorama import Fore
 from colorama import init as init_colorama
-from retrying import retry
 
 init_colorama(autoreset=True)
-import yaml
 import vlfm.utils.prompts as prompts
 import re
 from typing import List, Dict, Any
 import torch
 from copy import deepcopy
-import logging
+
+from vlfm.brain.structured_output import INT, STR, STR_DICT, STR_LIST, ask_structured
 
 
 class LLM_History:
@@ -69,93 +68,49 @@ class LLM_History:
             )
 
 
-    @retry(stop_max_attempt_number=10, wait_fixed=10000)
     def generate_self_questioner_question_given_distractor_description(
         self, distractor_description, target_object
     ) -> List[str]:
         """
         self question module new pipeline. Generate up to x quesiton, with uncertainty estimation.
         """
-        prompt = prompts.LLM_SELF_QUESTIONER_GIVEN_DISTRACTOR_DESCRIPTION.format(
-            distractor_object_description=distractor_description,
+        prompt = prompts.build_llm_prompt(
             target_object=target_object,
-            facts_about_the_target_picture=self.target_object_informations or "No information available",
-            uncertain_answer_choice_placeholder=prompts.UNCERTAIN_ANSWER_CHOICE_PLACEHOLDER,
+            description=distractor_description,
+            target_picture_facts=self.target_object_informations or "No information available",
         )
 
-        response = self.LLM_CLIENT.ask(prompt=prompt)
-        print(
-            Fore.YELLOW + "[INFO: LLM] Generate self-questions to be answer with uncertainty estimation \n" + response
+        print(Fore.YELLOW + "[INFO: LLM] Generate self-questions to be answer with uncertainty estimation")
+        answer = ask_structured(
+            self.LLM_CLIENT,
+            prompt,
+            schema={"questions_for_detected_object": STR_LIST},
+            name="self_questioner",
+            system=prompts.LLM_SELF_QUESTIONER_GIVEN_DISTRACTOR_DESCRIPTION,
         )
-        print("---" * 5)
-        try:
-            yaml_start = response.find("YAML_START")
-            yaml_end = response.find("YAML_END")
-            if yaml_start != -1 and yaml_end != -1:
-                yaml_string = response[yaml_start + len("YAML_START") : yaml_end].strip()
-                parsed_yaml = yaml.safe_load(yaml_string)
-
-                # Extract questions for target objects
-                questions_for_detected_object = [
-                    self_question.strip() for self_question in parsed_yaml["questions_for_detected_object"].values()
-                ]
-            else:
-                print("YAML section not found in the string.")
-                raise Exception("YAML section not found in the string.")
-            return questions_for_detected_object
-
-        except Exception as e:
-            logging.exception(response)
-            logging.info("This was the prompt")
-            logging.exception(prompt)
-            print(e)
-            raise e
+        # Extract questions for target objects
+        return answer["questions_for_detected_object"]
 
-    @retry(stop_max_attempt_number=10, wait_fixed=10000)
     def retrieving_more_facts_about_detected_object(self, distractor_description, target_object) -> List[str]:
         """
         retrieving_more_facts_about_detected_object
         """
-        prompt = prompts.LMM_RETRIEVE_FACTS_FROM_DESCRIPTION
-        prompt = prompt.format(
+        prompt = prompts.build_llm_prompt(
             target_object=target_object,
-            distractor_object_description=distractor_description,
-            facts_about_the_target_picture=self.target_object_informations or "No information available",
+            description=distractor_description,
+            target_picture_facts=self.target_object_informations or "No information available",
         )
 
-        response = self.LLM_CLIENT.ask(prompt=prompt)
-        print(
-            Fore.YELLOW
-            + "[INFO: LLM] Retrieving more facts about the detected object (open ended questions). \n"
-            + response
+        print(Fore.YELLOW + "[INFO: LLM] Retrieving more facts about the detected object (open ended questions).")
+        answer = ask_structured(
+            self.LLM_CLIENT,
+            prompt,
+            schema={"questions": STR_LIST},
+            name="retrieve_facts",
+            system=prompts.LMM_RETRIEVE_FACTS_FROM_DESCRIPTION,
         )
-        print("---" * 5)
-        try:
-            yaml_start = response.find("YAML_START")
-            yaml_end = response.find("YAML_END")
-
-            if yaml_start != -1 and yaml_end != -1:
-                yaml_string = response[yaml_start + len("YAML_START") : yaml_end].strip()
-                parsed_yaml = yaml.safe_load(yaml_string)
-
-                questions_for_detected_object = [
-                    question_for_detected_object.strip()
-                    for question_for_detected_object in parsed_yaml["questions"].values()
-                ]
-
-                return questions_for_detected_object
-            else:
-                print("YAML section not found in the string.")
-                raise Exception("YAML section not found in the string.")
-        except Exception as e:
-            print(e)
-            logging.exception(response)
-            logging.info("This was the prompt")
-            logging.exception(prompt)
-            raise e
+        return answer["questions"]
 
-    # max retry 10 times, wait 10 seconds between each retry
-    @retry(stop_max_attempt_number=10, wait_fixed=10000)
     def filter_self_questioner_answer_by_uncertainty(
         self, self_questioner_question_answers_lilekihood_pairs: List[dict], tau=0.5, offset=None
     ):
@@ -182,8 +137,6 @@ class LLM_History:
             results[i]["normalized_entropy_value"] = entropy_normalized.cpu().item()
         return results
 
-    # max retry 10 times, wait 10 seconds between each retry
-    @retry(stop_max_attempt_number=10, wait_fixed=10000)
     def refine_image_description_after_self_questioner(
         self,
         self_questioner_question_answers_uncertainty: List[dict],
@@ -198,66 +151,41 @@ class LLM_History:
             question, answer, certainty_label = item["question"], item["answer"], item["certainty_label"]
             questions_answer_string += f"- Question: {question} - Answer: {answer} - Certainty: {certainty_label}\n"
 
-        prompt = prompts.LLM_REFINE_DETECTED_OBJECT_DESCRIPTION.format(
+        prompt = prompts.build_llm_prompt(
             target_object=target_object,
-            distractor_object_description=distractor_object_description,
-            list_questions_answers_uncertainty_labels=questions_answer_string,
+            description=distractor_object_description,
+            question_and_responses=questions_answer_string,
         )
-        response = self.LLM_CLIENT.ask(prompt=prompt)
         print(
             Fore.BLUE
-            + f"[INFO: LLM] Refine image description using the on-board VLM, the question/answer pairs and the uncertainty associated to them: \n{response}"
+            + "[INFO: LLM] Refine image description using the on-board VLM, the question/answer pairs and the uncertainty associated to them:"
         )
-        print("---" * 5)
-        try:
-            yaml_data = response.split("YAML_START")[1].split("YAML_END")[0].strip()
-            parsed_yaml = yaml.safe_load(yaml_data)
-            update_detected_obj_description = parsed_yaml["image_description_refined"]
-
-            attributes = parsed_yaml["attributes_of_the_image"]
-
-            # Print each attribute:value pair
-            image_attributes = {}
-            for attribute, value in attributes.items():
-                image_attributes[attribute] = value
-
-            return update_detected_obj_description, image_attributes
-        except Exception as e:
-            print(e)
-            logging.exception(response)
-            logging.info("This was the prompt")
-            logging.exception(prompt)
-            raise e
+        answer = ask_structured(
+            self.LLM_CLIENT,
+            prompt,
+            schema={"image_description_refined": STR, "attributes_of_the_image": STR_DICT},
+            name="refine_description",
+            system=prompts.LLM_REFINE_DETECTED_OBJECT_DESCRIPTION,
+        )
+        return answer["image_description_refined"], answer["attributes_of_the_image"]
 
-    # max retry 10 times, wait 10 seconds between each retry
-    @retry(stop_max_attempt_number=10, wait_fixed=10000)
     def get_similarity_score_and_question_for_target_object(self, target_object: str, detected_object_description: str):
         """ """
-        prompt = prompts.LLM_SIMILARITY_SCORE_AND_QUESTION_TO_TARGET.format(
+        prompt = prompts.build_llm_prompt(
             target_object=target_object,
-            distractor_object_description=detected_object_description,
-            facts_about_the_target_picture=self.target_object_informations or "No information available",
+            description=detected_object_description,
+            target_picture_facts=self.target_object_informations or "No information available",
         )
-        response = self.LLM_CLIENT.ask(prompt=prompt)
-        print(Fore.BLUE + f"[INFO: LLM] Get similarity score and question for the user (if necessary) \n {response}")
-        print("---" * 5)
-        try:
-            yaml_data = response.split("YAML_START")[1].split("YAML_END")[0].strip()
-            parsed_yaml = yaml.safe_load(yaml_data)
-
-            similarity_score = parsed_yaml["similarity_score"]
-            questions_for_human = [q.strip() for q in parsed_yaml["questions"].values()]
-
-            return similarity_score, questions_for_human
-        except Exception as e:
-            print(e)
-            logging.exception(response)
-            logging.info("This was the prompt")
-            logging.exception(prompt)
-            raise e
+        print(Fore.BLUE + "[INFO: LLM] Get similarity score and question for the user (if necessary)")
+        answer = ask_structured(
+            self.LLM_CLIENT,
+            prompt,
+            schema={"similarity_score": INT, "questions": STR_LIST},
+            name="similarity_score",
+            system=prompts.LLM_SIMILARITY_SCORE_AND_QUESTION_TO_TARGET,
+        )
+        return answer["similarity_score"], answer["questions"]
 
-    # max retry 10 times, wait 10 seconds between each retry
-    @retry(stop_max_attempt_number=10, wait_fixed=10000)
     def updates_known_facts_about_target_object_given_oracle_answers(
         self, target_object: str, oracle_questions_answers: List[dict]
     ):
@@ -266,27 +194,23 @@ class LLM_History:
             question, answer = item["question"], item["answer"]
             questions_answer_string += f"- Question: {question} - Answer: {answer}\n"
 
-        prompt = prompts.LLM_FACTS_UPDATER_AFTER_IS_THIS_TARGET_OBJECT_ORACLE_QUESTION_V1.format(
+        prompt = prompts.build_llm_prompt(
             target_object=target_object,
-            oracle_questions_answer=questions_answer_string,
-            facts_about_the_target_picture=self.target_object_informations,
+            target_picture_facts=self.target_object_informations,
+            oracle_answer=questions_answer_string,
         )
 
-        response = self.LLM_CLIENT.ask(prompt=prompt)
-        print(Fore.BLUE + f"[INFO: LLM] Updating know facts using answers from the user. \n {response}")
-        try:
-            yaml_data = response.split("YAML_START")[1].split("YAML_END")[0].strip()
-            parsed_yaml = yaml.safe_load(yaml_data)
-
-            new_facts = parsed_yaml["facts"]
-            self.target_object_informations = new_facts
-            return new_facts
-        except Exception as e:
-            print(e)
-            logging.exception(response)
-            logging.info("This was the prompt")
-            logging.exception(prompt)
-            raise e
+        print(Fore.BLUE + "[INFO: LLM] Updating know facts using answers from the user.")
+        answer = ask_structured(
+            self.LLM_CLIENT,
+            prompt,
+            schema={"facts": STR},
+            name="facts_updater",
+            system=prompts.LLM_FACTS_UPDATER_AFTER_IS_THIS_TARGET_OBJECT_ORACLE_QUESTION_V1,
+        )
+        new_facts = answer["facts"]
+        self.target_object_informations = new_facts
+        return new_facts
 
     def reset(self):
         self.ep_id = None
@@ -0,0 +1,240 @@
+import json
+import logging
+import os
+import re
+from typing import Any, Dict, Optional
+
+import yaml
+from colorama import Fore
+from colorama import init as init_colorama
+from openai import APIConnectionError, InternalServerError, RateLimitError
+from retrying import retry
+
+import vlfm.utils.prompts as prompts
+from vlfm.vlm.openai_llm import RateLimitExhaustedError
+
+init_colorama(autoreset=True)
+
+# Types of the values of a structured answer, see coerce_to_schema
+INT = "int"
+STR = "str"
+STR_LIST = "str_list"  # a YAML list, or a mapping of numbered items (e.g. questions), possibly empty
+STR_DICT = "str_dict"  # a mapping of attributes
+
+_JSON_SCHEMA_TYPES = {
+    INT: {"type": "integer"},
+    STR: {"type": "string"},
+    STR_LIST: {"type": "array", "items": {"type": "string"}},
+    STR_DICT: {"type": "object", "additionalProperties": {"type": "string"}},
+}
+
+# "key: value" line whose value is not quoted, the value may contain colons
+_KEY_VALUE_LINE = re.compile(r"^(\s*(?:-\s+)?[^\s:#\"'-][^:#]*?):\s+(.+?)\s*$")
+
+
+class StructuredOutputError(ValueError):
+    """Raised when an answer of the LLM cannot be turned into the expected structure."""
+
+
+def _is_transient_api_error(error: Exception) -> bool:
+    """Connection errors and timeouts, server errors and rate limits (including the client giving up
+    on its rate-limited keys), which are worth retrying after a while."""
+    return isinstance(error, (APIConnectionError, InternalServerError, RateLimitError, RateLimitExhaustedError))
+
+
+# transient API errors are retried for as long as the calls of the LLM brain always were (10 attempts,
+# up to 10 s apart), independently of the attempts at correcting invalid answers
+@retry(
+    retry_on_exception=_is_transient_api_error,
+    stop_max_attempt_number=10,
+    wait_exponential_multiplier=1000,
+    wait_exponential_max=10000,
+)
+def _ask_with_retries(llm_client: Any, **kwargs: Any) -> str:
+    try:
+        return llm_client.ask(**kwargs)
+    except Exception as e:
+        if _is_transient_api_error(e):
+            print(Fore.RED + f"[ERROR] LLM call failed ({e}), retrying")
+        raise
+
+
+def extract_block(response: str) -> str:
+    """Returns the text between YAML_START and YAML_END, without code fences. If the tags are
+    missing, the whole response is used (e.g. JSON answers in structured-output mode)."""
+    start = response.find("YAML_START")
+    block = response[start + len("YAML_START") :] if start != -1 else response
+    end = block.find("YAML_END")
+    if end != -1:
+        block = block[:end]
+    lines = [line for line in block.splitlines() if not line.strip().startswith("```")]
+    return "\n".join(lines).strip()
+
+
+def _quote_values(text: str) -> str:
+    """Quotes the unquoted values of "key: value" lines, the most common reason for invalid
+    YAML being a colon inside a free-text value."""
+    lines = []
+    for line in text.splitlines():
+        match = _KEY_VALUE_LINE.match(line)
+        if match is not None and not match.group(2).startswith(('"', "'", "[", "{", "|", ">", "#")):
+            value = re.sub(r"\s+#\s.*$", "", match.group(2))
+            value = value.replace("\\", "\\\\").replace('"', '\\"')
+            line = f'{match.group(1)}: "{value}"'
+        lines.append(line.replace("\t", "    "))
+    return "\n".join(lines)
+
+
+def parse_structured(response: str) -> Dict[str, Any]:
+    """Parses the YAML (or JSON) block of the response, repairing it locally if needed.
+
+    Raises:
+        StructuredOutputError: If no repair gives a mapping.
+    """
+    block = extract_block(response)
+    if len(block) == 0:
+        raise StructuredOutputError("the YAML block between YAML_START and YAML_END is missing or empty")
+
+    parsers = [yaml.safe_load, lambda text: yaml.safe_load(_quote_values(text))]
+    if block.startswith("{"):
+        parsers.insert(0, json.loads)
+    error = "the YAML block is not a mapping of keys to values"
+    for parse in parsers:
+        try:
+            parsed = parse(block)
+        except (yaml.YAMLError, ValueError) as e:
+            error = f"the YAML block is not valid ({str(e).splitlines()[0]})"
+            continue
+        if isinstance(parsed, dict):
+            return parsed
+    raise StructuredOutputError(error)
+
+
+def _normalize_key(key: Any) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", str(key).lower()).strip("_")
+
+
+def _coerce_value(value: Any, kind: str, key: str) -> Any:
+    if kind == INT:
+        if isinstance(value, bool):
+            raise StructuredOutputError(f"'{key}' must be an integer")
+        if isinstance(value, (int, float)):
+            return int(round(value))
+        match = re.search(r"-?\d+", str(value))  # e.g. "7/10"
+        if match is None:
+            raise StructuredOutputError(f"'{key}' must be an integer, got '{value}'")
+        return int(match.group(0))
+    if kind == STR:
+        if value is None or isinstance(value, (dict, list)):
+            raise StructuredOutputError(f"'{key}' must be a single line of text")
+        return str(value).strip()
+    if kind == STR_LIST:
+        if isinstance(value, dict):
+            value = list(value.values())
+        elif isinstance(value, str):
+            value = [value] if len(value.strip()) > 0 else []
+        elif value is None:  # "questions:" with nothing after it
+            value = []
+        if not isinstance(value, list):
+            raise StructuredOutputError(f"'{key}' must be a list of items")
+        items = []
+        for item in value:
+            if isinstance(item, dict) and len(item) == 1:  # "- 1: <question>"
+                item = next(iter(item.values()))
+            items.append(str(item).strip())
+        return items
+    if kind == STR_DICT:
+        if isinstance(value, list) and all(isinstance(item, dict) for item in value):
+            value = {k: v for item in value for k, v in item.items()}
+        if not isinstance(value, dict):
+            raise StructuredOutputError(f"'{key}' must be a mapping of attributes to values")
+        return {str(k): v for k, v in value.items()}
+    raise ValueError(f"Unknown value type {kind}")
+
+
+def coerce_to_schema(parsed: Dict[str, Any], schema: Dict[str, str]) -> Dict[str, Any]:
+    """Returns the values of the schema keys, converted to their type. Keys are matched
+    regardless of case, spaces and plural (e.g. "Similarity Score" or "question").
+
+    Raises:
+        StructuredOutputError: If a key is missing or its value cannot be converted.
+    """
+    normalized = {_normalize_key(key): value for key, value in parsed.items()}
+    result = {}
+    for key, kind in schema.items():
+        candidates = [key, key[:-1] if key.endswith("s") else key + "s"]
+        matches = [candidate for candidate in candidates if candidate in normalized]
+        if len(matches) == 0:
+            raise StructuredOutputError(f"the key '{key}' is missing")
+        result[key] = _coerce_value(normalized[matches[0]], kind, key)
+    return result
+
+
+def json_schema_response_format(name: str, schema: Dict[str, str]) -> dict:
+    """Returns the response_format asking the provider for a JSON object with the schema keys."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "schema": {
+                "type": "object",
+                "properties": {key: _JSON_SCHEMA_TYPES[kind] for key, kind in schema.items()},
+                "required": list(schema.keys()),
+            },
+        },
+    }
+
+
+def ask_structured(
+    llm_client: Any,
+    prompt: str,
+    schema: Dict[str, str],
+    name: str,
+    system: Optional[str] = None,
+    max_tokens: Optional[int] = None,
+    max_attempts: int = 3,
+) -> Dict[str, Any]:
+    """Asks the prompt and returns its answer as a dict with the keys of the schema.
+
+    The answer is repaired locally when possible (code fences, unquoted values, key names
+    and value types). Only if that fails the LLM is asked again, with the reason of the
+    failure and its previous answer appended to the prompt. When COIN_LLM_JSON_SCHEMA=1,
+    the provider is asked for JSON following the schema instead of the YAML block.
+
+    Args:
+        llm_client: The OpenAILLMClient (or a wrapper with the same ask).
+        prompt (str): The prompt, asking for a YAML block between YAML_START and YAML_END. With
+            system, only the variable fields of the prompt (see prompts.build_llm_prompt).
+        schema (Dict[str, str]): The expected keys and the type of their values (INT, STR, ...).
+        name (str): Name of the prompt type, used for the token cap and the JSON schema.
+        system (str, optional): The static instructions of the prompt, sent as the system message.
+            The corrections keep it, so they reuse the cached prefix too.
+        max_tokens (int, optional): Cap of the generated tokens, LLM_MAX_TOKENS[name] by default.
+        max_attempts (int): How many answers the LLM is asked for at most, i.e. the first answer and
+            its corrections. Failed API calls do not count, they are retried separately.
+
+    Raises:
+        StructuredOutputError: If no attempt gives a valid answer.
+        Exception: The error of the API call, if it still fails after its retries.
+    """
+    if max_tokens is None:
+        max_tokens = prompts.LLM_MAX_TOKENS.get(name)
+    if os.environ.get("COIN_LLM_JSON_SCHEMA", "0") == "1":
+        generation = {"response_format": json_schema_response_format(name, schema)}
+    else:
+        generation = {"stop": prompts.LLM_YAML_STOP_SEQUENCES}
+
+    current_prompt = prompt
+    for _ in range(max_attempts):
+        response = _ask_with_retries(
+            llm_client, prompt=current_prompt, max_tokens=max_tokens, system=system, **generation
+        )
+        try:
+            return coerce_to_schema(parse_structured(response), schema)
+        except StructuredOutputError as e:
+            logging.warning(f"Invalid answer to the {name} prompt: {e}\n{response}")
+            print(Fore.RED + f"[ERROR] Invalid LLM answer: {e}. Asking for a correction.")
+            current_prompt = prompts.LLM_STRUCTURED_OUTPUT_CORRECTION.format(
+                prompt=prompt, previous_answer=response, error=e, keys=", ".join(schema.keys())
+            )
+    raise StructuredOutputError(f"no valid answer to the {name} prompt after {max_attempts} attempts")
@@ -5,6 +5,7 @@ from colorama import init as init_colorama
 init_colorama(autoreset=True)
 import numpy as np
 from vlfm.utils.prompts import LLava_REDUCE_FALSE_POSITIVE
+from vlfm.vlm.server_wrapper import PRIORITY_HIGH, PRIORITY_LOW
 
 
 class Conversation:
@@ -33,7 +34,7 @@ class VLM_History:
         self.conversation = Conversation()
 
     def get_description_of_the_image(self, image, prompt):
-        output, _ = self.llava_client.ask(image, prompt=prompt)
+        output, _ = self.llava_client.ask(image, prompt=prompt, priority=PRIORITY_LOW)
         print(Fore.LIGHTMAGENTA_EX + "[INFO: On-board VLM] " + output)
         return output
 
@@ -41,7 +42,12 @@ class VLM_History:
         self, detected_image: np.ndarray, target_object: str, get_logits: bool = False
     ) -> str:
         prompt = LLava_REDUCE_FALSE_POSITIVE.format(target_object=target_object)
-        response = self.llava_client.ask(detected_image, prompt=prompt, return_token_likelihood=get_logits)
+        if get_logits:
+            # a single forward pass gives the Yes/No/? distribution, no need to generate the answer
+            return self.llava_client.score_yes_no(detected_image, [prompt], priority=PRIORITY_HIGH)[0]
+        response = self.llava_client.ask(
+            detected_image, prompt=prompt, return_token_likelihood=get_logits, priority=PRIORITY_HIGH
+        )
         return response
 
     def reset(self):
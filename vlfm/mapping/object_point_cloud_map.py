@@ -401,13 +401,22 @@ class ObjectPointCloudMap:
         fx: float,
         fy: float,
     ) -> np.ndarray:
-        final_mask = object_mask * 255
+        # Only work on the region of interest around the mask. It is padded so that the
+        # erosion gives the same result as on the full frame.
+        x, y, w, h = cv2.boundingRect(object_mask)
+        pad = int(self._erosion_size) + 1
+        top, left = max(0, y - pad), max(0, x - pad)
+        bottom, right = min(depth.shape[0], y + h + pad), min(depth.shape[1], x + w + pad)
+
+        final_mask = object_mask[top:bottom, left:right] * 255
         final_mask = cv2.erode(final_mask, None, iterations=self._erosion_size)  # type: ignore
 
-        valid_depth = depth.copy()
+        valid_depth = depth[top:bottom, left:right].copy()
         valid_depth[valid_depth == 0] = 1  # set all holes (0) to just be far (1)
         valid_depth = valid_depth * (max_depth - min_depth) + min_depth
-        cloud = get_point_cloud(valid_depth, final_mask, fx, fy)
+        cloud = get_point_cloud(
+            valid_depth, final_mask, fx, fy, pixel_offset=(top, left), image_shape=depth.shape[:2]
+        )
         cloud = get_random_subarray(cloud, 5000)
         if self.use_dbscan:
             cloud = open3d_dbscan_filtering(cloud)
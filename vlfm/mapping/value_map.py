@@ -5,9 +5,10 @@ import json
 import os
 import os.path as osp
 import shutil
+import tempfile
 import time
 import warnings
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import cv2
 import numpy as np
@@ -15,9 +16,9 @@ import numpy as np
 from vlfm.mapping.base_map import BaseMap
 from vlfm.utils.geometry_utils import extract_yaw, get_rotation_matrix
 from vlfm.utils.img_utils import (
+    img_in_img_slices,
     monochannel_to_inferno_rgb,
-    pixel_value_within_radius,
-    place_img_in_img,
+    pixel_values_within_radius,
     rotate_image,
 )
 from vlfm.utils.my_colorama import Fore
@@ -29,13 +30,27 @@ PLAYING = os.environ.get("PLAY_VALUE_MAP", "0") == "1"
 RECORDING_DIR = "value_map_recordings"
 JSON_PATH = osp.join(RECORDING_DIR, "data.json")
 KWARGS_JSON = osp.join(RECORDING_DIR, "kwargs.json")
+# Directory where the confidence masks are stored across processes (e.g. data/cache), disabled if empty
+CONFIDENCE_MASK_DIR = os.environ.get("VALUE_MAP_CACHE_DIR", "")
+# Draw the occlusions onto pre-rotated cones rather than rotating each occluded cone. Faster, but the edges of the
+# visible region differ from those of the interpolated rotation, so it is opt-in.
+CACHE_ROTATED_CONES = os.environ.get("VALUE_MAP_CACHE_ROTATED_CONES", "0") == "1"
 
 
 class ValueMap(BaseMap):
     """Generates a map representing how valuable explored regions of the environment
     are with respect to finding and navigating to the target object."""
 
-    _confidence_masks: Dict[Tuple[float, float], np.ndarray] = {}
+    # Keyed by (fov, max_depth, pixels_per_meter, min_confidence)
+    _confidence_masks: Dict[Tuple[float, float, int, float], np.ndarray] = {}
+    # Confidence masks pre-rotated by multiples of _cone_yaw_step, keyed by (fov, max_depth, pixels_per_meter,
+    # yaw index).
+    # Habitat turns in fixed increments, so the yaws in the episodic frame fall on this grid.
+    _rotated_confidence_masks: Dict[Tuple[float, float, int, int], np.ndarray] = {}
+    _cone_yaw_step: float = np.deg2rad(15)
+    _cone_yaw_tolerance: float = 1e-3
+    # Past this many dirty boxes, they are merged into their bounding box
+    _max_dirty_boxes: int = 32
     _camera_positions: List[np.ndarray] = []
     _last_camera_yaw: float = 0.0
     _min_confidence: float = 0.25
@@ -67,6 +82,12 @@ class ValueMap(BaseMap):
         super().__init__(size, pixels_per_meter)
         self._value_map = np.zeros((size, size, value_channels), np.float32)
         self._value_channels = value_channels
+        # Bounding box (top, left, bottom, right) of the pixels written since the last reset
+        self._written_box: Optional[Tuple[int, int, int, int]] = None
+        # Boxes of the regions changed since the last call to sort_waypoints
+        self._dirty_boxes: List[Tuple[int, int, int, int]] = []
+        # Values of the waypoints of the last call to sort_waypoints, keyed by (row, col, radius) in pixels
+        self._waypoint_values: Dict[Tuple[int, int, int], np.ndarray] = {}
         self._use_max_confidence = use_max_confidence
         self._fusion_type = fusion_type
         self._obstacle_map = obstacle_map
@@ -102,6 +123,9 @@ class ValueMap(BaseMap):
     def reset(self) -> None:
         super().reset()
         self._value_map.fill(0)
+        self._written_box = None
+        self._dirty_boxes = []
+        self._waypoint_values = {}
 
     def update_map(
         self,
@@ -128,10 +152,10 @@ class ValueMap(BaseMap):
             len(values) == self._value_channels
         ), f"Incorrect number of values given ({len(values)}). Expected {self._value_channels}."
 
-        curr_map = self._localize_new_data(depth, tf_camera_to_episodic, min_depth, max_depth, fov)
+        curr_data, window = self._localize_new_data(depth, tf_camera_to_episodic, min_depth, max_depth, fov)
 
         # Fuse the new data with the existing data
-        self._fuse_new_data(curr_map, values)
+        self._fuse_new_data(curr_data, values, window)
 
         if RECORDING:
             idx = len(glob.glob(osp.join(RECORDING_DIR, "*.png")))
@@ -158,40 +182,87 @@ class ValueMap(BaseMap):
             waypoints (np.ndarray): An array of 2D waypoints to choose from.
             radius (float): The radius in meters to use for selecting the best waypoint.
             reduce_fn (Callable, optional): The function to use for reducing the values
-                within the given radius. Defaults to np.max.
+                of the channels to a single value per waypoint, given an array of shape
+                (num_waypoints, value_channels). Required with several value channels.
 
         Returns:
             Tuple[np.ndarray, List[float]]: A tuple of the sorted waypoints and
                 their corresponding values.
         """
         radius_px = int(radius * self.pixels_per_meter)
-
-        def get_value(point: np.ndarray) -> Union[float, Tuple[float, ...]]:
-            x, y = point
-            px = int(-x * self.pixels_per_meter) + self._episode_pixel_origin[0]
-            py = int(-y * self.pixels_per_meter) + self._episode_pixel_origin[1]
-            point_px = (self._value_map.shape[0] - px, py)
-            all_values = [
-                pixel_value_within_radius(self._value_map[..., c], point_px, radius_px)
-                for c in range(self._value_channels)
-            ]
-            if len(all_values) == 1:
-                return all_values[0]
-            return tuple(all_values)
-
-        values = [get_value(point) for point in waypoints]
+        values = self._get_waypoint_values(waypoints, radius_px)
 
         if self._value_channels > 1:
             assert reduce_fn is not None, "Must provide a reduction function when using multiple value channels."
             values = reduce_fn(values)
+        else:
+            values = values[:, 0]
 
         # Use np.argsort to get the indices of the sorted values
-        sorted_inds = np.argsort([-v for v in values])  # type: ignore
-        sorted_values = [values[i] for i in sorted_inds]
-        sorted_frontiers = np.array([waypoints[i] for i in sorted_inds])
+        sorted_inds = np.argsort(-values)
+        sorted_values = list(values[sorted_inds])
+        sorted_frontiers = np.asarray(waypoints)[sorted_inds]
 
         return sorted_frontiers, sorted_values
 
+    def _get_waypoint_values(self, waypoints: np.ndarray, radius_px: int) -> np.ndarray:
+        """Returns the median value of each channel within radius_px of each waypoint, as
+        an array of shape (num_waypoints, value_channels), -1 where nothing was seen.
+
+        The values of the previous call are reused, so only the new waypoints (e.g. new
+        frontiers) and those whose radius intersects a region changed since then are
+        scored again.
+        """
+        waypoints = np.asarray(waypoints, dtype=np.float64).reshape(-1, 2)
+        px = (-waypoints[:, 0] * self.pixels_per_meter).astype(int) + self._episode_pixel_origin[0]
+        py = (-waypoints[:, 1] * self.pixels_per_meter).astype(int) + self._episode_pixel_origin[1]
+        points_px = np.stack((self._value_map.shape[0] - px, py), axis=1)
+
+        keys = [(int(row), int(col), radius_px) for row, col in points_px]
+        cached = np.array([key in self._waypoint_values for key in keys], dtype=bool)
+        to_score = np.logical_or(~cached, self._intersects_dirty_boxes(points_px, radius_px))
+
+        values = np.empty((len(keys), self._value_channels), dtype=self._value_map.dtype)
+        if np.any(to_score):
+            values[to_score] = pixel_values_within_radius(self._value_map, points_px[to_score], radius_px)
+        for i in np.flatnonzero(~to_score):
+            values[i] = self._waypoint_values[keys[i]]
+
+        self._waypoint_values = {key: waypoint_values for key, waypoint_values in zip(keys, values)}
+        self._dirty_boxes = []
+        return values
+
+    def _add_dirty_box(self, box: Tuple[int, int, int, int]) -> None:
+        """Marks the box (top, left, bottom, right) as changed. The boxes accumulate
+        between calls to sort_waypoints, so once there are too many of them they are
+        replaced by their bounding box."""
+        self._dirty_boxes.append(box)
+        if len(self._dirty_boxes) > self._max_dirty_boxes:
+            boxes = np.array(self._dirty_boxes)
+            self._dirty_boxes = [
+                (int(boxes[:, 0].min()), int(boxes[:, 1].min()), int(boxes[:, 2].max()), int(boxes[:, 3].max()))
+            ]
+
+    def _intersects_dirty_boxes(self, points_px: np.ndarray, radius_px: int) -> np.ndarray:
+        """Returns whether the radius around each point intersects a region changed since
+        the last call to sort_waypoints."""
+        if len(self._dirty_boxes) == 0:
+            return np.zeros(len(points_px), dtype=bool)
+        dirty_boxes = np.array(self._dirty_boxes)
+        top = np.maximum(points_px[:, :1] - radius_px, 0)
+        left = np.maximum(points_px[:, 1:] - radius_px, 0)
+        bottom = points_px[:, :1] + radius_px + 1
+        right = points_px[:, 1:] + radius_px + 1
+        intersects = np.logical_and.reduce(
+            [
+                top < dirty_boxes[:, 2],
+                dirty_boxes[:, 0] < bottom,
+                left < dirty_boxes[:, 3],
+                dirty_boxes[:, 1] < right,
+            ]
+        )
+        return np.any(intersects, axis=1)
+
     def visualize(
         self,
         markers: Optional[List[Tuple[np.ndarray, Dict[str, Any]]]] = None,
@@ -233,34 +304,9 @@ class ValueMap(BaseMap):
         Returns:
             A mask of the visible portion of the FOV.
         """
-        # Squeeze out the channel dimension if depth is a 3D array
-        if len(depth.shape) == 3:
-            depth = depth.squeeze(2)
-        # Squash depth image into one row with the max depth value for each column
-        depth_row = np.max(depth, axis=0) * (max_depth - min_depth) + min_depth
-
-        # Create a linspace of the same length as the depth row from -fov/2 to fov/2
-        angles = np.linspace(-fov / 2, fov / 2, len(depth_row))
-
-        # Assign each value in the row with an x, y coordinate depending on 'angles'
-        # and the max depth value for that column
-        x = depth_row
-        y = depth_row * np.tan(angles)
-
         # Get blank cone mask
         cone_mask = self._get_confidence_mask(fov, max_depth)
-
-        # Convert the x, y coordinates to pixel coordinates
-        x = (x * self.pixels_per_meter + cone_mask.shape[0] / 2).astype(int)
-        y = (y * self.pixels_per_meter + cone_mask.shape[1] / 2).astype(int)
-
-        # Create a contour from the x, y coordinates, with the top left and right
-        # corners of the image as the first two points
-        last_row = cone_mask.shape[0] - 1
-        last_col = cone_mask.shape[1] - 1
-        start = np.array([[0, last_col]])
-        end = np.array([[last_row, last_col]])
-        contour = np.concatenate((start, np.stack((y, x), axis=1), end), axis=0)
+        contour = self._get_visibility_contour(depth, fov, min_depth, max_depth)
 
         # Draw the contour onto the cone mask, in filled-in black
         visible_mask = cv2.drawContours(cone_mask, [contour], -1, 0, -1)  # type: ignore
@@ -275,6 +321,9 @@ class ValueMap(BaseMap):
                 if not os.path.exists("visualizations"):
                     os.makedirs("visualizations")
                 # Expand the depth_row back into a full image
+                if len(depth.shape) == 3:
+                    depth = depth.squeeze(2)
+                depth_row = np.max(depth, axis=0) * (max_depth - min_depth) + min_depth
                 depth_row_full = np.repeat(depth_row.reshape(1, -1), depth.shape[0], axis=0)
                 # Stack the depth images with the visible mask
                 depth_rgb = cv2.cvtColor((depth * 255).astype(np.uint8), cv2.COLOR_GRAY2RGB)
@@ -291,6 +340,40 @@ class ValueMap(BaseMap):
 
         return visible_mask
 
+    def _get_visibility_contour(self, depth: np.ndarray, fov: float, min_depth: float, max_depth: float) -> np.ndarray:
+        """Returns the contour of the region of the FOV cone hidden behind the depth
+        readings, in the pixel coordinates of the (upright) cone mask."""
+        # Squeeze out the channel dimension if depth is a 3D array
+        if len(depth.shape) == 3:
+            depth = depth.squeeze(2)
+        # Squash depth image into one row with the max depth value for each column
+        depth_row = np.max(depth, axis=0) * (max_depth - min_depth) + min_depth
+
+        # Create a linspace of the same length as the depth row from -fov/2 to fov/2
+        angles = np.linspace(-fov / 2, fov / 2, len(depth_row))
+
+        # Assign each value in the row with an x, y coordinate depending on 'angles'
+        # and the max depth value for that column
+        x = depth_row
+        y = depth_row * np.tan(angles)
+
+        # Size of the cone mask
+        cone_size = 2 * int(max_depth * self.pixels_per_meter) + 1
+
+        # Convert the x, y coordinates to pixel coordinates
+        x = (x * self.pixels_per_meter + cone_size / 2).astype(int)
+        y = (y * self.pixels_per_meter + cone_size / 2).astype(int)
+
+        # Create a contour from the x, y coordinates, with the top left and right
+        # corners of the image as the first two points
+        last_row = cone_size - 1
+        last_col = cone_size - 1
+        start = np.array([[0, last_col]])
+        end = np.array([[last_row, last_col]])
+        contour = np.concatenate((start, np.stack((y, x), axis=1), end), axis=0)
+
+        return contour
+
     def _localize_new_data(
         self,
         depth: np.ndarray,
@@ -298,18 +381,32 @@ class ValueMap(BaseMap):
         min_depth: float,
         max_depth: float,
         fov: float,
-    ) -> np.ndarray:
-        # Get new portion of the map
-        curr_data = self._process_local_data(depth, fov, min_depth, max_depth)
-
-        # Rotate this new data to match the camera's orientation
+    ) -> Tuple[np.ndarray, Tuple[slice, slice]]:
+        """Returns the confidences of the visible portion of the FOV in the map frame, and
+        the window of the map they cover. Only the window is returned (rather than a
+        full-size map), so that the cost of an update scales with the sensor range.
+        """
         yaw = extract_yaw(tf_camera_to_episodic)
         if PLAYING:
             if yaw > 0:
                 yaw = 0
             else:
                 yaw = np.deg2rad(30)
-        curr_data = rotate_image(curr_data, -yaw)
+
+        rotated_cone_mask = self._get_rotated_confidence_mask(fov, max_depth, yaw) if CACHE_ROTATED_CONES else None
+        if rotated_cone_mask is not None:
+            # Rotate the contour rather than the mask, and draw it onto the pre-rotated cone
+            contour = self._get_visibility_contour(depth, fov, min_depth, max_depth).astype(np.float32)
+            center = (rotated_cone_mask.shape[1] // 2, rotated_cone_mask.shape[0] // 2)
+            rotation_matrix = cv2.getRotationMatrix2D(center, np.degrees(-self._snap_yaw(yaw)), 1.0)
+            contour = np.rint(cv2.transform(contour[:, None], rotation_matrix)).astype(np.int32)
+            curr_data = cv2.fillPoly(rotated_cone_mask, [contour], 0)
+        else:
+            # Get new portion of the map
+            curr_data = self._process_local_data(depth, fov, min_depth, max_depth)
+
+            # Rotate this new data to match the camera's orientation
+            curr_data = rotate_image(curr_data, -yaw)
 
         # Determine where this mask should be overlaid
         cam_x, cam_y = tf_camera_to_episodic[:2, 3] / tf_camera_to_episodic[3, 3]
@@ -318,11 +415,35 @@ class ValueMap(BaseMap):
         px = int(cam_x * self.pixels_per_meter) + self._episode_pixel_origin[0]
         py = int(-cam_y * self.pixels_per_meter) + self._episode_pixel_origin[1]
 
-        # Overlay the new data onto the map
-        curr_map = np.zeros_like(self._map)
-        curr_map = place_img_in_img(curr_map, curr_data, px, py)
+        # Determine the window of the map where the new data is overlaid
+        window, data_window = img_in_img_slices(self._map.shape, curr_data.shape, px, py)
+        curr_data = curr_data[data_window]
+
+        # Trim it to the bounding box of the visible pixels, which is all the fusion can change
+        left, top, width, height = cv2.boundingRect((curr_data > 0).astype(np.uint8))
+        curr_data = curr_data[top : top + height, left : left + width]
+        window = (
+            slice(window[0].start + top, window[0].start + top + height),
+            slice(window[1].start + left, window[1].start + left + width),
+        )
+
+        return curr_data.astype(self._map.dtype), window
+
+    def _snap_yaw(self, yaw: float) -> float:
+        return round(yaw / self._cone_yaw_step) * self._cone_yaw_step
 
-        return curr_map
+    def _get_rotated_confidence_mask(self, fov: float, max_depth: float, yaw: float) -> Optional[np.ndarray]:
+        """Returns the confidence mask rotated to match the given camera yaw, or None if the
+        yaw is not on the grid of pre-rotated masks (e.g. arbitrary yaws of reality runs)."""
+        snapped_yaw = self._snap_yaw(yaw)
+        if abs(yaw - snapped_yaw) > self._cone_yaw_tolerance:
+            return None
+        yaw_index = round(snapped_yaw / self._cone_yaw_step) % round(2 * np.pi / self._cone_yaw_step)
+        key = (fov, max_depth, self.pixels_per_meter, yaw_index)
+        if key not in self._rotated_confidence_masks:
+            cone_mask = self._get_confidence_mask(fov, max_depth)
+            self._rotated_confidence_masks[key] = rotate_image(cone_mask, -yaw_index * self._cone_yaw_step)
+        return self._rotated_confidence_masks[key].copy()
 
     def _get_blank_cone_mask(self, fov: float, max_depth: float) -> np.ndarray:
         """Generate a FOV cone without any obstacles considered"""
@@ -342,58 +463,118 @@ class ValueMap(BaseMap):
 
     def _get_confidence_mask(self, fov: float, max_depth: float) -> np.ndarray:
         """Generate a FOV cone with central values weighted more heavily"""
-        if (fov, max_depth) in self._confidence_masks:
-            return self._confidence_masks[(fov, max_depth)].copy()
+        key = (fov, max_depth, self.pixels_per_meter, self._min_confidence)
+        if key not in self._confidence_masks:
+            mask = self._load_confidence_mask(key)
+            if mask is None:
+                mask = self._compute_confidence_mask(fov, max_depth)
+                self._save_confidence_mask(key, mask)
+            self._confidence_masks[key] = mask
+        return self._confidence_masks[key].copy()
+
+    def _compute_confidence_mask(self, fov: float, max_depth: float) -> np.ndarray:
         cone_mask = self._get_blank_cone_mask(fov, max_depth)
-        adjusted_mask = np.zeros_like(cone_mask).astype(np.float32)
-        for row in range(adjusted_mask.shape[0]):
-            for col in range(adjusted_mask.shape[1]):
-                horizontal = abs(row - adjusted_mask.shape[0] // 2)
-                vertical = abs(col - adjusted_mask.shape[1] // 2)
-                angle = np.arctan2(vertical, horizontal)
-                angle = remap(angle, 0, fov / 2, 0, np.pi / 2)
-                confidence = np.cos(angle) ** 2
-                confidence = remap(confidence, 0, 1, self._min_confidence, 1)
-                adjusted_mask[row, col] = confidence
-        adjusted_mask = adjusted_mask * cone_mask
-        self._confidence_masks[(fov, max_depth)] = adjusted_mask.copy()
-
-        return adjusted_mask
-
-    def _fuse_new_data(self, new_map: np.ndarray, values: np.ndarray) -> None:
-        """Fuse the new data with the existing value and confidence maps.
+        center_row, center_col = cone_mask.shape[0] // 2, cone_mask.shape[1] // 2
+        horizontal = np.abs(np.arange(cone_mask.shape[0]) - center_row)[:, None]
+        vertical = np.abs(np.arange(cone_mask.shape[1]) - center_col)[None, :]
+        angle = np.arctan2(vertical, horizontal)
+        angle = remap(angle, 0, fov / 2, 0, np.pi / 2)  # type: ignore
+        confidence = np.cos(angle) ** 2
+        confidence = remap(confidence, 0, 1, self._min_confidence, 1)  # type: ignore
+        return confidence.astype(np.float32) * cone_mask
+
+    @staticmethod
+    def _confidence_mask_path(key: Tuple[float, float, int, float]) -> str:
+        fov, max_depth, pixels_per_meter, min_confidence = key
+        name = "_".join(repr(float(value)) for value in (fov, max_depth, pixels_per_meter, min_confidence))
+        return osp.join(CONFIDENCE_MASK_DIR, f"confidence_mask_{name}.npy")
+
+    def _load_confidence_mask(self, key: Tuple[float, float, int, float]) -> Optional[np.ndarray]:
+        if CONFIDENCE_MASK_DIR == "" or not osp.isfile(self._confidence_mask_path(key)):
+            return None
+        try:
+            return np.load(self._confidence_mask_path(key))
+        except (OSError, ValueError) as e:
+            warnings.warn(f"Could not load the cached confidence mask: {e}")
+            return None
+
+    def _save_confidence_mask(self, key: Tuple[float, float, int, float], mask: np.ndarray) -> None:
+        if CONFIDENCE_MASK_DIR == "":
+            return
+        temp_path = None
+        try:
+            os.makedirs(CONFIDENCE_MASK_DIR, exist_ok=True)
+            # Written to a temporary file first, so that concurrent workers never read a partial file
+            with tempfile.NamedTemporaryFile(dir=CONFIDENCE_MASK_DIR, suffix=".npy", delete=False) as f:
+                temp_path = f.name
+                np.save(f, mask)
+            os.replace(temp_path, self._confidence_mask_path(key))
+            temp_path = None
+        except OSError as e:
+            warnings.warn(f"Could not cache the confidence mask in {CONFIDENCE_MASK_DIR}: {e}")
+        finally:
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    def _fuse_new_data(self, new_map: np.ndarray, values: np.ndarray, window: Tuple[slice, slice]) -> None:
+        """Fuse the new data with the existing value and confidence maps. The maps are
+        updated in place, only within the window covered by the new data.
 
         Args:
-            new_map: The new new_map map data to fuse. Confidences are between
-                0 and 1, with 1 being the most confident.
+            new_map: The new new_map map data to fuse, covering the window of the map.
+                Confidences are between 0 and 1, with 1 being the most confident.
             values: The values attributed to the new portion of the map.
+            window: The (rows, columns) slices of the map covered by new_map.
         """
         assert (
             len(values) == self._value_channels
         ), f"Incorrect number of values given ({len(values)}). Expected {self._value_channels}."
-
-        if self._obstacle_map is not None:
+        if new_map.size > 0:
+            self._extend_written_box(window)
+            rows, cols = window
+            self._add_dirty_box((int(rows.start), int(cols.start), int(rows.stop), int(cols.stop)))
+        confidence_map = self._map[window]
+        value_map = self._value_map[window]
+
+        if self._obstacle_map is not None and self._written_box is not None:
             # If an obstacle map is provided, we will use it to mask out the
             # new map
             explored_area = self._obstacle_map.explored_area
-            new_map[explored_area == 0] = 0
-            self._map[explored_area == 0] = 0
-            self._value_map[explored_area == 0] *= 0
+            new_map[explored_area[window] == 0] = 0
+            # The explored area can also shrink away from the window, but the maps are
+            # still blank outside of the pixels written so far
+            top, left, bottom, right = self._written_box
+            unexplored = explored_area[top:bottom, left:right] == 0
+            cleared_rows, cleared_cols = np.nonzero(np.logical_and(unexplored, self._map[top:bottom, left:right] > 0))
+            if len(cleared_rows) > 0:
+                self._add_dirty_box(
+                    (
+                        int(top + cleared_rows.min()),
+                        int(left + cleared_cols.min()),
+                        int(top + cleared_rows.max() + 1),
+                        int(left + cleared_cols.max() + 1),
+                    )
+                )
+            self._map[top:bottom, left:right][unexplored] = 0
+            self._value_map[top:bottom, left:right][unexplored] = 0
 
         if self._fusion_type == "replace":
             # Ablation. The values from the current observation will overwrite any
             # existing values
             print("VALUE MAP ABLATION:", self._fusion_type)
-            new_value_map = np.zeros_like(self._value_map)
-            new_value_map[new_map > 0] = values
-            self._map[new_map > 0] = new_map[new_map > 0]
-            self._value_map[new_map > 0] = new_value_map[new_map > 0]
+            updated_mask = new_map > 0
+            confidence_map[updated_mask] = new_map[updated_mask]
+            value_map[updated_mask] = values
             return
         elif self._fusion_type == "equal_weighting":
             # Ablation. Updated values will always be the mean of the current and
             # new values, meaning that confidence scores are forced to be the same.
+            # Confidences outside the window are only read once they are in a window.
             print("VALUE MAP ABLATION:", self._fusion_type)
-            self._map[self._map > 0] = 1
+            confidence_map[confidence_map > 0] = 1
             new_map[new_map > 0] = 1
         else:
             assert self._fusion_type == "default", f"Unknown fusion type {self._fusion_type}"
@@ -401,38 +582,45 @@ class ValueMap(BaseMap):
         # Any values in the given map that are less confident than
         # self._decision_threshold AND less than the new_map in the existing map
         # will be silenced into 0s
-        new_map_mask = np.logical_and(new_map < self._decision_threshold, new_map < self._map)
+        new_map_mask = np.logical_and(new_map < self._decision_threshold, new_map < confidence_map)
         new_map[new_map_mask] = 0
 
         if self._use_max_confidence:
             # For every pixel that has a higher new_map in the new map than the
             # existing value map, replace the value in the existing value map with
             # the new value
-            higher_new_map_mask = new_map > self._map
-            self._value_map[higher_new_map_mask] = values
+            higher_new_map_mask = new_map > confidence_map
+            value_map[higher_new_map_mask] = values
             # Update the new_map map with the new new_map values
-            self._map[higher_new_map_mask] = new_map[higher_new_map_mask]
+            confidence_map[higher_new_map_mask] = new_map[higher_new_map_mask]
         else:
             # Each pixel in the existing value map will be updated with a weighted
             # average of the existing value and the new value. The weight of each value
             # is determined by the current and new new_map values. The new_map map
             # will also be updated with using a weighted average in a similar manner.
-            confidence_denominator = self._map + new_map
+            confidence_denominator = confidence_map + new_map
             with warnings.catch_warnings():
                 warnings.filterwarnings("ignore", category=RuntimeWarning)
-                weight_1 = self._map / confidence_denominator
+                weight_1 = confidence_map / confidence_denominator
                 weight_2 = new_map / confidence_denominator
 
-            weight_1_channeled = np.repeat(np.expand_dims(weight_1, axis=2), self._value_channels, axis=2)
-            weight_2_channeled = np.repeat(np.expand_dims(weight_2, axis=2), self._value_channels, axis=2)
-
-            self._value_map = self._value_map * weight_1_channeled + values * weight_2_channeled
-            self._map = self._map * weight_1 + new_map * weight_2
-
             # Because confidence_denominator can have 0 values, any nans in either the
             # value or confidence maps will be replaced with 0
-            self._value_map = np.nan_to_num(self._value_map)
-            self._map = np.nan_to_num(self._map)
+            value_map[:] = np.nan_to_num(value_map * weight_1[..., None] + values * weight_2[..., None])
+            confidence_map[:] = np.nan_to_num(confidence_map * weight_1 + new_map * weight_2)
+
+    def _extend_written_box(self, window: Tuple[slice, slice]) -> None:
+        rows, cols = window
+        if self._written_box is None:
+            self._written_box = (rows.start, cols.start, rows.stop, cols.stop)
+            return
+        top, left, bottom, right = self._written_box
+        self._written_box = (
+            min(top, rows.start),
+            min(left, cols.start),
+            max(bottom, rows.stop),
+            max(right, cols.stop),
+        )
 
 
 def remap(value: float, from_low: float, from_high: float, to_low: float, to_high: float) -> float:
@@ -12,6 +12,7 @@ from retrying import retry
 _init_co(autoreset=True)
 import yaml
 import numpy as np
+from vlfm.vlm.server_wrapper import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL
 
 
 class VLMOracle:
@@ -43,7 +44,7 @@ class VLMOracle:
     def set_image_description(self, image_description, target_object):
         prompt = LLaVa_TARGET_OBJECT_IS_DETECTED.format(target_object=target_object)
 
-        image_description, _ = self.LMM_CLIENT.ask(np.array(image_description), prompt=prompt)
+        image_description, _ = self.LMM_CLIENT.ask(np.array(image_description), prompt=prompt, priority=PRIORITY_LOW)
 
         self.instance_image_description = image_description
         print(Fore.LIGHTCYAN_EX + f"Image description: {image_description}")
@@ -96,22 +97,31 @@ class VLMOracle:
                 Fore.BLUE
                 + "[INFO: VLM_simulated user] Answering questions using the VLM simulated user and the high-def image."
             )
-        response_array = []
-        for question in questions:
-            prompt = question
-            if self.HUMAN_HAS_TO_ANSWER_THE_QUESTION and ARE_QUESTIONS_FOR_THE_ORACLE:
+        # answers of the simulated user are on the critical path, self-questions can wait
+        priority = PRIORITY_HIGH if ARE_QUESTIONS_FOR_THE_ORACLE else PRIORITY_NORMAL
+        if self.HUMAN_HAS_TO_ANSWER_THE_QUESTION and ARE_QUESTIONS_FOR_THE_ORACLE:
+            answers = []
+            for question in questions:
                 output = input(Fore.LIGHTRED_EX + f"Question: {question}\n{Fore.GREEN}Answer: ")
-                logits_likelihood = None
+                answers.append((output, None))
+        else:
+            # all the questions are about the same image, so they are answered in a single batched call
+            if perform_logits_likelihood:
+                # Yes/No/? questions: only the distribution of the first answer token is needed
+                answers = self.LMM_CLIENT.score_yes_no(
+                    np.array(IMAGE_TO_BE_USED_BY_VQA_MODEL), prompts=questions, priority=priority
+                )
             else:
-                output, logits_likelihood = self.LMM_CLIENT.ask(
-                    np.array(IMAGE_TO_BE_USED_BY_VQA_MODEL),
-                    prompt=prompt,
-                    return_token_likelihood=perform_logits_likelihood,
+                answers = self.LMM_CLIENT.ask_batch(
+                    np.array(IMAGE_TO_BE_USED_BY_VQA_MODEL), prompts=questions, priority=priority
                 )
-                if perform_logits_likelihood:
-                    assert (
-                        logits_likelihood is not None
-                    ), "logits_likelihood must be provided if perform_logits_likelihood is True"
+            if perform_logits_likelihood:
+                assert all(
+                    logits_likelihood is not None for _, logits_likelihood in answers
+                ), "logits_likelihood must be provided if perform_logits_likelihood is True"
+
+        response_array = []
+        for question, (output, logits_likelihood) in zip(questions, answers):
             print(f"\t -> Question: {question}")
             print(f"\t -> Answer: {output}")
             print("\n")
@@ -138,6 +148,9 @@ class VLMOracle:
 
     def reset(self):
 
+        stats = self.LMM_CLIENT.stats()
+        if stats:
+            print(Fore.CYAN + f"LLaVA server caches: {stats}")
         self.instance_image = None
         self.ep_id = None
         self.instance_image_description = None  # description of the target image
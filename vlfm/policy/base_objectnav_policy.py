@@ -1,5 +1,6 @@
 # Copyright (c) 2023 Boston Dynamics AI Institute LLC. All rights reserved.
 
+import json
 import os
 from dataclasses import dataclass, fields
 from typing import Any, Dict, List, Tuple, Union
@@ -15,11 +16,12 @@ from vlfm.obs_transformers.utils import image_resize
 from vlfm.policy.utils.pointnav_policy import WrappedPointNavResNetPolicy
 from vlfm.utils.geometry_utils import get_fov, rho_theta
 from vlfm.vlm.coco_classes import COCO_CLASSES
+from vlfm.vlm.detect_and_segment import DetectAndSegmentClient
 from vlfm.vlm.grounding_dino import GroundingDINOClient, ObjectDetections
 from vlfm.vlm.sam import MobileSAMClient
 from vlfm.vlm.yolov7 import YOLOv7Client
 import vlfm.vlm.llava_next as LLaVA
-from vlfm.vlm.openai_llm import OpenAILLMClient
+from vlfm.vlm.openai_llm import OpenAILLMClient, RecordReplayLLMClient
 from vlfm.oracle.oracle import VLMOracle
 from vlfm.brain.vlm_brain_history import VLM_History
 from vlfm.brain.llm_brain_history import LLM_History
@@ -75,6 +77,13 @@ class BaseObjectNavPolicy(BasePolicy):
         self._object_detector = GroundingDINOClient(port=int(os.environ.get("GROUNDING_DINO_PORT", "12181")))
         self._coco_object_detector = YOLOv7Client(port=int(os.environ.get("YOLOV7_PORT", "12184")))
         self._mobile_sam = MobileSAMClient(port=int(os.environ.get("SAM_PORT", "12183")))
+        # If a combined GroundingDINO + MobileSAM server is running, a frame is detected
+        # and segmented in one round trip instead of two
+        self._detect_and_segment = (
+            DetectAndSegmentClient(port=int(os.environ["DETECT_AND_SEGMENT_PORT"]))
+            if "DETECT_AND_SEGMENT_PORT" in os.environ
+            else None
+        )
         self._use_vqa = use_vqa
 
         ##### LLM and VLM
@@ -91,7 +100,18 @@ class BaseObjectNavPolicy(BasePolicy):
             llm_client_params = {
                 "model": "gpt-4o",
             }
+        if "COIN_LLM_ENDPOINTS" in os.environ:
+            # JSON list of OpenAI-compatible endpoints, e.g. [{"model": "gpt-4o"}, {"model": "...", "base_url": "...",
+            # "api_key_prefix": "CEREBRAS_KEY"}]: the calls go to the fastest one and are hedged on its tail latency
+            llm_client_params = json.loads(os.environ["COIN_LLM_ENDPOINTS"])
         LLM_CONNECTOR = OpenAILLMClient(llm_client_params)
+        if "COIN_LLM_CACHE" in os.environ:
+            # record the LLM answers (or replay them) to rerun ablations without calling the API
+            LLM_CONNECTOR = RecordReplayLLMClient(
+                LLM_CONNECTOR,
+                os.environ["COIN_LLM_CACHE"],
+                mode=os.environ.get("COIN_LLM_CACHE_MODE", "record-missing"),
+            )
 
         self.VLM_ORACLE = VLMOracle(vlm_connector, LLM_CONNECTOR)  # only accessible to the llm oracle
 
@@ -326,6 +346,31 @@ class BaseObjectNavPolicy(BasePolicy):
 
         return detections
 
+    def _get_object_detections_and_masks(self, img: np.ndarray) -> Tuple[ObjectDetections, List[np.ndarray]]:
+        """Detects the target objects in the image and segments each detection.
+
+        Returns:
+            Tuple[ObjectDetections, List[np.ndarray]]: The detections, and one mask per
+                detection with the same height and width as the image.
+        """
+        target_classes = self._target_object.split("|")
+        has_coco = any(c in COCO_CLASSES for c in target_classes) and self._load_yolo
+        if self._detect_and_segment is not None and not has_coco:
+            self._non_coco_caption = " . ".join(target_classes) + " ."
+            return self._detect_and_segment.detect_and_segment(
+                img, self._non_coco_caption, target_classes, self._non_coco_threshold
+            )
+
+        detections = self._get_object_detections(img)
+        height, width = img.shape[:2]
+        # Segment all the detections in one request, so the image is encoded only once
+        bboxes_denorm = [
+            (detections.boxes[idx] * np.array([width, height, width, height])).tolist()
+            for idx in range(len(detections.logits))
+        ]
+        object_masks = self._mobile_sam.segment_bboxes(img, bboxes_denorm)
+        return detections, object_masks
+
     def _pointnav(self, goal: np.ndarray, stop: bool = False) -> Tensor:
         """
         Calculates rho and theta from the robot's current position to the goal using the
@@ -403,7 +448,7 @@ class BaseObjectNavPolicy(BasePolicy):
         #     print(Fore.GREEN + f"Object {self._target_object} already detected, navigating towards it.")
         #     return
 
-        detections = self._get_object_detections(rgb)
+        detections, object_masks = self._get_object_detections_and_masks(rgb)
         height, width = rgb.shape[:2]
         self._object_masks = np.zeros((height, width), dtype=np.uint8)
         if np.array_equal(depth, np.ones_like(depth)) and detections.num_detections > 0:
@@ -412,8 +457,7 @@ class BaseObjectNavPolicy(BasePolicy):
             obs[1] = depth
             self._observations_cache["object_map_rgbd"][0] = tuple(obs)
         for idx in range(len(detections.logits)):
-            bbox_denorm = detections.boxes[idx] * np.array([width, height, width, height])
-            object_mask = self._mobile_sam.segment_bbox(rgb, bbox_denorm.tolist())
+            object_mask = object_masks[idx]
 
             if self._use_vqa:
                 ### we use our uncertainty estimation technique to filter out detection false positives
@@ -295,24 +295,22 @@ class ITMPolicyV3(ITMPolicyV2):
 
         return sorted_frontiers, sorted_values
 
-    def _reduce_values(self, values: List[Tuple[float, float]]) -> List[float]:
+    def _reduce_values(self, values: np.ndarray) -> np.ndarray:
         """
         Reduce the values to a single value per frontier
 
         Args:
-            values: A list of tuples of the form (target_value, exploration_value). If
-                the highest target_value of all the value tuples is below the threshold,
-                then we return the second element (exploration_value) of each tuple.
-                Otherwise, we return the first element (target_value) of each tuple.
+            values: An array of shape (num_frontiers, 2), where each row is of the form
+                (target_value, exploration_value). If the highest target_value of all the
+                rows is below the threshold, then we return the second column
+                (exploration_value). Otherwise, we return the first column (target_value).
 
         Returns:
-            A list of values, one per frontier.
+            An array of values, one per frontier.
         """
-        target_values = [v[0] for v in values]
-        max_target_value = max(target_values)
+        max_target_value = np.max(values[:, 0])
 
         if max_target_value < self._exploration_thresh:
-            explore_values = [v[1] for v in values]
-            return explore_values
+            return values[:, 1]
         else:
-            return [v[0] for v in values]
+            return values[:, 0]
@@ -1,7 +1,7 @@
 # Copyright (c) 2023 Boston Dynamics AI Institute LLC. All rights reserved.
 
 import math
-from typing import Tuple
+from typing import Optional, Tuple
 
 import numpy as np
 
@@ -213,7 +213,14 @@ def transform_points(transformation_matrix: np.ndarray, points: np.ndarray) -> n
     return transformed_points[:, :3] / transformed_points[:, 3:]
 
 
-def get_point_cloud(depth_image: np.ndarray, mask: np.ndarray, fx: float, fy: float) -> np.ndarray:
+def get_point_cloud(
+    depth_image: np.ndarray,
+    mask: np.ndarray,
+    fx: float,
+    fy: float,
+    pixel_offset: Tuple[int, int] = (0, 0),
+    image_shape: Optional[Tuple[int, int]] = None,
+) -> np.ndarray:
     """Calculates the 3D coordinates (x, y, z) of points in the depth image based on
     the horizontal field of view (HFOV), the image width and height, the depth values,
     and the pixel x and y coordinates.
@@ -223,14 +230,20 @@ def get_point_cloud(depth_image: np.ndarray, mask: np.ndarray, fx: float, fy: fl
         mask (np.ndarray): 2D binary mask identifying relevant pixels.
         fx (float): Focal length in the x direction.
         fy (float): Focal length in the y direction.
+        pixel_offset (Tuple[int, int]): The (row, col) of the top-left corner of the
+            depth image and mask, if they are a crop of the full image.
+        image_shape (Optional[Tuple[int, int]]): The shape of the full image, if the
+            depth image and mask are a crop of it.
 
     Returns:
         np.ndarray: Array of 3D coordinates (x, y, z) of the points in the image plane.
     """
+    if image_shape is None:
+        image_shape = depth_image.shape[:2]
     v, u = np.where(mask)
     z = depth_image[v, u]
-    x = (u - depth_image.shape[1] // 2) * z / fx
-    y = (v - depth_image.shape[0] // 2) * z / fy
+    x = (u + pixel_offset[1] - image_shape[1] // 2) * z / fx
+    y = (v + pixel_offset[0] - image_shape[0] // 2) * z / fy
     cloud = np.stack((z, -x, -y), axis=-1)
 
     return cloud
@@ -1,10 +1,13 @@
 # Copyright (c) 2023 Boston Dynamics AI Institute LLC. All rights reserved.
 
-from typing import List, Tuple, Union
+from typing import Dict, List, Tuple, Union
 
 import cv2
 import numpy as np
 
+# (row, column) offsets of the pixels of a filled disk, keyed by radius
+_disk_offsets: Dict[int, np.ndarray] = {}
+
 
 def rotate_image(
     image: np.ndarray,
@@ -28,35 +31,58 @@ def rotate_image(
     return rotated_image
 
 
-def place_img_in_img(img1: np.ndarray, img2: np.ndarray, row: int, col: int) -> np.ndarray:
-    """Place img2 in img1 such that img2's center is at the specified coordinates (xy)
-    in img1.
+def img_in_img_slices(
+    img1_shape: Tuple[int, ...], img2_shape: Tuple[int, ...], row: int, col: int
+) -> Tuple[Tuple[slice, slice], Tuple[slice, slice]]:
+    """Returns the overlapping windows of img1 and img2 when img2's center is placed at
+    the specified coordinates in img1, clipped to the borders of img1.
 
     Args:
-        img1 (numpy.ndarray): The base image.
-        img2 (numpy.ndarray): The image to be placed.
-
+        img1_shape (Tuple[int, ...]): The shape of the base image.
+        img2_shape (Tuple[int, ...]): The shape of the image to be placed.
+        row (int): The row of img1 where img2's center is placed.
+        col (int): The column of img1 where img2's center is placed.
 
     Returns:
-        numpy.ndarray: The updated base image with img2 placed.
+        Tuple[Tuple[slice, slice], Tuple[slice, slice]]: The (rows, columns) slices of
+            img1 and the corresponding slices of img2.
     """
-    assert 0 <= row < img1.shape[0] and 0 <= col < img1.shape[1], "Pixel location is outside the image."
-    top = row - img2.shape[0] // 2
-    left = col - img2.shape[1] // 2
-    bottom = top + img2.shape[0]
-    right = left + img2.shape[1]
+    assert 0 <= row < img1_shape[0] and 0 <= col < img1_shape[1], "Pixel location is outside the image."
+    top = row - img2_shape[0] // 2
+    left = col - img2_shape[1] // 2
+    bottom = top + img2_shape[0]
+    right = left + img2_shape[1]
 
     img1_top = max(0, top)
     img1_left = max(0, left)
-    img1_bottom = min(img1.shape[0], bottom)
-    img1_right = min(img1.shape[1], right)
+    img1_bottom = min(img1_shape[0], bottom)
+    img1_right = min(img1_shape[1], right)
 
     img2_top = max(0, -top)
     img2_left = max(0, -left)
     img2_bottom = img2_top + (img1_bottom - img1_top)
     img2_right = img2_left + (img1_right - img1_left)
 
-    img1[img1_top:img1_bottom, img1_left:img1_right] = img2[img2_top:img2_bottom, img2_left:img2_right]
+    return (
+        (slice(img1_top, img1_bottom), slice(img1_left, img1_right)),
+        (slice(img2_top, img2_bottom), slice(img2_left, img2_right)),
+    )
+
+
+def place_img_in_img(img1: np.ndarray, img2: np.ndarray, row: int, col: int) -> np.ndarray:
+    """Place img2 in img1 such that img2's center is at the specified coordinates (xy)
+    in img1.
+
+    Args:
+        img1 (numpy.ndarray): The base image.
+        img2 (numpy.ndarray): The image to be placed.
+
+
+    Returns:
+        numpy.ndarray: The updated base image with img2 placed.
+    """
+    img1_window, img2_window = img_in_img_slices(img1.shape, img2.shape, row, col)
+    img1[img1_window] = img2[img2_window]
 
     return img1
 
@@ -267,6 +293,78 @@ def pixel_value_within_radius(
         raise ValueError(f"Invalid reduction method: {reduction}")
 
 
+def get_disk_offsets(radius: int) -> np.ndarray:
+    """Returns the (row, column) offsets from the center of the pixels of a filled disk
+    of the given radius, as drawn by cv2.circle, as an array of shape (K, 2)."""
+    if radius not in _disk_offsets:
+        disk = np.zeros((2 * radius + 1, 2 * radius + 1), dtype=np.uint8)
+        disk = cv2.circle(disk, (radius, radius), radius, color=255, thickness=-1)
+        _disk_offsets[radius] = np.argwhere(disk > 0) - radius
+    return _disk_offsets[radius]
+
+
+def pixel_values_within_radius(
+    image: np.ndarray,
+    pixel_locations: np.ndarray,
+    radius: int,
+    reduction: str = "median",
+) -> np.ndarray:
+    """Batched version of pixel_value_within_radius, for several pixel locations and
+    all the channels of the image at once. The neighborhoods of all the locations are
+    gathered with a single table of disk offsets, and reduced with masked operations.
+
+    Args:
+        image (np.ndarray): The input image, of shape (H, W) or (H, W, C).
+        pixel_locations (np.ndarray): The locations of the pixels as an array of
+            (row, column), of shape (N, 2).
+        radius (int): The radius within which to reduce the pixel values.
+        reduction (str, optional): The method to use to reduce the values within the
+            radius to a single value. Defaults to "median".
+
+    Returns:
+        np.ndarray: The reduced values, of shape (N,) or (N, C), -1 where no pixel
+            within the radius has a value (i.e. pixels that weren't seen yet).
+    """
+    locations = np.asarray(pixel_locations, dtype=int).reshape(-1, 2)
+    image_size = np.array(image.shape[:2])
+    if np.any(locations < 0) or np.any(locations >= image_size):
+        raise ValueError("Pixel location is outside the image.")
+
+    # Like in pixel_value_within_radius, the neighborhood is cropped to the image and
+    # the disk is anchored at the top left corner of the crop
+    top_left = np.maximum(locations - radius, 0)
+    bottom_right = np.minimum(locations + radius + 1, image_size)
+    offsets = get_disk_offsets(radius) + radius
+    rows = top_left[:, :1] + offsets[:, 0]
+    cols = top_left[:, 1:] + offsets[:, 1]
+    in_crop = np.logical_and(rows < bottom_right[:, :1], cols < bottom_right[:, 1:])
+
+    # Gather the neighborhoods of all the locations and channels at once, shape (N, K, C)
+    flat_pixels = np.minimum(rows, image_size[0] - 1) * image_size[1] + np.minimum(cols, image_size[1] - 1)
+    values = image.reshape(image_size[0] * image_size[1], -1)[flat_pixels]
+    # Filter out any values that are 0 (i.e. pixels that weren't seen yet)
+    valid = np.logical_and(in_crop[..., None], values > 0)
+    counts = np.count_nonzero(valid, axis=1)
+
+    if reduction == "mean":
+        reduced = np.sum(np.where(valid, values, 0), axis=1) / np.maximum(counts, 1)
+    elif reduction == "max":
+        reduced = np.max(np.where(valid, values, -np.inf), axis=1)
+    elif reduction == "median":
+        # Invalid values are sorted last, the median is the mean of the middle valid values
+        sorted_values = np.sort(np.where(valid, values, np.inf), axis=1)
+        low = np.take_along_axis(sorted_values, (np.maximum(counts, 1) - 1)[:, None] // 2, axis=1)[:, 0]
+        high = np.take_along_axis(sorted_values, counts[:, None] // 2, axis=1)[:, 0]
+        reduced = np.where(counts > 0, (low + high) / 2, 0)
+    else:
+        raise ValueError(f"Invalid reduction method: {reduction}")
+
+    reduced = np.where(counts > 0, reduced, -1)
+    if image.ndim == 2:
+        return reduced[:, 0]
+    return reduced
+
+
 def median_blur_normalized_depth_image(depth_image: np.ndarray, ksize: int) -> np.ndarray:
     """Applies a median blur to a normalized depth image.
 
@@ -17,45 +17,33 @@ Task: Answer the following question in YAML format, explaining the most signific
 YAML_START
 Question: "Is this the target {target_object}?"
 Answer: "No, this is not the {target_object} I'm looking for, <explain the difference using the most significant attribute>"
-YAML_END
-
-Provide your reasoning step-by-step, after the YAML_END tag."""
+YAML_END"""
 
 
 LLM_FACTS_UPDATER_AFTER_IS_THIS_TARGET_OBJECT_ORACLE_QUESTION_V1 = """
-You are an intelligent embodied agent tasked with finding a specific target {target_object}.
+You are an intelligent embodied agent tasked with finding a specific target object, given between <START_TARGET_OBJECT> and <END_TARGET_OBJECT>.
 
-You know the following facts about the target {target_object}:
-<START_TARGET_PICTURE_FACTS> {facts_about_the_target_picture} <END_TARGET_PICTURE_FACTS> 
+You know the facts about the target object given between <START_TARGET_PICTURE_FACTS> and <END_TARGET_PICTURE_FACTS>.
 
-You recently detected another picture and asked to the human several question:
-<START_OF_ORACLE_ANSWER>
-{oracle_questions_answer}
-<END_OF_ORACLE_ANSWER>
+You recently detected another picture and asked to the human several question, the questions and answers are given between <START_ORACLE_ANSWER> and <END_ORACLE_ANSWER>.
 
 Task: Update the target facts with this new information. Be concise. Do not include information that are uncertain.
 
 YAML_START
 facts: <updated facts as a single text line>
-YAML_END # must be present to get the information back
-Provide your reasoning step-by-step, after the YAML_END tag."""
+YAML_END # must be present to get the information back"""
 
 
-UNCERTAIN_ANSWER_CHOICE_PLACEHOLDER = "?=I don't know."
 LLM_SELF_QUESTIONER_GIVEN_DISTRACTOR_DESCRIPTION = """
-You are an intelligent embodied agent equipped with an RGB sensor, an object detector, and a Visual Question Answering (VQA) model. Your task is to explore an indoor environment to find a specific target {target_object}.
-The detector has identified a {target_object}. The VQA model has provided the following description of the scene:
-
-<START_OF_DESCRIPTION>
-{distractor_object_description}
-<END_OF_DESCRIPTION>
+You are an intelligent embodied agent equipped with an RGB sensor, an object detector, and a Visual Question Answering (VQA) model. Your task is to explore an indoor environment to find a specific target object, given between <START_TARGET_OBJECT> and <END_TARGET_OBJECT>.
+The detector has identified an instance of the target object. The VQA model has provided the description of the scene given between <START_DESCRIPTION> and <END_DESCRIPTION>.
 
-Based on your past interactions with the user, you know the following facts about the target picture: <START_TARGET_PICTURE_FACTS> {facts_about_the_target_picture} <END_TARGET_PICTURE_FACTS> 
+Based on your past interactions with the user, you know the facts about the target picture given between <START_TARGET_PICTURE_FACTS> and <END_TARGET_PICTURE_FACTS>.
 
-Assume that the detected image description contains hallucinations. Your goal is to verify every attribute of the detected {target_object} description through questions. Formally:
+Assume that the detected image description contains hallucinations. Your goal is to verify every attribute of the detected object description through questions. Formally:
 - Detect possible hallucinations in the VQA model's description
 - Get more information about the detected object.
-Every question should be in this format: "<question content>? You must answer only with Yes, No, or {uncertain_answer_choice_placeholder}" This allows us to access likelihood the the answers.
+Every question should be in this format: "<question content>? You must answer only with Yes, No, or ?=I don't know." This allows us to access likelihood the the answers.
 
 
 Ensure your output follows the following format:
@@ -67,25 +55,18 @@ questions_for_detected_object: # question for the detected object, if any
     <Question number>:  "<question>? You must answer only with Yes, No, or ?=I don't know."
 reasoning_for_detected_object:
     <Question number>: <reasoning>
-YAML_END # must be present to get the information back
-
-Provide your reasoning step-by-step, after the YAML_END tag."""
+YAML_END # must be present to get the information back"""
 
 
 LMM_RETRIEVE_FACTS_FROM_DESCRIPTION = """
 You are an intelligent embodied agent equipped with an RGB sensor, an object detector, and a Visual Question Answering (VQA) model. 
-Your task is to explore an indoor environment to find a specific target {target_object}.
-The detector has identified a {target_object}. The VQA model has provided the following description of the scene:
-
-<START_OF_DESCRIPTION>
-{distractor_object_description}
-<END_OF_DESCRIPTION>
+Your task is to explore an indoor environment to find a specific target object, given between <START_TARGET_OBJECT> and <END_TARGET_OBJECT>.
+The detector has identified an instance of the target object. The VQA model has provided the description of the scene given between <START_DESCRIPTION> and <END_DESCRIPTION>.
 
-Based on your past interactions with the user, you know the following facts about the target picture: 
-<START_TARGET_PICTURE_FACTS> {facts_about_the_target_picture} <END_TARGET_PICTURE_FACTS> 
+Based on your past interactions with the user, you know the facts about the target picture given between <START_TARGET_PICTURE_FACTS> and <END_TARGET_PICTURE_FACTS>.
 
 Your task is to:
-- ask more question to the VQA model on the detected {target_object} to maximize information gain.
+- ask more question to the VQA model on the detected object to maximize information gain.
 
 Ensure your output follows the following format:
 
@@ -94,9 +75,7 @@ attributes_of_the_image:
     <attribute name>: "<attribute value>" # summarize all the known attributes from the description, enclosed in " "
 questions:
         <question_number>: "<question content>"
-YAML_END # must be present to get the information back
-      
-Provide your reasoning step-by-step, after the YAML_END tag."""
+YAML_END # must be present to get the information back"""
 
 
 LLM_REFINE_DETECTED_OBJECT_DESCRIPTION = """
@@ -104,58 +83,41 @@ You are an intelligent embodied agent equipped with an RGB sensor, an object det
 Your task is to refine an image description based on certainty estimates and user interactions.
 
 Scenario:
-The detector has identified a scene with a {target_object}. The VQA model provided this initial scene description:
+The detector has identified a scene with the target object, given between <START_TARGET_OBJECT> and <END_TARGET_OBJECT>. The VQA model provided the initial scene description given between <START_DESCRIPTION> and <END_DESCRIPTION>.
 
-<START_OF_DESCRIPTION>
-{distractor_object_description}
-<END_OF_DESCRIPTION>
-
-
-Questions asked and responses:
-<START_QUESTION_AND_RESPONSES>
-{list_questions_answers_uncertainty_labels}
-<END_QUESTION_AND_RESPONSES>
+The questions asked and their responses, with uncertainty labels, are given between <START_QUESTION_AND_RESPONSES> and <END_QUESTION_AND_RESPONSES>.
 
 Task:
 Using the questions/answer pairs with uncertainty labels, refine the image description. 
-Since we have to find a {target_object}, put enphasis on it. Do not include in the description information that is labeled as uncertain.
+Since we have to find the target object, put enphasis on it. Do not include in the description information that is labeled as uncertain.
 
 Ensure your response follows the format below:
 YAML_START # must be present to get the information back
 attributes_of_the_image:
     <attribute name>: "<attribute value>" # summarize all the known attributes from the description, enclosed in " "
 image_description_refined: <insert refined description>  # Ensure that the string does not contain a newline (\n) after the tag image_description_refined:
-YAML_END # must be present to get the information back
-      
-Provide your reasoning step-by-step, after the YAML_END tag."""
+YAML_END # must be present to get the information back"""
 
 LLM_SIMILARITY_SCORE_AND_QUESTION_TO_TARGET = """
 You are an intelligent agent equipped with an RGB sensor, object detector, and Visual Question Answering (VQA) model.
-Your goal is to identify a target {target_object} based on a scene description and prior knowledge of the target.
+Your goal is to identify a target object, given between <START_TARGET_OBJECT> and <END_TARGET_OBJECT>, based on a scene description and prior knowledge of the target.
 
 Scenario:
-The object detector has identified a scene containing a {target_object}, and the VQA model has provided the following description:
-
-<START_OF_DESCRIPTION>
-{distractor_object_description}
-<END_OF_DESCRIPTION>
+The object detector has identified a scene containing an instance of the target object, and the VQA model has provided the description given between <START_DESCRIPTION> and <END_DESCRIPTION>.
 
 Target object information: 
-Based on previous interactions, you know the target picture has the following characteristics:
-<START_TARGET_PICTURE_FACTS>
-{facts_about_the_target_picture}
-<END_TARGET_PICTURE_FACTS> 
+Based on previous interactions, you know the target picture has the characteristics given between <START_TARGET_PICTURE_FACTS> and <END_TARGET_PICTURE_FACTS>.
 
 Task:
 1. Similarity analysis.
-Analyze how closely the detected scene description aligns with the known facts about the target {target_object}. Provide a similarity score between 0 and 10, where:
-- 0 = The detected {target_object} is not the target object.
-- 10 = The detected {target_object} is definitely the target object.
+Analyze how closely the detected scene description aligns with the known facts about the target object. Provide a similarity score between 0 and 10, where:
+- 0 = The detected object is not the target object.
+- 10 = The detected object is definitely the target object.
 - If no information about the target is available, the score should be -1.
 
 2. Question Generation:
 - The question is for the target object, not the detected one.
-- Ask exactly one specific, relevant, and human-answerable question related to the target object that maximizes information gain for identifying the target {target_object}.
+- Ask exactly one specific, relevant, and human-answerable question related to the target object that maximizes information gain for identifying the target object.
 - Do not ask speculative or irrelevant questions 
 - The question should be grounded in observable or known details from the scene, focusing on key characteristics that can help confirm or refute the identity of the target object.
 
@@ -164,6 +126,37 @@ YAML_START # must be present to get the information back
 similarity_score: <similarity score>
 questions:
     <question_number>: <question_content>
-YAML_END # must be present to get the information back
+YAML_END # must be present to get the information back"""
+
+
+# The LLM prompts above are static: they are sent first, as the system message, so that providers with
+# automatic prefix caching reuse them across calls. The episode-specific fields follow in the user message.
+def build_llm_prompt(**fields: str) -> str:
+    """Returns the user message holding the variable fields of an LLM prompt, each one enclosed in
+    <START_NAME> and <END_NAME> tags (e.g. target_object -> <START_TARGET_OBJECT>)."""
+    return "\n\n".join(
+        f"<START_{name.upper()}>\n{value}\n<END_{name.upper()}>" for name, value in fields.items()
+    )
+
+
+LLM_STRUCTURED_OUTPUT_CORRECTION = """{prompt}
+
+<START_PREVIOUS_ANSWER>
+{previous_answer}
+<END_PREVIOUS_ANSWER>
+
+Your previous answer (above) could not be used: {error}.
+Answer again, with a valid YAML block between YAML_START and YAML_END containing the keys: {keys}.
+Enclose every text value in " "."""
+
 
-Provide your reasoning step-by-step for the similarity score and questions, after the YAML_END tag."""
+# Generation controls of the LLM prompts above. The answer is complete once the YAML block is closed, so the
+# generation stops at YAML_END and is capped per prompt type.
+LLM_YAML_STOP_SEQUENCES = ["YAML_END"]
+LLM_MAX_TOKENS = {
+    "self_questioner": 600,  # LLM_SELF_QUESTIONER_GIVEN_DISTRACTOR_DESCRIPTION
+    "retrieve_facts": 400,  # LMM_RETRIEVE_FACTS_FROM_DESCRIPTION
+    "refine_description": 600,  # LLM_REFINE_DETECTED_OBJECT_DESCRIPTION
+    "similarity_score": 300,  # LLM_SIMILARITY_SCORE_AND_QUESTION_TO_TARGET
+    "facts_updater": 300,  # LLM_FACTS_UPDATER_AFTER_IS_THIS_TARGET_OBJECT_ORACLE_QUESTION_V1
+}
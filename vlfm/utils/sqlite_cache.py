@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+class SQLiteCache:
+    """Persistent key/value store for JSON-serializable values, backed by a SQLite file.
+
+    The total size of the stored values is bounded: once it exceeds max_size_mb, the
+    least recently used entries are evicted, down to a fraction of the limit so that
+    eviction does not run on every insertion. The store can be shared by several
+    processes, and counts its hits and misses to measure how much work it saves.
+    """
+
+    # Eviction brings the size down to this fraction of max_size_mb
+    _evict_to: float = 0.9
+    # The running total of a process misses the insertions of the others, it is
+    # recomputed after this many insertions
+    _resync_every: int = 1000
+
+    def __init__(self, path: str, max_size_mb: float = 512.0) -> None:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._max_size = int(max_size_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+            self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        self._puts_since_resync = 0
+        self._last_access = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        """Returns a fixed-length key for the given JSON-serializable parts."""
+        serialized = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+        return hashlib.blake2b(serialized.encode("utf-8"), digest_size=20).hexdigest()
+
+    def _now(self) -> float:
+        # strictly increasing, so that entries touched in a burst keep their order
+        self._last_access = max(time.time(), self._last_access + 1e-6)
+        return self._last_access
+
+    def get(self, key: str) -> Optional[Any]:
+        """Returns the value stored for key, or None if there is none."""
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (self._now(), key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any) -> None:
+        """Stores value for key, evicting the least recently used entries if needed."""
+        serialized = json.dumps(value)
+        with self._lock, self._conn:
+            replaced = self._conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, serialized, len(serialized), self._now()),
+            )
+            self._size += len(serialized) - (replaced[0] if replaced is not None else 0)
+            self._puts_since_resync += 1
+            if self._size > self._max_size or self._puts_since_resync >= self._resync_every:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Recomputes the total size and, if it exceeds the limit, evicts the least
+        recently used entries."""
+        total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        self._puts_since_resync = 0
+        if total_size > self._max_size:
+            stale_keys = []
+            for key, size in self._conn.execute("SELECT key, size FROM cache ORDER BY last_access"):
+                if total_size <= self._evict_to * self._max_size:
+                    break
+                stale_keys.append((key,))
+                total_size -= size
+            self._conn.executemany("DELETE FROM cache WHERE key = ?", stale_keys)
+        self._size = total_size
+
+    def clear(self) -> None:
+        """Removes all the entries."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache")
+            self._size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the hit/miss counters of this process and the current size of the store."""
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "entries": entries,
+            "size_mb": size / (1024 * 1024),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -1,6 +1,6 @@
 # Copyright (c) 2023 Boston Dynamics AI Institute LLC. All rights reserved.
 
-from typing import Any, Optional
+from typing import Any, List, Optional
 
 import numpy as np
 import torch
@@ -53,6 +53,24 @@ class BLIP2ITM:
 
         return cosine
 
+    def cosine_batch(self, images: List[np.ndarray], txts: List[str]) -> List[float]:
+        """
+        Compute the cosine similarity of each image with its prompt in one forward pass.
+
+        Args:
+            images (List[numpy.ndarray]): The input images as numpy arrays.
+            txts (List[str]): The texts to compare the images to, one per image.
+
+        Returns:
+            List[float]: The cosine similarity between each image and its prompt.
+        """
+        img = torch.stack([self.vis_processors["eval"](Image.fromarray(image)) for image in images]).to(self.device)
+        txt = [self.text_processors["eval"](t) for t in txts]
+        with torch.inference_mode():
+            cosine = self.model({"image": img, "text_input": txt}, match_head="itc")
+
+        return cosine.view(-1).tolist()
+
 
 class BLIP2ITMClient:
     def __init__(self, port: int = 12182):
@@ -69,6 +87,10 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, default=12182)
+    parser.add_argument(
+        "--max-batch-size", type=int, default=1, help="Largest number of requests scored together (1: no batching)"
+    )
+    parser.add_argument("--batch-window-ms", type=float, default=10.0)
     args = parser.parse_args()
 
     print("Loading model...")
@@ -78,7 +100,21 @@ if __name__ == "__main__":
             image = str_to_image(payload["image"])
             return {"response": self.cosine(image, payload["txt"])}
 
+        def process_payloads(self, payloads: List[dict]) -> List[dict]:
+            images = [str_to_image(payload["image"]) for payload in payloads]
+            cosines = self.cosine_batch(images, [payload["txt"] for payload in payloads])
+            return [{"response": cosine} for cosine in cosines]
+
+        def warmup(self) -> None:
+            self.cosine(np.zeros((480, 640, 3), dtype=np.uint8), "a chair")
+
     blip = BLIP2ITMServer()
     print("Model loaded!")
     print(f"Hosting on port {args.port}...")
-    host_model(blip, name="blip2itm", port=args.port)
+    host_model(
+        blip,
+        name="blip2itm",
+        port=args.port,
+        batch_window_ms=args.batch_window_ms,
+        max_batch_size=args.max_batch_size,
+    )
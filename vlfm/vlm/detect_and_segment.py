@@ -0,0 +1,90 @@
+# Copyright (c) 2023 Boston Dynamics AI Institute LLC. All rights reserved.
+
+import os
+from typing import List, Tuple
+
+import numpy as np
+
+from vlfm.vlm.detections import ObjectDetections
+
+from .server_wrapper import (
+    ServerMixin,
+    host_model,
+    mask_to_packed_roi,
+    packed_roi_to_mask,
+    send_request,
+    str_to_image,
+)
+
+
+class DetectAndSegmentClient:
+    """Client for a server hosting both GroundingDINO and MobileSAM, which detects the
+    objects in a frame and segments every kept detection in a single round trip."""
+
+    def __init__(self, port: int = 12185):
+        self.url = f"http://localhost:{port}/detect_and_segment"
+
+    def detect_and_segment(
+        self, image: np.ndarray, caption: str, classes: List[str], conf_threshold: float
+    ) -> Tuple[ObjectDetections, List[np.ndarray]]:
+        """Detects the objects of the given classes and segments each of them.
+
+        Args:
+            image (np.ndarray): The RGB image.
+            caption (str): The GroundingDINO caption, classes separated by " . ".
+            classes (List[str]): Only detections of these classes are kept.
+            conf_threshold (float): Only detections with at least this confidence are
+                kept.
+
+        Returns:
+            Tuple[ObjectDetections, List[np.ndarray]]: The kept detections, and one
+                uint8 mask with the same height and width as the image per detection.
+        """
+        response = send_request(
+            self.url, image=image, caption=caption, classes=classes, conf_threshold=conf_threshold
+        )
+        detections = ObjectDetections.from_json(response["detections"], image_source=image)
+        masks = [packed_roi_to_mask(m, shape=tuple(image.shape[:2])) for m in response["masks"]]
+
+        return detections, masks
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from vlfm.vlm.grounding_dino import GROUNDING_DINO_CONFIG, GROUNDING_DINO_WEIGHTS, GroundingDINO
+    from vlfm.vlm.sam import MobileSAM
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=12185)
+    args = parser.parse_args()
+
+    print("Loading models...")
+
+    class DetectAndSegmentServer(ServerMixin):
+        def __init__(self) -> None:
+            self.gdino = GroundingDINO(
+                config_path=os.environ.get("GROUNDING_DINO_CONFIG", GROUNDING_DINO_CONFIG),
+                weights_path=os.environ.get("GROUNDING_DINO_WEIGHTS", GROUNDING_DINO_WEIGHTS),
+            )
+            self.sam = MobileSAM(sam_checkpoint=os.environ.get("MOBILE_SAM_CHECKPOINT", "data/mobile_sam.pt"))
+
+        def process_payload(self, payload: dict) -> dict:
+            image = str_to_image(payload["image"])
+            detections = self.gdino.predict(image, caption=payload["caption"])
+            detections.filter_by_class(payload["classes"])
+            detections.filter_by_conf(payload["conf_threshold"])
+
+            height, width = image.shape[:2]
+            bboxes = (detections.boxes.cpu().numpy() * np.array([width, height, width, height])).tolist()
+            masks = self.sam.segment_bboxes(image, bboxes)
+            return {"detections": detections.to_json(), "masks": [mask_to_packed_roi(mask) for mask in masks]}
+
+        def warmup(self) -> None:
+            self.gdino.predict(np.zeros((480, 640, 3), dtype=np.uint8))
+            self.sam.segment_bbox(np.zeros((480, 640, 3), dtype=np.uint8), [100, 100, 200, 200])
+
+    detect_and_segment = DetectAndSegmentServer()
+    print("Models loaded!")
+    print(f"Hosting on port {args.port}...")
+    host_model(detect_and_segment, name="detect_and_segment", port=args.port)
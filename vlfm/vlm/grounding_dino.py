@@ -99,6 +99,9 @@ if __name__ == "__main__":
             image = str_to_image(payload["image"])
             return self.predict(image, caption=payload["caption"]).to_json()
 
+        def warmup(self) -> None:
+            self.predict(np.zeros((480, 640, 3), dtype=np.uint8))
+
     gdino = GroundingDINOServer()
     print("Model loaded!")
     print(f"Hosting on port {args.port}...")
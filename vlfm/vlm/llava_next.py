@@ -1,13 +1,25 @@
-from typing import Any, Optional
-from flask import jsonify
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 import numpy as np
 import os
 import torch
 from PIL import Image
 import random
-from .server_wrapper import ServerMixin, host_model, send_request, str_to_image
+from .server_wrapper import (
+    PRIORITY_NORMAL,
+    ImageId,
+    ServerMixin,
+    get_stats,
+    host_model,
+    image_hash,
+    send_request,
+    str_to_image,
+)
+
+from vlfm.utils.sqlite_cache import SQLiteCache
 
 from transformers import (
+    DynamicCache,
     LlavaNextProcessor,
     LlavaNextForConditionalGeneration,
     BitsAndBytesConfig,
@@ -29,16 +41,57 @@ def seed_everything(seed: int):
     torch.backends.cudnn.benchmark = True
 
 
+# first token of the answers allowed by the "Yes, No, or ?=I don't know" prompts, and the answer reported for each
+YES_NO_IDK_LABELS = ("Yes", "No", "?")
+YES_NO_IDK_ANSWERS = ("Yes", "No", "I don't know")
+
+
+def label_token_ids(tokenizer: Any, label: str) -> List[int]:
+    """Returns the ids of the single tokens that decode to label, with or without the leading space of
+    sentencepiece, i.e. the tokens the model may start an answer with to say label.
+
+    Sentencepiece tokenizers may encode "?" or " Yes" as a bare "▁" token followed by the label, so
+    every token of the encodings is checked rather than taking the first one.
+    """
+    candidates = set(tokenizer.encode(label, add_special_tokens=False))
+    candidates.update(tokenizer.encode(" " + label, add_special_tokens=False))
+    for token in (label, "▁" + label):
+        token_id = tokenizer.convert_tokens_to_ids(token)
+        if token_id is not None and token_id != tokenizer.unk_token_id:
+            candidates.add(token_id)
+    token_ids = sorted(token_id for token_id in candidates if tokenizer.decode([token_id]).strip() == label)
+    assert len(token_ids) > 0, f"No token of the tokenizer decodes to {label!r}"
+    return token_ids
+
+
 class LLavaNext:
     def __init__(
         self,
         model_type: str = "llava-hf/llava-v1.6-mistral-7b-hf",
         max_new_tokens=500,
+        max_batch_size: int = 8,
+        prefix_cache_size: int = 4,
+        response_cache: Optional[str] = None,
+        response_cache_mb: float = 512.0,
         device: Optional[Any] = None,
     ) -> None:
         seed_everything(42)
+        self.model_type = model_type
         self.max_new_tokens = max_new_tokens
+        self.max_batch_size = max_batch_size
+        # KV cache of the image prefix of the prompt (vision features included), keyed by image hash
+        self._prefix_cache: "OrderedDict[str, Tuple[torch.Tensor, tuple]]" = OrderedDict()
+        self._prefix_cache_size = prefix_cache_size
+        # decoding is greedy, so the answers to an (image, prompt) pair can be stored on disk and reused across runs
+        self._response_cache = SQLiteCache(response_cache, response_cache_mb) if response_cache else None
         self.processor = LlavaNextProcessor.from_pretrained(model_type)
+        # batched generation needs the padding on the left, so that all the answers start at the same position
+        self.processor.tokenizer.padding_side = "left"
+        if self.processor.tokenizer.pad_token is None:
+            self.processor.tokenizer.pad_token = self.processor.tokenizer.unk_token
+        self._yes_no_idk_token_ids = [
+            label_token_ids(self.processor.tokenizer, label) for label in YES_NO_IDK_LABELS
+        ]
         quantization_config = BitsAndBytesConfig(
             load_in_4bit=True,
             bnb_4bit_quant_type="nf4",
@@ -59,26 +112,13 @@ class LLavaNext:
 
         print(Fore.GREEN + f"Model loaded! with max new tokens {self.max_new_tokens}")
 
-    def ask(
-        self, image: np.ndarray, prompt: Optional[str] = None, return_token_likelihood: Optional[bool] = False
-    ) -> str:
-        """Generates a caption for the given image.
-
-        Args:
-            image (numpy.ndarray): The input image as a numpy array.
-            prompt (str, optional): An optional prompt to provide context and guide
-                the caption generation. Can be used to ask questions about the image.
-
-        Returns:
-            dict: The generated caption.
-
-        """
+    def _build_prompt(self, prompt: str, return_token_likelihood: bool = False) -> str:
+        """Wraps the question into the chat template of the model, with the image placeholder."""
         if return_token_likelihood:
             # the prompt must contains ' You must answer only with Yes, No, or ?=I don't know.'
             if "You must answer only with Yes, No, or ?=I don't know" not in prompt:
                 prompt += " You must answer only with Yes, No, or ?=I don't know."
 
-        image = Image.fromarray(image)
         conversation = [
             {
                 "role": "user",
@@ -88,63 +128,268 @@ class LLavaNext:
                 ],
             },
         ]
+        return self.processor.apply_chat_template(conversation, add_generation_prompt=True)
+
+    def _top_k_likelihood(self, logits: torch.Tensor, top_k: int = 3) -> List[Tuple[str, float]]:
+        """Returns the top-k decoded tokens and their probability given the logits of one timestep."""
+        probs = torch.softmax(logits, dim=-1)
+        topk_scores, topk_indices = torch.topk(probs, top_k)
+        topk_indices = topk_indices.cpu().numpy()
+
+        values_to_be_returned = []
+        for i in range(top_k):
+            decoded: str = self.processor.decode([topk_indices[i]], skip_special_tokens=True)
+            likelihood = round(probs[topk_indices[i]].cpu().item(), 3)
+            values_to_be_returned.append((decoded, likelihood))
+        return values_to_be_returned
+
+    def reset_cache(self) -> None:
+        """Drops the cached image prefixes and frees their GPU memory. The server never
+        needs to call it: the prefixes are keyed by image content and evicted by the LRU."""
+        self._prefix_cache.clear()
+        torch.cuda.empty_cache()
 
-        prompt = self.processor.apply_chat_template(conversation, add_generation_prompt=True)
-        inputs = self.processor(prompt, image, return_tensors="pt").to("cuda:0")
+    def stats(self) -> Dict[str, Any]:
+        """Returns the number of cached image prefixes and the hit/miss counters of the response cache."""
+        stats: Dict[str, Any] = {"prefix_cache_entries": len(self._prefix_cache)}
+        if self._response_cache is not None:
+            stats["response_cache"] = self._response_cache.stats()
+        return stats
+
+    def _cached_responses(
+        self, image: np.ndarray, texts: List[str], mode: str, answer_fn: Callable[[List[str]], List[dict]]
+    ) -> List[dict]:
+        """Returns the responses to the texts about the image, reading them from the response
+        cache when possible. The missing ones are computed together by answer_fn and stored."""
+        if self._response_cache is None:
+            return answer_fn(texts)
+
+        image_id = image_hash(image)
+        keys = [
+            SQLiteCache.make_key(self.model_type, self.max_new_tokens, mode, image_id, text) for text in texts
+        ]
+        responses = [self._response_cache.get(key) for key in keys]
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if len(missing) > 0:
+            for i, response in zip(missing, answer_fn([texts[i] for i in missing])):
+                self._response_cache.put(keys[i], response)
+                responses[i] = response
+        return responses
+
+    def _get_prefix_cache(self, image_id: str, inputs: dict) -> Optional[Tuple[torch.Tensor, tuple]]:
+        """Returns the token ids and the KV cache of the prompt up to the last image token.
+
+        The prefix ([INST] + image tokens) is the same for every question about an image,
+        so it is encoded once (vision tower included) and the following prompts only
+        prefill their question tokens. Returns None if the cache is disabled or if the
+        processor leaves the expansion of the image tokens to the model.
+        """
+        if self._prefix_cache_size <= 0:
+            return None
+        input_ids = inputs["input_ids"][0]
+        image_positions = (input_ids == self.model.config.image_token_index).nonzero()
+        if len(image_positions) <= 1:
+            return None
+        prefix_len = int(image_positions[-1]) + 1
+
+        entry = self._prefix_cache.get(image_id)
+        if entry is not None and torch.equal(entry[0], input_ids[:prefix_len]):
+            self._prefix_cache.move_to_end(image_id)
+            return entry
 
-        # autoregressively complete prompt
-        if not return_token_likelihood:
-            output = self.model.generate(**inputs, max_new_tokens=self.max_new_tokens, do_sample=False)
+        with torch.no_grad():
+            output = self.model(
+                input_ids=inputs["input_ids"][:, :prefix_len].to("cuda:0"),
+                attention_mask=inputs["attention_mask"][:, :prefix_len].to("cuda:0"),
+                pixel_values=inputs["pixel_values"].to("cuda:0"),
+                image_sizes=inputs["image_sizes"].to("cuda:0"),
+                use_cache=True,
+            )
+        past_key_values = output.past_key_values
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+        entry = (input_ids[:prefix_len].clone(), past_key_values)
+        self._prefix_cache[image_id] = entry
+        while len(self._prefix_cache) > self._prefix_cache_size:
+            self._prefix_cache.popitem(last=False)
+        return entry
+
+    def _generate(
+        self, image: np.ndarray, texts: List[str], output_logits: bool, max_new_tokens: Optional[int] = None
+    ) -> Tuple[List[str], Any]:
+        """Greedily answers the chat-formatted texts about the image, as a single batch.
 
-            output = self.processor.decode(output[0], skip_special_tokens=True)
-            output = output.split("[/INST]")[-1].strip()
-            return {"lmm_output": output}
+        Returns:
+            Tuple[List[str], Any]: The decoded answers and, if output_logits, the logits of
+                each generation step (batch first).
+        """
+        pil_image = Image.fromarray(image)
+        first_row = self.processor(texts[0], pil_image, return_tensors="pt")
+        prefix = self._get_prefix_cache(image_hash(image), first_row)
+
+        if prefix is None:
+            inputs = self.processor(
+                text=texts, images=[pil_image] * len(texts), padding=True, return_tensors="pt"
+            ).to("cuda:0")
+            past_key_values = None
         else:
-            # we want to get also the likelihood of the tokens (useful when self-questioning)
+            # [prefix | padding | question]: the questions are left-padded after the shared prefix, the
+            # position ids are derived from the attention mask, so the padding is transparent to the model
+            prefix_ids, prefix_kv = prefix
+            prefix_len = len(prefix_ids)
+            rows = [first_row] + [self.processor(text, pil_image, return_tensors="pt") for text in texts[1:]]
+            questions = [row["input_ids"][0, prefix_len:] for row in rows]
+            width = prefix_len + max(len(question) for question in questions)
+            input_ids = torch.full((len(texts), width), self.processor.tokenizer.pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(texts), width), dtype=torch.long)
+            input_ids[:, :prefix_len] = prefix_ids
+            attention_mask[:, :prefix_len] = 1
+            for i, question in enumerate(questions):
+                input_ids[i, width - len(question) :] = question
+                attention_mask[i, width - len(question) :] = 1
+            inputs = {"input_ids": input_ids.to("cuda:0"), "attention_mask": attention_mask.to("cuda:0")}
+            # the generation appends to new tensors, the cached ones are never modified
+            past_key_values = DynamicCache.from_legacy_cache(
+                tuple(
+                    (key.expand(len(texts), -1, -1, -1), value.expand(len(texts), -1, -1, -1))
+                    for key, value in prefix_kv
+                )
+            )
+
+        output = self.model.generate(
+            **inputs,
+            past_key_values=past_key_values,
+            max_new_tokens=self.max_new_tokens if max_new_tokens is None else max_new_tokens,
+            do_sample=False,
+            output_logits=output_logits,
+            return_dict_in_generate=True,
+            pad_token_id=self.processor.tokenizer.pad_token_id,
+        )
+        # the generated tokens start right after the (common) input length
+        generated = output["sequences"][:, inputs["input_ids"].shape[1] :]
+        answers = [answer.strip() for answer in self.processor.batch_decode(generated, skip_special_tokens=True)]
+        return answers, output["logits"] if output_logits else None
+
+    def _answer(self, image: np.ndarray, texts: List[str], return_token_likelihood: bool) -> List[dict]:
+        """Generates the answers to the chat-formatted texts, in chunks of max_batch_size."""
+        responses = []
+        for start in range(0, len(texts), self.max_batch_size):
+            chunk = texts[start : start + self.max_batch_size]
             # in greedy deconding, logits should be equal to the scores
-            output = self.model.generate(
-                **inputs,
-                max_new_tokens=self.max_new_tokens,
-                do_sample=False,
-                output_logits=True,
-                return_dict_in_generate=True,
+            answers, logits = self._generate(image, chunk, output_logits=return_token_likelihood)
+            for i, answer in enumerate(answers):
+                response = {"lmm_output": answer}
+                if return_token_likelihood:
+                    # we want to get also the likelihood of the tokens (useful when self-questioning)
+                    # answer should only contains one word  -> 'Yes', 'No', or '?', so only the first timestep matters
+                    print(Fore.YELLOW + chunk[i])
+                    print(Fore.GREEN + answer)
+                    response["likelihood"] = self._top_k_likelihood(logits[0][i])
+                responses.append(response)
+        return responses
+
+    def _score(self, image: np.ndarray, texts: List[str]) -> List[dict]:
+        """Scores the chat-formatted Yes/No/? texts, in chunks of max_batch_size."""
+        responses = []
+        for start in range(0, len(texts), self.max_batch_size):
+            chunk = texts[start : start + self.max_batch_size]
+            # a single new token: generate only runs the prefill forward pass
+            _, logits = self._generate(image, chunk, output_logits=True, max_new_tokens=1)
+            first_token_logits = logits[0].float()
+            label_logits = torch.stack(
+                [
+                    torch.logsumexp(first_token_logits[:, token_ids], dim=-1)
+                    for token_ids in self._yes_no_idk_token_ids
+                ],
+                dim=-1,
             )
-            output_decoded = self.processor.decode(output["sequences"][0], skip_special_tokens=True)
-            output_string = output_decoded.split("[/INST]")[-1].strip()
+            probs = torch.softmax(label_logits, dim=-1).cpu()
+            for row in probs:
+                responses.append(
+                    {
+                        "lmm_output": YES_NO_IDK_ANSWERS[int(row.argmax())],
+                        "likelihood": [(label, prob.item()) for label, prob in zip(YES_NO_IDK_LABELS, row)],
+                    }
+                )
+        return responses
 
-            # get the actual likelihood of the tokens
-            # answer should only contains one word  -> 'Yes', 'No', or '?'
+    def ask(
+        self, image: np.ndarray, prompt: Optional[str] = None, return_token_likelihood: Optional[bool] = False
+    ) -> str:
+        """Generates a caption for the given image.
 
-            logits = output["logits"]
-            print(Fore.YELLOW + prompt)
-            print(Fore.GREEN + output_string)
+        Args:
+            image (numpy.ndarray): The input image as a numpy array.
+            prompt (str, optional): An optional prompt to provide context and guide
+                the caption generation. Can be used to ask questions about the image.
 
-            for timestep_t in range(len(logits)):
-                logits_time_t = logits[timestep_t][0]  # -> shape num_vocab
-                logits_time_t = torch.softmax(logits_time_t, dim=-1)
+        Returns:
+            dict: The generated caption.
 
-                # get tokens likelihood
-                top_k = 3
-                topk_scores, topk_indices = torch.topk(logits_time_t, top_k)
-                topk_indices = topk_indices.cpu().numpy()
+        """
+        return self.ask_batch(image, [prompt], return_token_likelihood=return_token_likelihood)[0]
 
-                values_to_be_returned = []
-                for i in range(top_k):
-                    decoded: str = self.processor.decode([topk_indices[i]], skip_special_tokens=True)
-                    likelihood = round(logits_time_t[topk_indices[i]].cpu().item(), 3)
+    def ask_batch(
+        self, image: np.ndarray, prompts: List[str], return_token_likelihood: Optional[bool] = False
+    ) -> List[dict]:
+        """Answers several questions about the same image with batched generation.
 
-                    values_to_be_returned.append((decoded, likelihood))
+        The prompts are padded and decoded together (in chunks of max_batch_size),
+        so the answers cost a single generate call instead of one call per question.
 
-                break
-            return {"lmm_output": output_string, "likelihood": values_to_be_returned}
+        Args:
+            image (numpy.ndarray): The input image as a numpy array.
+            prompts (List[str]): The questions about the image.
+            return_token_likelihood (bool, optional): If True, also return the top-k
+                likelihood of the first generated token of each answer.
+
+        Returns:
+            List[dict]: One {"lmm_output", "likelihood"} dict per prompt, in order,
+                formatted as the output of ask.
+        """
+        texts = [self._build_prompt(prompt, return_token_likelihood) for prompt in prompts]
+        mode = "likelihood" if return_token_likelihood else "generate"
+        return self._cached_responses(
+            image, texts, mode, lambda missing: self._answer(image, missing, return_token_likelihood)
+        )
+
+    def score_yes_no(self, image: np.ndarray, prompts: List[str]) -> List[dict]:
+        """Scores Yes/No/? questions about the image with a single forward pass.
+
+        Instead of generating the answers, only the prompts are prefilled and the logits
+        of the first answer token are restricted to the Yes, No and ? tokens. The softmax
+        over these three is the distribution used to estimate the uncertainty of the answer.
+
+        Args:
+            image (numpy.ndarray): The input image as a numpy array.
+            prompts (List[str]): The Yes/No/? questions about the image.
+
+        Returns:
+            List[dict]: One {"lmm_output", "likelihood"} dict per prompt, where likelihood is
+                [("Yes", p_yes), ("No", p_no), ("?", p_idk)] and lmm_output the most likely answer.
+        """
+        texts = [self._build_prompt(prompt, return_token_likelihood=True) for prompt in prompts]
+        return self._cached_responses(image, texts, "score", lambda missing: self._score(image, missing))
 
 
 class LLavaNextClient:
     def __init__(self, port: int = 12189):
         self.url = f"http://localhost:{port}/llava_next"
 
-    def ask(self, image: np.ndarray, prompt: Optional[str] = None, return_token_likelihood=False) -> str:
+    def stats(self) -> Dict[str, Any]:
+        """Returns the cache counters of the LLaVA server (see LLavaNext.stats)."""
+        return get_stats(self.url)
 
+    def ask(
+        self,
+        image: Union[np.ndarray, ImageId],
+        prompt: Optional[str] = None,
+        return_token_likelihood=False,
+        priority: int = PRIORITY_NORMAL,
+    ) -> str:
+        """Asks the LLaVA server about the image. Requests with a lower priority value
+        (see PRIORITY_HIGH/NORMAL/LOW in server_wrapper) are served first when the
+        server is busy."""
         if prompt is None:
             prompt = "Describe the image in detail, also with details from its surroundings."
         with torch.no_grad():
@@ -153,6 +398,7 @@ class LLavaNextClient:
                 image=image,
                 prompt=prompt,
                 return_token_likelihood=return_token_likelihood,
+                priority=priority,
                 request_timeout=15,
             )
         torch.cuda.empty_cache()
@@ -162,42 +408,104 @@ class LLavaNextClient:
         else:
             return response["response"]["lmm_output"], None
 
+    def score_yes_no(
+        self,
+        image: Union[np.ndarray, ImageId],
+        prompts: List[str],
+        priority: int = PRIORITY_NORMAL,
+    ) -> List[Tuple[str, list]]:
+        """Scores Yes/No/? questions about the same image without generating the answers.
+
+        Returns:
+            List[Tuple[str, list]]: (answer, [("Yes", p), ("No", p), ("?", p)]) for each prompt.
+        """
+        with torch.no_grad():
+            response = send_request(
+                self.url,
+                image=image,
+                prompts=list(prompts),
+                score_yes_no=True,
+                priority=priority,
+                request_timeout=15,
+            )
+        torch.cuda.empty_cache()
+        return [(answer["lmm_output"], answer["likelihood"]) for answer in response["response"]]
+
+    def ask_batch(
+        self,
+        image: Union[np.ndarray, ImageId],
+        prompts: List[str],
+        return_token_likelihood=False,
+        priority: int = PRIORITY_NORMAL,
+    ) -> List[Tuple[str, Optional[list]]]:
+        """Asks several questions about the same image in a single request. The image is
+        sent once and the server answers all the prompts with one batched generation.
+
+        Returns:
+            List[Tuple[str, Optional[list]]]: (answer, likelihood) for each prompt, as
+                returned by ask.
+        """
+        with torch.no_grad():
+            response = send_request(
+                self.url,
+                image=image,
+                prompts=list(prompts),
+                return_token_likelihood=return_token_likelihood,
+                priority=priority,
+                request_timeout=15,
+            )
+        torch.cuda.empty_cache()
+        return [
+            (answer["lmm_output"], answer["likelihood"] if return_token_likelihood else None)
+            for answer in response["response"]
+        ]
+
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, default=8070)
+    parser.add_argument("--max-queue-depth", type=int, default=32)
+    parser.add_argument(
+        "--response-cache",
+        type=str,
+        default=None,
+        help="SQLite file storing the answers across runs (e.g. cache/llava_responses.sqlite)",
+    )
+    parser.add_argument("--response-cache-mb", type=float, default=512.0)
     args = parser.parse_args()
     seed_everything(42)
     print("Loading model...")
 
     class LLavaNextServer(ServerMixin, LLavaNext):
-
-        def __init__(self, *args, **kwargs):
-            super().__init__(*args, **kwargs)
-            self.is_busy = False
-
+        # Requests are serialized by the priority queue of host_model, so oracle answers
+        # and false-positive checks overtake long descriptions when the server is busy
         def process_payload(self, payload: dict) -> dict:
-            if self.is_busy:
-                return jsonify({"error": "Server is busy"}), 503  # Return HTTP 503 (Service Unavailable)
-
-            self.is_busy = True
-            try:
-                image = str_to_image(payload["image"])
-                response = {
-                    "response": self.ask(
+            image = str_to_image(payload["image"])
+            if payload.get("score_yes_no", False):
+                return {"response": self.score_yes_no(image, payload["prompts"])}
+            if "prompts" in payload:
+                return {
+                    "response": self.ask_batch(
                         image,
-                        prompt=payload.get("prompt"),
+                        payload["prompts"],
                         return_token_likelihood=payload.get("return_token_likelihood", False),
                     )
                 }
-            finally:
-                self.is_busy = False
+            response = {
+                "response": self.ask(
+                    image,
+                    prompt=payload.get("prompt"),
+                    return_token_likelihood=payload.get("return_token_likelihood", False),
+                )
+            }
             return response
 
     model_name = "llava-hf/llava-v1.6-mistral-7b-hf"
-    llava = LLavaNextServer(model_type=model_name)
+    llava = LLavaNextServer(
+        model_type=model_name, response_cache=args.response_cache, response_cache_mb=args.response_cache_mb
+    )
     print(f"Model - {model_name} loaded!")
     print(f"Hosting on port {args.port}...")
-    host_model(llava, name="llava_next", port=args.port)
+    host_model(llava, name="llava_next", port=args.port, max_queue_depth=args.max_queue_depth)
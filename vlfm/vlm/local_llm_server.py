@@ -0,0 +1,153 @@
+"""Local stand-in for an OpenAI-compatible chat completion API.
+
+It answers every request with a deterministic echo of the prompt and enforces per-key
+requests/tokens per minute limits, answering 429 like the real providers, so the LLM
+client can be exercised without API spend, e.g.:
+
+    python -m vlfm.vlm.local_llm_server --port 12190 --rpm 10 --tpm 20000
+    COIN_LLM_CLIENT_KEY_1=key1 COIN_LLM_CLIENT_KEY_2=key2 python -m vlfm.vlm.openai_llm \
+        --base-url http://localhost:12190/v1 --model local
+"""
+
+import json
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, Iterator, Optional, Tuple
+
+from flask import Flask, Response, jsonify, request
+
+
+class _RateLimiter:
+    """Sliding one-minute window of the requests and tokens of each API key."""
+
+    def __init__(self, rpm: int, tpm: int) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self._history: Dict[str, Deque[Tuple[float, int]]] = defaultdict(deque)
+        self._lock = threading.Lock()
+
+    def admit(self, api_key: str, tokens: int) -> float:
+        """Records the request and returns 0, or returns the seconds to wait if it exceeds the limits."""
+        with self._lock:
+            now = time.time()
+            history = self._history[api_key]
+            while len(history) > 0 and history[0][0] <= now - 60.0:
+                history.popleft()
+            used_tokens = sum(count for _, count in history)
+            if len(history) + 1 > self.rpm or used_tokens + tokens > self.tpm:
+                return max(0.1, history[0][0] + 60.0 - now) if len(history) > 0 else 1.0
+            history.append((now, tokens))
+            return 0.0
+
+
+def _stream_chunks(
+    completion_id: str, model: str, content: str, usage: Optional[dict] = None, chunk_size: int = 16
+) -> Iterator[str]:
+    """Yields the answer as server-sent events, like the streaming chat completion API. The usage, if
+    given, is sent in a last chunk without choices, as with stream_options={"include_usage": True}."""
+    chunk: Dict[str, Any] = {"id": completion_id, "object": "chat.completion.chunk", "model": model}
+    for start in range(0, len(content) + 1, chunk_size):
+        delta = {"content": content[start : start + chunk_size]} if start < len(content) else {}
+        chunk["created"] = int(time.time())
+        chunk["choices"] = [{"index": 0, "delta": delta, "finish_reason": None if delta else "stop"}]
+        yield f"data: {json.dumps(chunk)}\n\n"
+    if usage is not None:
+        yield f"data: {json.dumps(dict(chunk, choices=[], usage=usage))}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def host_local_llm(
+    port: int = 12190,
+    rpm: int = 30,
+    tpm: int = 60000,
+    latency_ms: float = 0.0,
+    jitter_ms: float = 0.0,
+    reject_stream_options: bool = False,
+) -> None:
+    """Hosts the stand-in chat completion API on http://localhost:<port>/v1.
+
+    Args:
+        port (int): The port to listen on.
+        rpm (int): Requests per minute allowed for each API key.
+        tpm (int): Tokens per minute allowed for each API key (prompt + completion).
+        latency_ms (float): Base latency of every answer.
+        jitter_ms (float): Random latency added on top of latency_ms, to simulate slow tails.
+        reject_stream_options (bool): Answer 400 to requests with stream_options, like some
+            OpenAI-compatible servers.
+    """
+    app = Flask(__name__)
+    limiter = _RateLimiter(rpm, tpm)
+
+    @app.route("/v1/chat/completions", methods=["POST"])
+    def chat_completions() -> dict:
+        payload = request.get_json()
+        if reject_stream_options and "stream_options" in payload:
+            return jsonify({"error": {"message": "Unknown parameter: stream_options", "type": "invalid_request"}}), 400
+        api_key = request.headers.get("Authorization", "").replace("Bearer ", "")
+        prompt = payload["messages"][-1]["content"]
+        content = f"Echo: {prompt}"[: 4 * payload.get("max_tokens", 1500)]
+        stop_sequences = payload.get("stop") or []
+        if isinstance(stop_sequences, str):
+            stop_sequences = [stop_sequences]
+        for stop in stop_sequences:
+            if stop in content:
+                content = content[: content.index(stop)]
+        prompt_tokens = sum(len(message["content"]) for message in payload["messages"]) // 4
+        completion_tokens = len(content) // 4
+
+        retry_after = limiter.admit(api_key, prompt_tokens + completion_tokens)
+        if retry_after > 0:
+            response = jsonify(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+            )
+            response.headers["Retry-After"] = f"{retry_after:.2f}"
+            return response, 429
+
+        time.sleep((latency_ms + random.random() * jitter_ms) / 1000.0)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        if payload.get("stream", False):
+            include_usage = (payload.get("stream_options") or {}).get("include_usage", False)
+            chunks = _stream_chunks(completion_id, payload["model"], content, usage if include_usage else None)
+            return Response(chunks, mimetype="text/event-stream")
+        return jsonify(
+            {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": payload["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": usage,
+            }
+        )
+
+    app.run(host="localhost", port=port, threaded=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=12190)
+    parser.add_argument("--rpm", type=int, default=30)
+    parser.add_argument("--tpm", type=int, default=60000)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--reject-stream-options", action="store_true")
+    args = parser.parse_args()
+
+    print(f"Hosting a local OpenAI-compatible API on port {args.port}...")
+    host_local_llm(args.port, args.rpm, args.tpm, args.latency_ms, args.jitter_ms, args.reject_stream_options)
@@ -1,25 +1,339 @@
 import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+
+import numpy as np
 from colorama import Fore
 from colorama import init as init_colorama
 from openai import OpenAI
 
 init_colorama(autoreset=True)
 from retrying import retry
-from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from openai import APIConnectionError, APITimeoutError, BadRequestError, InternalServerError, RateLimitError
+
+from vlfm.utils.sqlite_cache import SQLiteCache
+
+
+class RateLimitExhaustedError(Exception):
+    """Raised when all the API keys of the endpoints stay rate limited for longer than the client may wait."""
+
+
+class _TokenBucket:
+    """Budget of capacity units per minute, refilled continuously. A capacity of None means no limit."""
+
+    def __init__(self, capacity: Optional[float]) -> None:
+        self.capacity = capacity
+        self.level = capacity or 0.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def headroom(self, now: float) -> float:
+        """Fraction of the budget currently available."""
+        if self.capacity is None:
+            return 1.0
+        self._refill(now)
+        return self.level / self.capacity
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until amount units are available."""
+        if self.capacity is None:
+            return 0.0
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing * 60.0 / self.capacity)
+
+    def consume(self, amount: float, now: float) -> None:
+        if self.capacity is not None:
+            self._refill(now)
+            self.level -= amount
+
+    def refund(self, amount: float) -> None:
+        """Gives back units that were consumed but not used; a negative amount consumes the overrun."""
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class _APIKey:
+    """Client of one API key, with its requests and tokens per minute budgets."""
+
+    def __init__(self, client: OpenAI, rpm: Optional[float], tpm: Optional[float]) -> None:
+        self.client = client
+        self.requests = _TokenBucket(rpm)
+        self.tokens = _TokenBucket(tpm)
+        self.cooldown_until = 0.0  # set when the provider rate-limits the key anyway
+        self.last_used = 0.0
+
+    def wait_time(self, tokens: float, now: float) -> float:
+        return max(self.cooldown_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+
+    def headroom(self, now: float) -> float:
+        return min(self.requests.headroom(now), self.tokens.headroom(now))
+
+
+def _retry_after(error: RateLimitError, default: float = 10.0) -> float:
+    """Returns the Retry-After of a rate limit error, in seconds."""
+    try:
+        return float(error.response.headers.get("retry-after", default))
+    except (AttributeError, TypeError, ValueError):
+        return default
+
+
+class _Endpoint:
+    """One OpenAI-compatible endpoint (base url + model), with its API keys and a rolling latency estimate."""
+
+    # how long an endpoint whose call failed is tried after the others
+    failure_cooldown_s: float = 30.0
+
+    def __init__(self, params: dict, rpm: Optional[float], tpm: Optional[float], latency_window: int = 50) -> None:
+        params = dict(params)
+        self.model = params.pop("model", "gpt-4o")
+        api_key_prefix = params.pop("api_key_prefix", "COIN_LLM_CLIENT_KEY")
+        self.name = f"{self.model}@{params.get('base_url', 'openai')}"
+
+        self.api_keys = [value for key, value in os.environ.items() if key.startswith(api_key_prefix)]
+        # one client per key, each call goes to the key with the most headroom in its rate limits
+        self.keys: List[_APIKey] = [
+            _APIKey(OpenAI(**dict(params, api_key=api_key)), rpm, tpm)
+            for api_key in (self.api_keys if self.api_keys else [None])
+        ]
+        # parallel workers do not all start from the same key
+        random.shuffle(self.keys)
+        self.latencies: Deque[float] = deque(maxlen=latency_window)
+        # completion tokens of the recent calls, to reserve what a call is likely to use rather than max_tokens
+        self.completion_tokens: Deque[int] = deque(maxlen=latency_window)
+        self.usage = {"calls": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0, "completion_tokens": 0}
+        self.failing_until = 0.0
+        # asks streams for their usage, until the endpoint rejects stream_options
+        self.stream_usage = True
+        self._lock = threading.Lock()
+
+    def is_failing(self) -> bool:
+        """Whether a call to the endpoint failed (other than being rate limited) in the last failure_cooldown_s."""
+        return time.monotonic() < self.failing_until
+
+    def latency_quantile(self, quantile: float) -> Optional[float]:
+        """Returns the quantile of the recent latencies, None until enough calls were measured."""
+        with self._lock:
+            if len(self.latencies) < 5:
+                return None
+            return float(np.quantile(self.latencies, quantile))
+
+    def _acquire_key(self, tokens: int, deadline: float) -> _APIKey:
+        """Returns the key with the most headroom that can serve the request, waiting if all are exhausted."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                ready = [key for key in self.keys if key.wait_time(tokens, now) == 0.0]
+                if len(ready) > 0:
+                    # the least recently used key breaks ties, e.g. when no rate limits are set
+                    key = max(ready, key=lambda key: (key.headroom(now), -key.last_used))
+                    key.requests.consume(1, now)
+                    key.tokens.consume(tokens, now)
+                    key.last_used = now
+                    return key
+                wait = min(key.wait_time(tokens, now) for key in self.keys)
+            if now + wait > deadline:
+                print(Fore.RED + f"[ERROR] All the API keys of {self.name} are rate limited for the next {wait:.1f}s")
+                raise RateLimitExhaustedError(f"All the API keys of {self.name} are rate limited")
+            time.sleep(wait)
+
+    def complete(self, request: dict, max_wait_s: float, stream: bool = False) -> str:
+        request = dict(request, model=self.model)
+        with self._lock:
+            expected_completion_tokens = (
+                int(np.mean(self.completion_tokens)) if len(self.completion_tokens) > 0 else None
+            )
+        estimated_tokens = _estimate_tokens(request, expected_completion_tokens)
+        deadline = time.monotonic() + max_wait_s
+        while True:
+            key = self._acquire_key(estimated_tokens, deadline)
+            start_time = time.monotonic()
+            try:
+                if stream:
+                    content, usage = self._stream(key.client, request)
+                else:
+                    completion = key.client.chat.completions.create(**request)
+                    content, usage = completion.choices[0].message.content, getattr(completion, "usage", None)
+            except RateLimitError as e:
+                print(Fore.RED + "[ERROR] Rate Limit Error")
+                print(Fore.RED + f"[ERROR] {e}")
+                with self._lock:
+                    key.cooldown_until = time.monotonic() + _retry_after(e)
+                continue
+            except Exception:
+                # nothing (or only part of the answer) was billed: give the reservation back, and route the next
+                # calls elsewhere first, since a failing endpoint answers fast and would keep a low median latency
+                with self._lock:
+                    key.tokens.refund(estimated_tokens)
+                    self.failing_until = time.monotonic() + self.failure_cooldown_s
+                raise
+
+            with self._lock:
+                self.latencies.append(time.monotonic() - start_time)
+                if usage is not None and usage.total_tokens is not None:
+                    key.tokens.refund(estimated_tokens - usage.total_tokens)
+                elif stream:
+                    # the stream was closed at a stop sequence, before its usage chunk: settle with the
+                    # tokens that were read
+                    key.tokens.refund(estimated_tokens - _estimate_tokens(request, len(content) // 4))
+                if usage is not None and usage.completion_tokens is not None:
+                    self.completion_tokens.append(usage.completion_tokens)
+                self._account_usage(usage)
+            return _close_yaml_block(content, request)
+
+    def _stream(self, client: OpenAI, request: dict) -> Tuple[str, Any]:
+        """Streams the completion with _stream_until_stop, asking for the usage unless the endpoint does not
+        support it."""
+        if self.stream_usage:
+            try:
+                return _stream_until_stop(client, request, include_usage=True)
+            except BadRequestError as e:
+                # many OpenAI-compatible servers that ignore stop also reject stream_options
+                print(Fore.YELLOW + f"[INFO] {self.name} rejected stream_options, streaming without usage: {e}")
+                self.stream_usage = False
+        return _stream_until_stop(client, request, include_usage=False)
+
+    def _account_usage(self, usage: Any) -> None:
+        """Adds the prompt, cached prompt and completion tokens of a call to the totals, and prints them."""
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+        prompt_tokens = usage.prompt_tokens or 0
+        self.usage["calls"] += 1
+        self.usage["prompt_tokens"] += prompt_tokens
+        self.usage["cached_prompt_tokens"] += cached_tokens
+        self.usage["completion_tokens"] += usage.completion_tokens or 0
+        hit_rate = self.usage["cached_prompt_tokens"] / max(1, self.usage["prompt_tokens"])
+        print(
+            Fore.CYAN
+            + f"[INFO: LLM] {self.name}: {prompt_tokens} prompt tokens ({cached_tokens} cached), "
+            + f"{usage.completion_tokens} completion tokens. Cached so far: {hit_rate:.0%}"
+        )
+
+
+def _stream_until_stop(client: OpenAI, request: dict, include_usage: bool = False) -> Tuple[str, Any]:
+    """Streams the completion and closes the stream as soon as one of the stop sequences of the request
+    appears, for the providers that ignore them.
+
+    Returns the content and, with include_usage, the usage sent in the last chunk of the stream (None if
+    the stream was closed before it or the usage was not asked for)."""
+    stop_sequences = request.get("stop") or []
+    content = ""
+    usage = None
+    options = {"stream_options": {"include_usage": True}} if include_usage else {}
+    stream = client.chat.completions.create(**request, stream=True, **options)
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            if len(chunk.choices) == 0 or not chunk.choices[0].delta.content:
+                continue
+            delta = chunk.choices[0].delta.content
+            content += delta
+            for stop in stop_sequences:
+                # only the tail can contain a stop sequence that was not there before
+                position = content.find(stop, max(0, len(content) - len(delta) - len(stop)))
+                if position != -1:
+                    return content[:position], usage
+    finally:
+        stream.close()
+    return content, usage
+
+
+def _close_yaml_block(content: str, request: dict) -> str:
+    """Appends back the YAML_END tag that the stop sequence removed from the answer."""
+    stop_sequences = request.get("stop") or []
+    if "YAML_END" in stop_sequences and "YAML_START" in content and "YAML_END" not in content:
+        content += "\nYAML_END"
+    return content
+
+
+def _estimate_tokens(request: dict, expected_completion_tokens: Optional[int] = None) -> int:
+    """Estimate of the tokens billed for the request, ~4 characters per prompt token. The completion is
+    counted as expected_completion_tokens (capped by max_tokens), or as max_tokens if unknown; the
+    difference is settled once the actual usage is known."""
+    prompt_chars = sum(len(message["content"]) for message in request["messages"])
+    max_tokens = request.get("max_tokens", 0)
+    if expected_completion_tokens is None:
+        return prompt_chars // 4 + max_tokens
+    return prompt_chars // 4 + min(max_tokens, expected_completion_tokens)
 
 
 class OpenAILLMClient:
-    def __init__(self, llm_client_params) -> None:
+    def __init__(self, llm_client_params: Union[dict, List[dict]]) -> None:
+        """llm_client_params holds the arguments of the OpenAI client (model, base_url, ...). A list of
+        them routes the calls across several endpoints: each call goes to the fastest one, and is
+        duplicated to the next fastest when it takes longer than the p95 latency of its endpoint.
+        Each endpoint reads its keys from the env vars starting with its api_key_prefix
+        (default COIN_LLM_CLIENT_KEY)."""
         print(Fore.YELLOW + f"[INFO] Initializing OpenAI LLM")
 
-        all_env_vars = os.environ
+        if isinstance(llm_client_params, dict):
+            llm_client_params = [llm_client_params]
+        # client-side rate limits per key, off unless set: the provider's 429s are handled either way
+        rpm = float(os.environ["COIN_LLM_RPM"]) if "COIN_LLM_RPM" in os.environ else None
+        tpm = float(os.environ["COIN_LLM_TPM"]) if "COIN_LLM_TPM" in os.environ else None
+        self.max_wait_s = float(os.environ.get("COIN_LLM_MAX_WAIT_S", "120"))
+        # deadline of the calls to endpoints without enough latency measurements yet
+        self.default_hedge_s = float(os.environ.get("COIN_LLM_HEDGE_S", "15"))
+        # stream the answers and stop reading them at the stop sequences, for providers that do not support them
+        self.stream = os.environ.get("COIN_LLM_STREAM", "0") == "1"
+        self._endpoints = [_Endpoint(params, rpm, tpm) for params in llm_client_params]
+        self._executor = ThreadPoolExecutor(max_workers=4 * len(self._endpoints))
 
-        self.api_keys = [value for key, value in all_env_vars.items() if key.startswith("COIN_LLM_CLIENT_KEY")]
-        llm_client_params["api_key"] = self.api_keys[0] if self.api_keys else None
-        self.model = llm_client_params.get("model", "gpt-4o")
-        del llm_client_params["model"]
+        self.model = self._endpoints[0].model
+        self.api_keys = self._endpoints[0].api_keys
+        self.client = self._endpoints[0].keys[0].client
+        limits = f"{rpm or 'unlimited'} RPM, {tpm or 'unlimited'} TPM"
+        for endpoint in self._endpoints:
+            print(Fore.YELLOW + f"[INFO] {endpoint.name}: {len(endpoint.keys)} key(s), {limits}")
 
-        self.client = OpenAI(**llm_client_params)
+    def build_request(
+        self,
+        prompt: str,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        response_format: Optional[dict] = None,
+        system: Optional[str] = None,
+    ) -> dict:
+        """Returns the arguments of the chat completion for the prompt: model, messages and sampling params.
+
+        Args:
+            prompt (str): The user prompt.
+            max_tokens (int, optional): Cap of the generated tokens, 1500 by default.
+            stop (List[str], optional): Sequences that end the generation (e.g. ["YAML_END"]).
+            response_format (dict, optional): Structured output format (e.g. a JSON schema), if the
+                provider supports it.
+            system (str, optional): Static instructions, sent first as the system message so that the
+                providers with prefix caching reuse them across calls; prompt then holds only the
+                variable part.
+        """
+        preamble = "You are an useful and helpful assistant. You are also concise. Use at most 300 words per answer."
+        if system is None:
+            messages = [{"role": "assistant", "content": preamble}, {"role": "user", "content": prompt}]
+        else:
+            messages = [{"role": "system", "content": f"{preamble}\n{system}"}, {"role": "user", "content": prompt}]
+        request = dict(
+            model=self.model,
+            messages=messages,
+            top_p=1,
+            max_tokens=1500 if max_tokens is None else max_tokens, #3000,
+            seed=42,
+        )
+        if stop is not None:
+            request["stop"] = list(stop)
+        if response_format is not None:
+            request["response_format"] = response_format
+        return request
 
     @retry(
         retry_on_exception=(
@@ -31,29 +345,113 @@ class OpenAILLMClient:
         stop_max_attempt_number=1,
         wait_fixed=6000,
     )
-    def ask(self, prompt: str) -> str:
-        try:
-            completion = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {   "role": "assistant",
-                        "content": "You are an useful and helpful assistant. You are also concise. Use at most 300 words per answer."
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt,
-                    }
-                ],
-                top_p=1,
-                max_tokens=1500, #3000,
-                seed=42,
-            )
-            return completion.choices[0].message.content
+    def ask(
+        self,
+        prompt: str,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        stream: Optional[bool] = None,
+        response_format: Optional[dict] = None,
+        system: Optional[str] = None,
+    ) -> str:
+        """Answers the prompt. See build_request for the generation params; stream overrides COIN_LLM_STREAM."""
+        request = self.build_request(
+            prompt, max_tokens=max_tokens, stop=stop, response_format=response_format, system=system
+        )
+        return self.complete(request, stream=stream)
+
+    def complete(self, request: dict, stream: Optional[bool] = None) -> str:
+        """Runs the chat completion built by build_request and returns the content of the answer.
 
-        except RateLimitError as e:
-            print(Fore.RED + "[ERROR] Rate Limit Error")
-            print(Fore.RED + f"[ERROR] {e}")
-            raise Exception("retry")
+        The request goes to the endpoint with the lowest median latency. If no answer arrives
+        within the p95 latency of that endpoint, a hedged duplicate is sent to the next fastest
+        endpoint, and so on; the first answer wins.
+        """
+        stream = self.stream if stream is None else stream
+        if len(self._endpoints) == 1:
+            return self._endpoints[0].complete(request, self.max_wait_s, stream)
+
+        # endpoints without measurements come first, so that every endpoint gets measured, and the ones that
+        # failed recently come last
+        endpoints = sorted(
+            self._endpoints, key=lambda endpoint: (endpoint.is_failing(), endpoint.latency_quantile(0.5) or 0.0)
+        )
+        pending = set()
+        error: Optional[BaseException] = None
+        for i, endpoint in enumerate(endpoints):
+            pending.add(self._executor.submit(endpoint.complete, request, self.max_wait_s, stream))
+            is_last = i == len(endpoints) - 1
+            hedge_deadline = time.monotonic() + (endpoint.latency_quantile(0.95) or self.default_hedge_s)
+            while len(pending) > 0:
+                timeout = None if is_last else max(0.0, hedge_deadline - time.monotonic())
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        # the slower calls still complete in background, which keeps their latency up to date
+                        return future.result()
+                    error = future.exception()
+                if len(done) == 0 or (len(pending) == 0 and not is_last):
+                    # over the deadline (or failed): hedge with the next endpoint
+                    if not is_last:
+                        print(Fore.YELLOW + f"[INFO] {endpoint.name} is late, hedging with {endpoints[i + 1].name}")
+                    break
+        raise error if error is not None else RateLimitExhaustedError("No endpoint answered")
+
+    def usage_stats(self) -> Dict[str, Dict[str, int]]:
+        """Returns the token usage of each endpoint: calls, prompt, cached prompt and completion tokens."""
+        return {endpoint.name: dict(endpoint.usage) for endpoint in self._endpoints}
+
+
+class ReplayMissError(Exception):
+    """Raised in replay mode when a request was never recorded."""
+
+
+class RecordReplayLLMClient:
+    """Content-addressed request/response store in front of an OpenAILLMClient.
+
+    Requests are keyed by model, messages and sampling params (see OpenAILLMClient.build_request).
+    Modes:
+        record: always call the API and store (or overwrite) the answer.
+        replay: only answer from the store, a request that was never recorded raises ReplayMissError.
+        record-missing: answer from the store when possible, call the API and store the answer otherwise.
+    """
+
+    MODES = ("record", "replay", "record-missing")
+
+    def __init__(self, llm_client: OpenAILLMClient, path: str, mode: str = "record-missing") -> None:
+        assert mode in self.MODES, f"Unknown record/replay mode {mode}, expected one of {self.MODES}"
+        self.llm_client = llm_client
+        self.mode = mode
+        # recordings are not a cache of convenience: keep them unless they grow really large
+        self.store = SQLiteCache(path, max_size_mb=4096.0)
+        print(Fore.YELLOW + f"[INFO] LLM answers are in {mode} mode, store: {path}")
+
+    def ask(
+        self,
+        prompt: str,
+        max_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        stream: Optional[bool] = None,
+        response_format: Optional[dict] = None,
+        system: Optional[str] = None,
+    ) -> str:
+        request = self.llm_client.build_request(
+            prompt, max_tokens=max_tokens, stop=stop, response_format=response_format, system=system
+        )
+        key = SQLiteCache.make_key(request)
+        if self.mode != "record":
+            response = self.store.get(key)
+            if response is not None:
+                return response
+            if self.mode == "replay":
+                raise ReplayMissError(f"No recorded answer for prompt: {prompt[:200]}")
+
+        response = self.llm_client.complete(request, stream=stream)
+        self.store.put(key, response)
+        return response
+
+    def stats(self) -> dict:
+        return self.store.stats()
 
 
 if __name__ == "__main__":
@@ -62,9 +460,22 @@ if __name__ == "__main__":
     # you can also use Groq for testing, otherwise it will use OpenAI
     ### make sure to set the environment variable LLM_CLIENT_KEY (inside .env.llm_client_key) to either your OpenAI API key or groq API key
     # If using Groq, register here for a free api (https://groq.com/)
+    # To exercise the multi-key dispatcher without API spend, start the local stand-in server
+    # (python -m vlfm.vlm.local_llm_server) and pass --base-url http://localhost:12190/v1 --num-requests 50.
+    # Several base urls (e.g. two local servers with different --latency-ms) exercise the hedged routing.
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", type=str, nargs="+", default=None)
+    parser.add_argument("--model", type=str, default=None)
+    parser.add_argument("--num-requests", type=int, default=1)
+    args = parser.parse_args()
+
     test_with_groq = True
 
-    if test_with_groq:
+    if args.base_url is not None:
+        llm_client_params = [{"model": args.model or "local", "base_url": base_url} for base_url in args.base_url]
+    elif test_with_groq:
         llm_client_params = {
             "model": "qwen-3-235b-a22b-instruct-2507", # "gpt-oss-120b", # "llama-3.3-70b-versatile",
             "base_url": "https://api.cerebras.ai/v1",
@@ -77,5 +488,8 @@ if __name__ == "__main__":
     llm_client = OpenAILLMClient(llm_client_params)
 
     prompt = "What is the capital of France?"
-    response = llm_client.ask(prompt)
-    print(Fore.GREEN + f"Response: {response}")
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = list(executor.map(llm_client.ask, [prompt] * args.num_requests))
+    print(Fore.GREEN + f"Response: {responses[0]}")
+    print(Fore.GREEN + f"{args.num_requests} requests in {time.time() - start_time:.1f}s")
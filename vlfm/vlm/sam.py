@@ -1,17 +1,19 @@
 # Copyright (c) 2023 Boston Dynamics AI Institute LLC. All rights reserved.
 
 import os
-from typing import Any, List, Optional
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple
 
 import numpy as np
 import torch
 
 from .server_wrapper import (
     ServerMixin,
-    bool_arr_to_str,
     host_model,
+    image_hash,
+    mask_to_packed_roi,
+    packed_roi_to_mask,
     send_request,
-    str_to_bool_arr,
     str_to_image,
 )
 
@@ -27,6 +29,7 @@ class MobileSAM:
         sam_checkpoint: str,
         model_type: str = "vit_t",
         device: Optional[Any] = None,
+        embedding_cache_size: int = 4,
     ) -> None:
         if device is None:
             device = torch.device("cuda") if torch.cuda.is_available() else "cpu"
@@ -37,6 +40,32 @@ class MobileSAM:
         mobile_sam.eval()
         self.predictor = SamPredictor(mobile_sam)
 
+        # Image embeddings of the last few images, keyed by image hash, so that
+        # follow-up requests on the same frame skip the image encoder
+        self._embedding_cache: "OrderedDict[str, Tuple[Any, Any, Any]]" = OrderedDict()
+        self._embedding_cache_size = embedding_cache_size
+
+    def _set_image(self, image: np.ndarray) -> None:
+        """Sets the image of the predictor, reusing a cached embedding if possible."""
+        image_id = image_hash(image)
+        if image_id in self._embedding_cache:
+            self._embedding_cache.move_to_end(image_id)
+            features, original_size, input_size = self._embedding_cache[image_id]
+            self.predictor.features = features
+            self.predictor.original_size = original_size
+            self.predictor.input_size = input_size
+            self.predictor.is_image_set = True
+            return
+
+        self.predictor.set_image(image)
+        self._embedding_cache[image_id] = (
+            self.predictor.features,
+            self.predictor.original_size,
+            self.predictor.input_size,
+        )
+        while len(self._embedding_cache) > self._embedding_cache_size:
+            self._embedding_cache.popitem(last=False)
+
     def segment_bbox(self, image: np.ndarray, bbox: List[int]) -> np.ndarray:
         """Segments the object in the given bounding box from the image.
 
@@ -51,11 +80,35 @@ class MobileSAM:
 
         """
         with torch.inference_mode():
-            self.predictor.set_image(image)
+            self._set_image(image)
             masks, _, _ = self.predictor.predict(box=np.array(bbox), multimask_output=False)
 
         return masks[0]
 
+    def segment_bboxes(self, image: np.ndarray, bboxes: List[List[int]]) -> np.ndarray:
+        """Segments the objects in all the given bounding boxes from the image. The image
+        is encoded once and all boxes are decoded as one batch.
+
+        Args:
+            image (numpy.ndarray): The input image as a numpy array.
+            bboxes (List[List[int]]): The bounding boxes, each in the format
+                [x1, y1, x2, y2].
+
+        Returns:
+            np.ndarray: The boolean masks of the objects, with shape (N, H, W).
+        """
+        if len(bboxes) == 0:
+            return np.zeros((0, *image.shape[:2]), dtype=bool)
+        with torch.inference_mode():
+            self._set_image(image)
+            boxes = torch.as_tensor(bboxes, dtype=torch.float, device=self.predictor.device)
+            boxes = self.predictor.transform.apply_boxes_torch(boxes, self.predictor.original_size)
+            masks, _, _ = self.predictor.predict_torch(
+                point_coords=None, point_labels=None, boxes=boxes, multimask_output=False
+            )
+
+        return masks[:, 0].cpu().numpy()
+
 
 class MobileSAMClient:
     def __init__(self, port: int = 12183):
@@ -63,11 +116,16 @@ class MobileSAMClient:
 
     def segment_bbox(self, image: np.ndarray, bbox: List[int]) -> np.ndarray:
         response = send_request(self.url, image=image, bbox=bbox)
-        cropped_mask_str = response["cropped_mask"]
-        cropped_mask = str_to_bool_arr(cropped_mask_str, shape=tuple(image.shape[:2]))
+        cropped_mask = packed_roi_to_mask(response["cropped_mask"], shape=tuple(image.shape[:2]))
 
         return cropped_mask
 
+    def segment_bboxes(self, image: np.ndarray, bboxes: List[List[int]]) -> List[np.ndarray]:
+        if len(bboxes) == 0:
+            return []
+        response = send_request(self.url, image=image, bboxes=bboxes)
+        return [packed_roi_to_mask(m, shape=tuple(image.shape[:2])) for m in response["cropped_masks"]]
+
 
 if __name__ == "__main__":
     import argparse
@@ -81,9 +139,14 @@ if __name__ == "__main__":
     class MobileSAMServer(ServerMixin, MobileSAM):
         def process_payload(self, payload: dict) -> dict:
             image = str_to_image(payload["image"])
+            if "bboxes" in payload:
+                cropped_masks = self.segment_bboxes(image, payload["bboxes"])
+                return {"cropped_masks": [mask_to_packed_roi(cropped_mask) for cropped_mask in cropped_masks]}
             cropped_mask = self.segment_bbox(image, payload["bbox"])
-            cropped_mask_str = bool_arr_to_str(cropped_mask)
-            return {"cropped_mask": cropped_mask_str}
+            return {"cropped_mask": mask_to_packed_roi(cropped_mask)}
+
+        def warmup(self) -> None:
+            self.segment_bbox(np.zeros((480, 640, 3), dtype=np.uint8), [100, 100, 200, 200])
 
     mobile_sam = MobileSAMServer(sam_checkpoint=os.environ.get("MOBILE_SAM_CHECKPOINT", "data/mobile_sam.pt"))
     print("Model loaded!")
@@ -1,16 +1,92 @@
 # Copyright (c) 2023 Boston Dynamics AI Institute LLC. All rights reserved.
 
+import atexit
 import base64
+import hashlib
+import itertools
+import json
 import os
+import queue
 import random
+import secrets
 import socket
+import struct
+import threading
 import time
-from typing import Any, Dict
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlparse
 
 import cv2
 import numpy as np
 import requests
 from flask import Flask, jsonify, request
+from requests.adapters import HTTPAdapter
+
+# Binary wire format: a 4-byte big-endian header length, a JSON header, then the
+# concatenated array buffers. The header holds the plain fields of the payload and,
+# for every array, its codec, shape, dtype and position in the body.
+FRAMES_MIMETYPE = "application/x-vlfm-frames"
+IMAGE_CODECS = ("raw", "png", "jpeg")
+# Size of the header at the start of every shared-memory ring. It holds the token used
+# to check that client and server see the same /dev/shm, followed by the ring's write
+# position and capacity (uint64, at _SHM_POSITION_OFFSET) used to detect stale frames.
+_SHM_HEADER_SIZE = 64
+_SHM_ALIGNMENT = 64
+_SHM_POSITION_OFFSET = 40
+# Header with the time (seconds since the epoch) at which the client stops waiting for
+# the response. Servers drop requests that are still waiting past it.
+DEADLINE_HEADER = "X-Request-Deadline"
+
+
+class ImageId(str):
+    """Content hash of an image that was uploaded to a model server. Passing it to
+    send_request in place of the pixels makes the server use its cached copy."""
+
+
+class UnknownImageError(Exception):
+    """Raised when a model server no longer holds an image referenced by its id."""
+
+    def __init__(self, image_ids: List[str]) -> None:
+        super().__init__(f"Images not cached by the server: {image_ids}")
+        self.image_ids = image_ids
+
+
+class StaleFrameError(Exception):
+    """Raised when a frame in a shared-memory ring was overwritten by the client before
+    the server was done reading it."""
+
+
+def image_hash(image: np.ndarray) -> ImageId:
+    """Returns the content hash of an array, including its shape and dtype."""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(f"{image.shape}{image.dtype.str}".encode("ascii"))
+    hasher.update(np.ascontiguousarray(image).data)
+    return ImageId(hasher.hexdigest())
+
+
+class _ImageStore:
+    """Bounded LRU of images kept by a model server, keyed by content hash."""
+
+    def __init__(self, capacity: int) -> None:
+        self._capacity = capacity
+        self._images: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, image_id: str) -> Optional[np.ndarray]:
+        with self._lock:
+            image = self._images.get(image_id)
+            if image is not None:
+                self._images.move_to_end(image_id)
+            return image
+
+    def put(self, image_id: str, image: np.ndarray) -> None:
+        with self._lock:
+            self._images[image_id] = image
+            self._images.move_to_end(image_id)
+            while len(self._images) > self._capacity:
+                self._images.popitem(last=False)
 
 
 class ServerMixin:
@@ -20,19 +96,279 @@ class ServerMixin:
     def process_payload(self, payload: dict) -> dict:
         raise NotImplementedError
 
+    def process_payloads(self, payloads: List[dict]) -> List[dict]:
+        """Processes a batch of payloads collected by host_model's micro-batching.
+        Models that can run batched inference should override this."""
+        return [self.process_payload(payload) for payload in payloads]
+
+    def warmup(self) -> None:
+        """Runs the model once on dummy inputs so that the first real request does not
+        pay for CUDA initialization. Called by host_model in the background; the server
+        reports itself as ready once it returns."""
+        pass
+
+
+# Priority classes for requests to a server with a request queue. Lower values are
+# served first; requests of the same class are served in arrival order.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class DeadlineExceededError(Exception):
+    """Raised by the request scheduler when a request was not run before the client
+    stopped waiting for it."""
+
 
-def host_model(model: Any, name: str, port: int = 5000) -> None:
+class QueueFullError(Exception):
+    """Raised by the request scheduler when its queue has reached its maximum depth."""
+
+    def __init__(self, depth: int, eta: float) -> None:
+        super().__init__(f"Request queue is full ({depth} requests, ~{eta:.1f}s to drain)")
+        self.depth = depth
+        self.eta = eta
+
+
+class _PendingRequest:
+    def __init__(
+        self, payload: dict, shm_frames: Optional[List[dict]] = None, deadline: Optional[float] = None
+    ) -> None:
+        self.payload = payload
+        self.shm_frames = shm_frames or []
+        self.deadline = deadline
+        # Set when the client stopped waiting before the worker picked the request up
+        self.cancelled = False
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class _RequestScheduler:
+    """Queues incoming requests by priority and runs them on the model from a single
+    worker thread, so the model never runs concurrently with itself even though Flask
+    serves requests from many threads.
+
+    Requests arriving within a short window are run through the model's
+    process_payloads in one call, and each request is handed its own result. The queue
+    is bounded: once it is full, new requests are rejected with an estimate of how long
+    the queue needs to drain, which clients use to decide how long to wait.
+    """
+
+    def __init__(self, model: ServerMixin, batch_window: float, max_batch_size: int, max_queue_depth: int) -> None:
+        self._model = model
+        self._batch_window = batch_window
+        self._max_batch_size = max_batch_size
+        self._max_queue_depth = max_queue_depth
+        self._queue: "queue.PriorityQueue[Tuple[int, int, _PendingRequest]]" = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._submit_lock = threading.Lock()
+        # Exponential moving average of the time taken by one batch
+        self._batch_time = 1.0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stats(self, priority: int = PRIORITY_LOW) -> Dict[str, Any]:
+        """Returns the number of queued requests that would be served before a new
+        request of the given priority, and the estimated wait in seconds."""
+        with self._queue.mutex:
+            depth = len(self._queue.queue)
+            position = sum(1 for entry in self._queue.queue if entry[0] <= priority)
+        eta = -(-(position + 1) // self._max_batch_size) * self._batch_time
+        return {"depth": depth, "queue_position": position, "eta_s": eta}
+
+    def submit(self, payload: dict, shm_frames: Optional[List[dict]] = None, deadline: Optional[float] = None) -> Any:
+        """Queues the payload and blocks until it has been processed. shm_frames are
+        the handles of the shared-memory frames the payload points into; the request is
+        dropped with StaleFrameError if they were overwritten while it was queued.
+
+        If a deadline (seconds since the epoch) is given, DeadlineExceededError is
+        raised once it has passed, and the request is dropped if it has not run yet, so
+        that requests abandoned by their clients do not keep the model busy.
+        """
+        priority = int(payload.get("priority", PRIORITY_NORMAL))
+        pending = _PendingRequest(payload, shm_frames, deadline)
+        # Flask serves requests from many threads, the depth check and the put must not interleave
+        with self._submit_lock:
+            depth = self._queue.qsize()
+            if self._max_queue_depth > 0 and depth >= self._max_queue_depth:
+                raise QueueFullError(depth, self.stats(priority)["eta_s"])
+            self._queue.put((priority, next(self._counter), pending))
+        if not pending.done.wait(None if deadline is None else max(0.0, deadline - time.time())):
+            pending.cancelled = True
+            raise DeadlineExceededError("The client stopped waiting for the request")
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _next_batch(self) -> List[_PendingRequest]:
+        batch = [self._queue.get()[2]]
+        deadline = time.monotonic() + self._batch_window
+        while len(batch) < self._max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining)[2])
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = []
+            for pending in self._next_batch():
+                if pending.cancelled or (pending.deadline is not None and time.time() > pending.deadline):
+                    pending.error = DeadlineExceededError("The client stopped waiting for the request")
+                    pending.done.set()
+                elif not shm_frames_are_valid(pending.shm_frames):
+                    pending.error = StaleFrameError("Shared-memory frame was overwritten while queued")
+                    pending.done.set()
+                else:
+                    batch.append(pending)
+            if not batch:
+                continue
+            start_time = time.monotonic()
+            try:
+                results = self._model.process_payloads([pending.payload for pending in batch])
+                for pending, result in zip(batch, results):
+                    pending.result = result
+            except Exception as e:
+                for pending in batch:
+                    pending.error = e
+            self._batch_time = 0.8 * self._batch_time + 0.2 * (time.monotonic() - start_time)
+            for pending in batch:
+                pending.done.set()
+
+
+def host_model(
+    model: Any,
+    name: str,
+    port: int = 5000,
+    batch_window_ms: Optional[float] = None,
+    max_batch_size: Optional[int] = None,
+    max_queue_depth: Optional[int] = None,
+) -> None:
     """
     Hosts a model as a REST API using Flask.
+
+    Args:
+        model: The model to host, a ServerMixin.
+        name: The name of the endpoint.
+        port: The port to listen on.
+        batch_window_ms: How long to wait for more requests before running a batch.
+            Defaults to the VLM_BATCH_WINDOW_MS environment variable, or 10.
+        max_batch_size: The largest number of requests to run in one batch. Defaults
+            to the VLM_MAX_BATCH_SIZE environment variable, or 1 (no batching).
+        max_queue_depth: If positive, requests are queued by their "priority" field
+            and rejected with HTTP 503 once this many are waiting. Defaults to the
+            VLM_MAX_QUEUE_DEPTH environment variable, or 0 (no request queue).
     """
+    if batch_window_ms is None:
+        batch_window_ms = float(os.environ.get("VLM_BATCH_WINDOW_MS", "10"))
+    if max_batch_size is None:
+        max_batch_size = int(os.environ.get("VLM_MAX_BATCH_SIZE", "1"))
+    if max_queue_depth is None:
+        max_queue_depth = int(os.environ.get("VLM_MAX_QUEUE_DEPTH", "0"))
+    use_scheduler = max_batch_size > 1 or max_queue_depth > 0
+    scheduler = (
+        _RequestScheduler(model, batch_window_ms / 1000, max_batch_size, max_queue_depth) if use_scheduler else None
+    )
+
     app = Flask(__name__)
+    image_store = _ImageStore(int(os.environ.get("VLM_SERVER_IMAGE_CACHE", "32")))
+    warm = threading.Event()
+    warmup_error: List[str] = []
+
+    def run_warmup() -> None:
+        try:
+            model.warmup()
+        except Exception as e:
+            # Not fatal, the first real request will just be slower
+            print(f"Warm-up of {name} failed: {e}")
+            warmup_error.append(str(e))
+        warm.set()
+
+    threading.Thread(target=run_warmup, daemon=True).start()
 
     @app.route(f"/{name}", methods=["POST"])
-    def process_request() -> Dict[str, Any]:
-        payload = request.json
-        return jsonify(model.process_payload(payload))
+    def process_request() -> Any:
+        if not warm.is_set():
+            return jsonify({"error": "Server is warming up", "eta_s": 1.0}), 503
+        shm_frames: List[dict] = []
+        if request.mimetype == FRAMES_MIMETYPE:
+            try:
+                payload = decode_frames(request.get_data(), image_store=image_store, shm_frames=shm_frames)
+            except UnknownImageError as e:
+                return jsonify({"error": str(e), "missing_image_ids": e.image_ids}), 409
+            except StaleFrameError as e:
+                return jsonify({"error": str(e)}), 410
+        else:
+            payload = request.json
+        deadline = request.headers.get(DEADLINE_HEADER, type=float)
+        try:
+            if scheduler is None:
+                # Requests waited in the socket backlog, the client may have given up
+                if deadline is not None and time.time() > deadline:
+                    raise DeadlineExceededError("The client stopped waiting for the request")
+                result = model.process_payload(payload)
+            else:
+                result = scheduler.submit(payload, shm_frames, deadline)
+        except DeadlineExceededError as e:
+            eta = 0.0 if scheduler is None else scheduler.stats(int(payload.get("priority", PRIORITY_NORMAL)))["eta_s"]
+            return jsonify({"error": str(e), "eta_s": eta}), 504
+        except QueueFullError as e:
+            response = jsonify({"error": str(e), "queue_depth": e.depth, "eta_s": e.eta})
+            response.headers["Retry-After"] = str(max(1, int(e.eta)))
+            return response, 503
+        except StaleFrameError as e:
+            return jsonify({"error": str(e)}), 410
+        # The model read the frames in place, so they must not have changed under it
+        if not shm_frames_are_valid(shm_frames):
+            return jsonify({"error": "Shared-memory frame was overwritten during processing"}), 410
+        return jsonify(result)
+
+    @app.route("/healthz", methods=["GET"])
+    def healthz() -> Any:
+        # The model is loaded before host_model is called, so a live server always has it
+        status = {"status": "ok", "model": name, "model_loaded": True, "warm": warm.is_set()}
+        if warmup_error:
+            status["warmup_error"] = warmup_error[0]
+        return jsonify(status)
+
+    @app.route("/ready", methods=["GET"])
+    def ready() -> Any:
+        return jsonify({"ready": warm.is_set()}), 200 if warm.is_set() else 503
+
+    @app.route(f"/{name}/queue", methods=["GET"])
+    def queue_status() -> Any:
+        if scheduler is None:
+            return jsonify({"depth": 0, "queue_position": 0, "eta_s": 0.0})
+        return jsonify(scheduler.stats(int(request.args.get("priority", PRIORITY_LOW))))
 
-    app.run(host="localhost", port=port, threaded=False)
+    @app.route(f"/{name}/stats", methods=["GET"])
+    def model_stats() -> Any:
+        # Models may define stats() to report their counters, e.g. cache hits
+        return jsonify(model.stats() if hasattr(model, "stats") else {})
+
+    @app.route(f"/{name}/images", methods=["POST"])
+    def register_images() -> Any:
+        payload = decode_frames(request.get_data(), image_store=image_store)
+        return jsonify({"image_ids": {k: image_hash(v) for k, v in payload.items() if isinstance(v, np.ndarray)}})
+
+    @app.route(f"/{name}/transport", methods=["GET"])
+    def transport() -> Dict[str, Any]:
+        shm_name = request.args.get("shm")
+        shm_token = request.args.get("token", "")
+        return jsonify(
+            {
+                "formats": ["json", "frames"],
+                "codecs": list(IMAGE_CODECS),
+                "shm": shm_name is not None and _check_shared_memory_token(shm_name, shm_token),
+                "image_store": True,
+            }
+        )
+
+    # Requests only need to be served concurrently when they are queued by the scheduler
+    app.run(host="localhost", port=port, threaded=use_scheduler)
 
 
 def bool_arr_to_str(arr: np.ndarray) -> str:
@@ -54,6 +390,46 @@ def str_to_bool_arr(s: str, shape: tuple) -> np.ndarray:
     return unpacked
 
 
+def mask_to_packed_roi(mask: np.ndarray) -> Dict[str, Any]:
+    """Compactly encodes a binary mask: the mask is cropped to the bounding box of its
+    non-zero pixels and bit-packed.
+
+    Args:
+        mask (np.ndarray): A 2D boolean or 0/1 mask.
+
+    Returns:
+        Dict[str, Any]: The base64 bit-packed crop, its (row, col) offset in the mask
+            and its shape.
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        return {"bits": "", "offset": [0, 0], "shape": [0, 0]}
+    top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    crop = mask[top:bottom, left:right].astype(bool)
+    return {
+        "bits": base64.b64encode(np.packbits(crop).tobytes()).decode(),
+        "offset": [int(top), int(left)],
+        "shape": [int(bottom - top), int(right - left)],
+    }
+
+
+def packed_roi_to_mask(packed: Union[str, Dict[str, Any]], shape: tuple) -> np.ndarray:
+    """Decodes a mask encoded by mask_to_packed_roi into a full-size uint8 mask. Masks
+    encoded by bool_arr_to_str are accepted as well."""
+    if isinstance(packed, str):
+        return str_to_bool_arr(packed, shape)
+    mask = np.zeros(shape, dtype=np.uint8)
+    height, width = packed["shape"]
+    if height == 0 or width == 0:
+        return mask
+    bits = np.frombuffer(base64.b64decode(packed["bits"]), dtype=np.uint8)
+    crop = np.unpackbits(bits, count=height * width).reshape(height, width)
+    top, left = packed["offset"]
+    mask[top : top + height, left : left + width] = crop
+    return mask
+
+
 # def image_to_str(img_np: np.ndarray) -> str:
 #     try:
 #         # Debugging: Log image properties before encoding
@@ -97,98 +473,608 @@ def image_to_str(img_np: np.ndarray, quality: float = 90.0) -> str:
 
 
 
-def str_to_image(img_str: str) -> np.ndarray:
+def str_to_image(img_str: Union[str, np.ndarray]) -> np.ndarray:
+    if isinstance(img_str, np.ndarray):
+        # Already decoded by host_model from a binary payload
+        return img_str
     img_bytes = base64.b64decode(img_str)
     img_arr = np.frombuffer(img_bytes, dtype=np.uint8)
     img_np = cv2.imdecode(img_arr, cv2.IMREAD_ANYCOLOR)
     return img_np
 
 
+def encode_array(arr: np.ndarray, codec: str = "raw", quality: int = 95) -> Tuple[bytes, dict]:
+    """Encodes an array for the binary wire format.
+
+    Args:
+        arr (np.ndarray): The array to encode, usually an image.
+        codec (str): One of "raw", "png" or "jpeg". Arrays that cannot be represented
+            by the image codecs (e.g. float arrays) are always sent raw.
+        quality (int): The JPEG quality, only used by the "jpeg" codec.
+
+    Returns:
+        Tuple[bytes, dict]: The encoded buffer and the metadata needed to decode it.
+    """
+    if codec not in IMAGE_CODECS:
+        raise ValueError(f"Invalid image codec: {codec}")
+    is_image = arr.dtype == np.uint8 and (arr.ndim == 2 or (arr.ndim == 3 and arr.shape[2] in (1, 3, 4)))
+    if codec == "jpeg" and is_image and (arr.ndim == 2 or arr.shape[2] != 4):
+        retval, buffer = cv2.imencode(".jpg", arr, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    elif codec == "png" and is_image:
+        # Lowest compression level, as the goal is to save bandwidth but not CPU time
+        retval, buffer = cv2.imencode(".png", arr, [int(cv2.IMWRITE_PNG_COMPRESSION), 1])
+    else:
+        codec, retval, buffer = "raw", True, np.ascontiguousarray(arr)
+    if not retval:
+        raise ValueError(f"Failed to encode array with codec {codec}")
+    data = buffer.tobytes()
+    meta = {"codec": codec, "shape": list(arr.shape), "dtype": arr.dtype.str, "nbytes": len(data)}
+    return data, meta
+
+
+def decode_array(data: Union[bytes, memoryview], meta: dict, offset: int = 0) -> np.ndarray:
+    """Decodes an array encoded by encode_array. Raw arrays are returned as read-only
+    views of the given buffer, without copying."""
+    dtype = np.dtype(meta["dtype"])
+    shape = tuple(meta["shape"])
+    if meta["codec"] == "raw":
+        count = int(np.prod(shape))
+        return np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(shape)
+    buffer = np.frombuffer(data, dtype=np.uint8, count=meta["nbytes"], offset=offset)
+    arr = cv2.imdecode(buffer, cv2.IMREAD_UNCHANGED)
+    if arr is None:
+        raise ValueError(f"Failed to decode array with codec {meta['codec']}")
+    return arr.reshape(shape)
+
+
+class SharedMemoryRing:
+    """Ring buffer in shared memory used to hand frames to model servers on the same
+    host without serializing them over TCP.
+
+    Frames are written one after another and the ring wraps around when it is full, so
+    a frame stays valid until the ring has been written over once. A request that is
+    queued, abandoned by a timed-out client or retried may outlive its frame, so every
+    frame is tagged with its position in the stream of bytes written to the ring. The
+    header holds the end of the last reserved frame, which tells the server whether a
+    frame has been overwritten since (see shm_frames_are_valid).
+    """
+
+    def __init__(self, size: int) -> None:
+        self.shm = shared_memory.SharedMemory(create=True, size=_SHM_HEADER_SIZE + size)
+        self.name = self.shm.name
+        self.token = secrets.token_hex(16)
+        self.shm.buf[: len(self.token)] = self.token.encode("ascii")
+        struct.pack_into("<QQ", self.shm.buf, _SHM_POSITION_OFFSET, 0, size)
+        self._capacity = size
+        self._position = 0
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def write(self, arr: np.ndarray) -> Optional[dict]:
+        """Copies the array into the ring and returns its handle, or None if the array
+        is too large to fit."""
+        nbytes = arr.nbytes
+        if nbytes > self._capacity // 2:
+            return None
+        with self._lock:
+            if self._position % self._capacity + nbytes > self._capacity:
+                # Skip the tail of the ring, the frame starts over at its beginning
+                self._position += self._capacity - self._position % self._capacity
+            position = self._position
+            offset = _SHM_HEADER_SIZE + position % self._capacity
+            self._position += -(-nbytes // _SHM_ALIGNMENT) * _SHM_ALIGNMENT
+            # Published before the copy, so readers of the frames about to be overwritten
+            # see that they are stale
+            struct.pack_into("<Q", self.shm.buf, _SHM_POSITION_OFFSET, self._position)
+        view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=self.shm.buf, offset=offset)
+        view[...] = arr
+        return {
+            "codec": "shm",
+            "name": self.name,
+            "offset": offset,
+            "position": position,
+            "shape": list(arr.shape),
+            "dtype": arr.dtype.str,
+            "nbytes": 0,
+        }
+
+    def close(self) -> None:
+        try:
+            self.shm.close()
+            self.shm.unlink()
+        except (FileNotFoundError, BufferError):
+            pass
+
+
+_SHM_RING: Optional[SharedMemoryRing] = None
+_SHM_RING_PID = -1
+_SHM_RING_LOCK = threading.Lock()
+
+
+def _get_shared_memory_ring() -> Optional[SharedMemoryRing]:
+    """Returns this process' shared-memory ring, or None if the transport is disabled
+    with VLM_SHM_TRANSPORT=0 or shared memory is unavailable."""
+    global _SHM_RING, _SHM_RING_PID
+    if os.environ.get("VLM_SHM_TRANSPORT", "1") != "1":
+        return None
+    with _SHM_RING_LOCK:
+        if _SHM_RING_PID != os.getpid():
+            # A forked child must not write into its parent's ring
+            _SHM_RING_PID = os.getpid()
+            size = int(float(os.environ.get("VLM_SHM_RING_MB", "64")) * 1024 * 1024)
+            try:
+                _SHM_RING = SharedMemoryRing(size)
+            except OSError as e:
+                print(f"Could not create shared memory ring, using the network transport: {e}")
+                _SHM_RING = None
+        return _SHM_RING
+
+
+# Shared-memory segments attached by a server, by name. Bounded so that segments of
+# clients that have exited are eventually released.
+_ATTACHED_SHM: "OrderedDict[str, shared_memory.SharedMemory]" = OrderedDict()
+_ATTACHED_SHM_LOCK = threading.Lock()
+_MAX_ATTACHED_SHM = 64
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    if _SHM_RING is not None and _SHM_RING.name == name:
+        # Client and server live in the same process
+        return _SHM_RING.shm
+    with _ATTACHED_SHM_LOCK:
+        if name in _ATTACHED_SHM:
+            _ATTACHED_SHM.move_to_end(name)
+            return _ATTACHED_SHM[name]
+        shm = shared_memory.SharedMemory(name=name)
+        # The segment belongs to the client. Stop the resource tracker from unlinking
+        # it when the server exits.
+        try:
+            resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore[attr-defined]
+        except Exception:
+            pass
+        _ATTACHED_SHM[name] = shm
+        if len(_ATTACHED_SHM) > _MAX_ATTACHED_SHM:
+            _, evicted = _ATTACHED_SHM.popitem(last=False)
+            try:
+                evicted.close()
+            except BufferError:
+                # Arrays still reference it, the mapping is released with them
+                pass
+        return shm
+
+
+def _check_shared_memory_token(name: str, token: str) -> bool:
+    """Returns True if the named segment is visible to this process and carries the
+    given token, i.e. the client that created it runs on the same host."""
+    try:
+        shm = _attach_shared_memory(name)
+    except (FileNotFoundError, OSError, ValueError):
+        return False
+    return len(token) > 0 and bytes(shm.buf[: len(token)]) == token.encode("ascii")
+
+
+def shm_frames_are_valid(handles: List[dict]) -> bool:
+    """Returns False if any of the shared-memory frames has been overwritten since its
+    handle was created, i.e. the ring has been written past its position plus the
+    capacity of the ring."""
+    for handle in handles:
+        shm = _attach_shared_memory(handle["name"])
+        written, capacity = struct.unpack_from("<QQ", shm.buf, _SHM_POSITION_OFFSET)
+        if written > handle["position"] + capacity:
+            return False
+    return True
+
+
+def encode_frames(
+    payload: Dict[str, Any],
+    codec: str = "raw",
+    quality: int = 95,
+    shm_ring: Optional[SharedMemoryRing] = None,
+    image_ids: Optional[Dict[str, str]] = None,
+) -> bytes:
+    """Serializes a payload whose np.ndarray values are sent as binary buffers. If a
+    shared-memory ring is given, arrays are placed in it and only their handles are
+    sent. ImageId values are sent as references to images cached by the server, and
+    arrays listed in image_ids are cached by the server under the given id."""
+    image_ids = image_ids or {}
+    fields: Dict[str, Any] = {}
+    arrays: Dict[str, dict] = {}
+    buffers: List[bytes] = []
+    offset = 0
+    for k, v in payload.items():
+        if isinstance(v, ImageId):
+            arrays[k] = {"codec": "ref", "id": str(v)}
+        elif isinstance(v, np.ndarray):
+            handle = shm_ring.write(v) if shm_ring is not None else None
+            if handle is not None:
+                if k in image_ids:
+                    handle["id"] = image_ids[k]
+                arrays[k] = handle
+                continue
+            data, meta = encode_array(v, codec=codec, quality=quality)
+            meta["offset"] = offset
+            if k in image_ids:
+                meta["id"] = image_ids[k]
+            arrays[k] = meta
+            buffers.append(data)
+            offset += len(data)
+        else:
+            fields[k] = v
+    header = json.dumps({"fields": fields, "arrays": arrays}).encode("utf-8")
+    return b"".join([struct.pack(">I", len(header)), header] + buffers)
+
+
+def decode_frames(
+    body: bytes, image_store: Optional[_ImageStore] = None, shm_frames: Optional[List[dict]] = None
+) -> Dict[str, Any]:
+    """Deserializes a payload produced by encode_frames. Image references are resolved
+    through the given image store, and raise UnknownImageError if it misses them.
+
+    Frames in a shared-memory ring that have already been overwritten raise
+    StaleFrameError. The handles of the frames returned as views into the ring are
+    appended to shm_frames, so that the caller can check that they are still valid once
+    it is done with them.
+    """
+    (header_len,) = struct.unpack_from(">I", body)
+    header = json.loads(body[4 : 4 + header_len].decode("utf-8"))
+    payload = dict(header["fields"])
+    data_start = 4 + header_len
+    missing_ids = []
+    for k, meta in header["arrays"].items():
+        if meta["codec"] == "ref":
+            arr = image_store.get(meta["id"]) if image_store is not None else None
+            if arr is None:
+                missing_ids.append(meta["id"])
+                continue
+        elif meta["codec"] == "shm":
+            # Zero-copy view into the client's shared-memory ring
+            shm = _attach_shared_memory(meta["name"])
+            if not shm_frames_are_valid([meta]):
+                raise StaleFrameError(f"Frame {k} was overwritten in shared memory")
+            arr = np.ndarray(tuple(meta["shape"]), dtype=np.dtype(meta["dtype"]), buffer=shm.buf, offset=meta["offset"])
+            arr.flags.writeable = False
+            if "id" in meta and image_store is not None:
+                # The ring is reused by the client, so cached images need their own copy
+                arr = arr.copy()
+                arr.flags.writeable = False
+                if not shm_frames_are_valid([meta]):
+                    raise StaleFrameError(f"Frame {k} was overwritten in shared memory while copied")
+            elif shm_frames is not None:
+                shm_frames.append(meta)
+        else:
+            arr = decode_array(body, meta, offset=data_start + meta["offset"])
+        if "id" in meta and image_store is not None:
+            image_store.put(meta["id"], arr)
+        payload[k] = arr
+    if missing_ids:
+        raise UnknownImageError(missing_ids)
+    return payload
+
+
+def _backoff_delay(attempt: int, base: float = 0.1, cap: float = 10.0) -> float:
+    """Exponential backoff with full jitter: a random delay of up to base * 2^attempt
+    seconds, capped."""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def _server_root(url: str) -> str:
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+
+def wait_until_ready(url: str, timeout: float = 300.0) -> None:
+    """Blocks until the server hosting the given endpoint reports that its model is
+    loaded and warmed up, polling with exponential backoff.
+
+    Args:
+        url: The url of any endpoint of the server.
+        timeout: How long to wait, in seconds, before raising a TimeoutError.
+    """
+    client = _get_endpoint_client(url)
+    ready_url = _server_root(url) + "/ready"
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        try:
+            resp = client.session.get(ready_url, timeout=1)
+            # Servers that predate the readiness endpoint are ready once they answer
+            if resp.status_code in (200, 404):
+                return
+        except requests.exceptions.RequestException:
+            pass
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Server at {url} not ready after {timeout} seconds")
+        time.sleep(min(_backoff_delay(attempt, cap=5.0), max(0.0, deadline - time.monotonic())))
+        attempt += 1
+
+
+def get_stats(url: str) -> Dict[str, Any]:
+    """Returns the counters reported by the model behind the endpoint (see host_model's
+    /<name>/stats), or an empty dict if the server does not answer. The request does not
+    go through the request queue."""
+    client = _get_endpoint_client(url)
+    try:
+        resp = client.session.get(url + "/stats", timeout=1)
+        return resp.json() if resp.status_code == 200 else {}
+    except (requests.exceptions.RequestException, ValueError):
+        return {}
+
+
 def send_request(url: str, **kwargs: Any) -> dict:
-    response = {}
-    for attempt in range(10):
+    client = _get_endpoint_client(url)
+    max_attempts = 10
+    for attempt in range(max_attempts):
+        if client.breaker.is_open():
+            # The server looks down; wait for it to come back instead of piling up
+            # failing requests
+            print(f"Circuit open for {url}, waiting for the server to be ready...")
+            wait_until_ready(url)
+            client.breaker.record_success()
         try:
             response = _send_request(url, **kwargs)
-            break
+            client.breaker.record_success()
+            return response
+        except UnknownImageError:
+            # Retrying cannot help, the caller has to register the image again
+            raise
         except Exception as e:
-            if attempt == 9:
+            client.breaker.record_failure()
+            if attempt == max_attempts - 1:
                 print(e)
                 raise e
-                # exit()
-            else:
-                print(f"Error: {e}. Retrying in 40 seconds...")
-                # time.sleep(1)
-                time.sleep(40)
+            delay = _backoff_delay(attempt)
+            print(f"Error: {e}. Retrying in {delay:.2f} seconds...")
+            time.sleep(delay)
 
-    return response
+    raise RuntimeError(f"Request to {url} failed after {max_attempts} attempts")
 
 
-def _send_request(url: str, **kwargs: Any) -> dict:
-    lockfiles_dir = "lockfiles"
-    if not os.path.exists(lockfiles_dir):
-        os.makedirs(lockfiles_dir)
-    pid = os.getpid()
-
-    filename = url.replace("/", "_").replace(":", "_") + f"_p-{pid}.lock"
-    filename = filename.replace("localhost", socket.gethostname())
-    filename = os.path.join(lockfiles_dir, filename)
-    try:
-        while True:
-            # Use a while loop to wait until this filename does not exist
-            while os.path.exists(filename):
-                # If the file exists, wait 50ms and try again
-                time.sleep(0.05)
-
-                try:
-                    # If the file was last modified more than 120 seconds ago, delete it
-                    if time.time() - os.path.getmtime(filename) > 120:
-                        os.remove(filename)
-                except FileNotFoundError:
-                    pass
-
-            rand_str = str(random.randint(0, 1000000))
-
-            with open(filename, "w") as f:
-                f.write(rand_str)
-            time.sleep(0.05)
-            try:
-                with open(filename, "r") as f:
-                    if f.read() == rand_str:
-                        break
-            except FileNotFoundError:
-                pass
+class _CircuitBreaker:
+    """Counts consecutive failed requests to an endpoint. Once the threshold is
+    reached the circuit opens, and requests first wait for the server to be ready."""
+
+    def __init__(self, failure_threshold: int = 3) -> None:
+        self._failure_threshold = failure_threshold
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        return self._failures >= self._failure_threshold
 
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+
+
+class _EndpointClient:
+    """Keep-alive HTTP session and in-process concurrency limit for one endpoint.
+
+    Connections are pooled by the session, so consecutive requests to the same model
+    server reuse a socket instead of paying a TCP handshake every call. The semaphore
+    caps how many threads of this process may talk to the endpoint at once.
+    """
+
+    def __init__(self, url: str, max_concurrency: int) -> None:
+        self.url = url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.breaker = _CircuitBreaker()
+        # Image codec used for this endpoint. None until negotiated with the server,
+        # "json" when the server only understands the legacy base64-JPEG payloads.
+        self.codec: Optional[str] = None
+        self.quality = int(os.environ.get("VLM_IMAGE_QUALITY", "95"))
+        # Shared-memory ring used for this endpoint, set when negotiation confirms that
+        # the server runs on this host
+        self.shm_ring: Optional[SharedMemoryRing] = None
+        # Ids of the images this process believes the server has cached. Only used if
+        # the server has an image store.
+        self.supports_image_ids = False
+        self._known_image_ids: "OrderedDict[str, None]" = OrderedDict()
+        self._known_image_capacity = int(os.environ.get("VLM_SERVER_IMAGE_CACHE", "32"))
+        self._known_image_lock = threading.Lock()
+
+    def is_image_known(self, image_id: str) -> bool:
+        with self._known_image_lock:
+            if image_id in self._known_image_ids:
+                self._known_image_ids.move_to_end(image_id)
+                return True
+            return False
+
+    def remember_images(self, image_ids: List[str]) -> None:
+        with self._known_image_lock:
+            for image_id in image_ids:
+                self._known_image_ids[image_id] = None
+                self._known_image_ids.move_to_end(image_id)
+            while len(self._known_image_ids) > self._known_image_capacity:
+                self._known_image_ids.popitem(last=False)
+
+    def forget_images(self, image_ids: List[str]) -> None:
+        with self._known_image_lock:
+            for image_id in image_ids:
+                self._known_image_ids.pop(image_id, None)
+
+    def negotiate_codec(self) -> str:
+        """Asks the server which codecs it supports and picks one for this endpoint.
+
+        The preferred codec is taken from the VLM_IMAGE_CODEC environment variable. By
+        default it is "raw" for servers on this host, where frames go through shared
+        memory or the loopback, and "jpeg" for remote servers, where the bandwidth
+        matters more than the encoding time. Servers that predate the binary format
+        fall back to "json".
+        """
+        if self.codec is not None:
+            return self.codec
+        preferred = os.environ.get("VLM_IMAGE_CODEC", "raw" if _is_local_url(self.url) else "jpeg")
+        ring = _get_shared_memory_ring() if _is_local_url(self.url) else None
+        params = {"shm": ring.name, "token": ring.token} if ring is not None else {}
+        try:
+            resp = self.session.get(self.url + "/transport", params=params, timeout=1)
+            transport = resp.json() if resp.status_code == 200 else {}
+            codecs = transport.get("codecs", [])
+        except (requests.exceptions.RequestException, ValueError):
+            # Server may still be loading; retry negotiation on the next request
+            return "json"
+        if ring is not None and transport.get("shm", False):
+            self.shm_ring = ring
+        self.supports_image_ids = transport.get("image_store", False) and os.environ.get("VLM_IMAGE_DEDUP", "1") == "1"
+        if preferred in codecs:
+            self.codec = preferred
+        elif codecs:
+            self.codec = codecs[0]
+        else:
+            self.codec = "json"
+        return self.codec
+
+
+_ENDPOINT_CLIENTS: Dict[str, _EndpointClient] = {}
+_ENDPOINT_CLIENTS_LOCK = threading.Lock()
+_ENDPOINT_CLIENTS_PID = os.getpid()
+
+
+def _get_endpoint_client(url: str) -> _EndpointClient:
+    """Returns the shared client for the given url, creating it on first use."""
+    global _ENDPOINT_CLIENTS_PID
+    with _ENDPOINT_CLIENTS_LOCK:
+        if _ENDPOINT_CLIENTS_PID != os.getpid():
+            # Sockets must not be shared with a parent process after a fork
+            _ENDPOINT_CLIENTS.clear()
+            _ENDPOINT_CLIENTS_PID = os.getpid()
+        if url not in _ENDPOINT_CLIENTS:
+            max_concurrency = int(os.environ.get("VLM_CLIENT_MAX_CONCURRENCY", "4"))
+            _ENDPOINT_CLIENTS[url] = _EndpointClient(url, max(1, max_concurrency))
+        return _ENDPOINT_CLIENTS[url]
+
+
+def _is_local_url(url: str) -> bool:
+    hostname = urlparse(url).hostname
+    return hostname in ("localhost", "127.0.0.1", "::1", socket.gethostname())
+
+
+def set_image_codec(url: str, codec: str, quality: Optional[int] = None) -> None:
+    """Overrides the image codec used for one endpoint, e.g. "jpeg" for a remote
+    server behind a slow link, or "json" to force the legacy base64-JPEG payloads.
+    This also disables the shared-memory transport for the endpoint."""
+    if codec not in IMAGE_CODECS + ("json",):
+        raise ValueError(f"Invalid image codec: {codec}")
+    client = _get_endpoint_client(url)
+    client.codec = codec
+    client.shm_ring = None
+    if quality is not None:
+        client.quality = quality
+
+
+def register_image(url: str, image: np.ndarray) -> ImageId:
+    """Uploads an image to the server at the given url, which caches it. The returned
+    id can then be passed to send_request instead of the pixels, e.g. for an image that
+    is queried many times."""
+    client = _get_endpoint_client(url)
+    client.negotiate_codec()
+    if not client.supports_image_ids:
+        raise RuntimeError(f"Server at {url} does not cache images")
+    image_id = image_hash(image)
+    body = encode_frames(
+        {"image": image}, codec=client.codec or "raw", quality=client.quality, image_ids={"image": image_id}
+    )
+    with client.semaphore:
+        resp = client.session.post(url + "/images", headers={"Content-Type": FRAMES_MIMETYPE}, data=body, timeout=20)
+    resp.raise_for_status()
+    client.remember_images([image_id])
+    return image_id
+
+
+def _encode_request(client: _EndpointClient, codec: str, kwargs: Dict[str, Any]) -> Tuple[dict, bytes, List[str]]:
+    """Builds the headers and body of a request, returning also the ids of the images
+    that the server will cache once the request succeeds."""
+    if codec == "json":
         # Create a payload dict which is a clone of kwargs but all np.array values are
         # converted to strings
         payload = {}
         for k, v in kwargs.items():
+            if isinstance(v, ImageId):
+                raise ValueError(f"Server at {client.url} does not accept image ids")
             if isinstance(v, np.ndarray):
                 payload[k] = image_to_str(v)
             else:
                 payload[k] = v
+        return {"Content-Type": "application/json"}, json.dumps(payload).encode("utf-8"), []
+
+    # Images the server already holds are replaced by their id; the others are sent
+    # along with their id so the server caches them for the following requests
+    payload = dict(kwargs)
+    image_ids: Dict[str, str] = {}
+    if client.supports_image_ids:
+        for k, v in kwargs.items():
+            if isinstance(v, np.ndarray):
+                image_id = image_hash(v)
+                if client.is_image_known(image_id):
+                    payload[k] = image_id
+                else:
+                    image_ids[k] = image_id
+    body = encode_frames(payload, codec=codec, quality=client.quality, shm_ring=client.shm_ring, image_ids=image_ids)
+    return {"Content-Type": FRAMES_MIMETYPE}, body, list(image_ids.values())
 
-        # Set the headers
-        headers = {"Content-Type": "application/json"}
 
-        start_time = time.time()
-        
-        slow_request = 'request_timeout' in kwargs # when calling LLM, we increse the amount of time
-        if slow_request:
-            request_timeout_raise_exception = 50 # in second 
-            timeout = 30
-            # print("this is a slow request")
-        else:
-            timeout = 1
-            request_timeout_raise_exception = 20
+def _send_request(url: str, **kwargs: Any) -> dict:
+    client = _get_endpoint_client(url)
+    codec = client.negotiate_codec()
+    headers, body, new_image_ids = _encode_request(client, codec, kwargs)
+
+    start_time = time.time()
+
+    slow_request = "request_timeout" in kwargs  # when calling LLM, we increse the amount of time
+    if slow_request:
+        request_timeout_raise_exception = 50  # in second
+        timeout = 30
+    else:
+        timeout = 1
+        request_timeout_raise_exception = 20
+
+    retries = 0
+    with client.semaphore:
         while True:
             try:
-                resp = requests.post(url, headers=headers, json=payload, timeout=timeout)
+                # The server drops the request if it cannot start it before we give up
+                deadline = {DEADLINE_HEADER: repr(time.time() + timeout)}
+                resp = client.session.post(url, headers={**headers, **deadline}, data=body, timeout=timeout)
                 if resp.status_code == 200:
                     result = resp.json()
+                    client.remember_images(new_image_ids)
                     break
+                elif resp.status_code == 409:  # Server evicted some of the referenced images
+                    missing_ids = resp.json()["missing_image_ids"]
+                    client.forget_images(missing_ids)
+                    if any(isinstance(v, ImageId) and v in missing_ids for v in kwargs.values()):
+                        raise UnknownImageError(missing_ids)
+                    headers, body, new_image_ids = _encode_request(client, codec, kwargs)
+                elif resp.status_code == 410:  # Our shared-memory frames were overwritten
+                    headers, body, new_image_ids = _encode_request(client, codec, kwargs)
                 elif resp.status_code == 503:  # Server is busy
-                    print("Server is busy, retrying after 5 seconds...")
-                    time.sleep(5)
+                    # Wait for the queue to drain by the server's estimate, rather than
+                    # a fixed amount of time
+                    try:
+                        eta = float(resp.json().get("eta_s", 5.0))
+                    except ValueError:
+                        eta = 5.0
+                    wait = min(max(eta, 0.05), 10.0) * random.uniform(0.8, 1.2)
+                    print(f"Server is busy, retrying after {wait:.2f} seconds...")
+                    time.sleep(wait)
+                elif resp.status_code == 504:  # Dropped by the server past our deadline
+                    if time.time() - start_time > request_timeout_raise_exception:
+                        raise Exception(f"Request timed out after {request_timeout_raise_exception} seconds")
+                    # Wait long enough for the queue ahead of us to drain next time
+                    try:
+                        eta = float(resp.json().get("eta_s", 0.0))
+                    except ValueError:
+                        eta = 0.0
+                    timeout = max(timeout, min(2 * eta, request_timeout_raise_exception))
+                    print(f"Request expired in the server queue, retrying with a {timeout:.1f}s timeout...")
                 else:
                     raise Exception("Request failed")
             except (
@@ -197,23 +1083,11 @@ def _send_request(url: str, **kwargs: Any) -> dict:
             ) as e:
                 print(e)
                 print("failed to call the server", url)
-                print("HEADERS", headers)
                 print("timeout", timeout)
                 if time.time() - start_time > request_timeout_raise_exception:
-                    raise Exception("Request timed out after 20 seconds")
-
-        try:
-            # Delete the lock file
-            os.remove(filename)
-        except FileNotFoundError:
-            pass
-
-    except Exception as e:
-        try:
-            # Delete the lock file
-            os.remove(filename)
-        except FileNotFoundError:
-            pass
-        raise e
+                    raise Exception(f"Request timed out after {request_timeout_raise_exception} seconds")
+                # Short hiccups are retried within milliseconds, longer outages back off
+                time.sleep(_backoff_delay(retries, base=0.01, cap=2.0))
+                retries += 1
 
     return result